@@ -8,7 +8,11 @@
 #include <SLIPEncodedUSBSerial.h>
 
 #include "Arduino.h"
-#include <ESP8266WiFi.h> // This depends on board architecture, ESP32 needs something else
+#if defined(ESP32)
+#include <WiFi.h>
+#else
+#include <ESP8266WiFi.h>
+#endif
 #include <WiFiUdp.h>
 #include <SPI.h>
 #include <OSCMessage.h>
@@ -20,6 +24,20 @@
 WiFiUDP udp;                            // Wifi UDP instance
 IPAddress ip;                           // The ESP's IP
 
+// A whole datagram is read at once into this buffer, osc_output.py keeps them below 1400 bytes
+const int maxPacketSize = 1472;
+uint8_t packetBuffer[maxPacketSize];
+
+// Reused for every packet instead of being made again
+OSCBundle inBundle;
+OSCMessage inMessage;
+
+// Counters, printed every few seconds
+unsigned long packetsReceived = 0;
+unsigned long messagesReceived = 0;
+unsigned long packetErrors = 0;
+unsigned long lastReport = 0;
+
 // -----------------------
 // Network Stuff
 // -----------------------
@@ -29,14 +47,51 @@ char pass[] = "";                       // your network password
 const unsigned int receivePort = 8888;  // Local port to listen (if listening for some data)
 const unsigned int outPort = 9999;      // Port to send to
 
+// -----------------------
+// Routing table
+// -----------------------
+
+void sayHello(OSCMessage &msg);
+void onPosition(OSCMessage &msg);
+
+/**
+ * The handler of every address, add a line to handle another address
+ */
+struct Route {
+  const char *address;
+  void (*handler)(OSCMessage &);
+};
+
+Route routes[] = {
+  {"/hello", sayHello},
+  {"/position", onPosition},
+};
+const int numberOfRoutes = sizeof(routes) / sizeof(routes[0]);
+
+// -----------------------
+// Positions
+// -----------------------
+
+// The last position of every tag, as sent by osc_output.py: tag id, x, y, z in mm
+const int maxTags = 32;
+struct TagPosition {
+  int32_t id;
+  int32_t x;
+  int32_t y;
+  int32_t z;
+  unsigned long received;
+};
+TagPosition positions[maxTags];
+int numberOfTags = 0;
+
 // -----------------------
 // General Program Logic
 // -----------------------
 
 /**
- * Sends an OSC message to a specific address
+ * Sends an OSC message to a specific address, the message is passed by reference, not copied
  */
-void sendMessage(IPAddress to, OSCMessage msg) {
+void sendMessage(IPAddress to, OSCMessage &msg) {
   // Sending over udp, begin the packet header
   udp.beginPacket(to, outPort);
 
@@ -51,25 +106,60 @@ void sendMessage(IPAddress to, OSCMessage msg) {
 }
 
 /**
- * Receiving the messages from a specific address
+ * Passes a message to the handlers of the routing table whose address matches
  */
-void receiveMessage() {
-  // Creates the internal
-  OSCMessage inmsg;
+void route(OSCMessage &msg) {
+  messagesReceived++;
+  for (int i = 0; i < numberOfRoutes; i++) {
+    if (msg.dispatch(routes[i].address, routes[i].handler)) {
+      return;
+    }
+  }
+}
 
+/**
+ * Receives one packet, a message or a bundle of messages, returns false when there was none
+ */
+bool receiveMessage() {
   // Parse the UDP package
   int size = udp.parsePacket();
 
   // Did we receive something?
-  if (size > 0) {
-    while (size--) {
-      inmsg.fill(udp.read());
+  if (size <= 0) {
+    return false;
+  }
+  packetsReceived++;
+  if (size > maxPacketSize) {
+    // Doesn't fit the buffer, skip it
+    udp.flush();
+    packetErrors++;
+    return true;
+  }
+
+  // Read the whole packet at once instead of byte by byte
+  udp.read(packetBuffer, size);
+
+  if (packetBuffer[0] == '#') {
+    // A bundle, osc_output.py sends the positions of many tags in one
+    inBundle.fill(packetBuffer, size);
+    if (!inBundle.hasError()) {
+      for (int i = 0; i < inBundle.size(); i++) {
+        route(*inBundle.getOSCMessage(i));
+      }
+    } else {
+      packetErrors++;
     }
-    if (!inmsg.hasError()) {
-      inmsg.dispatch("/hello", sayHello);
-      // @TODO dispatch other functions
+    inBundle.empty();
+  } else {
+    inMessage.fill(packetBuffer, size);
+    if (!inMessage.hasError()) {
+      route(inMessage);
+    } else {
+      packetErrors++;
     }
+    inMessage.empty();
   }
+  return true;
 }
 
 // ------------------------------
@@ -83,6 +173,47 @@ void sayHello(OSCMessage &msg) {
   Serial.print("Hello World!");
 }
 
+/**
+ * Keeps the last position of a tag: /position tag id, x, y, z
+ */
+void onPosition(OSCMessage &msg) {
+  if (msg.size() < 4) {
+    return;
+  }
+  int32_t id = msg.getInt(0);
+  int i = 0;
+  while (i < numberOfTags && positions[i].id != id) {
+    i++;
+  }
+  if (i == numberOfTags) {
+    if (numberOfTags == maxTags) {
+      return;
+    }
+    numberOfTags++;
+  }
+  positions[i].id = id;
+  positions[i].x = msg.getInt(1);
+  positions[i].y = msg.getInt(2);
+  positions[i].z = msg.getInt(3);
+  positions[i].received = millis();
+}
+
+/**
+ * Prints the counters and the positions every few seconds
+ */
+void report() {
+  unsigned long now = millis();
+  if (now - lastReport < 5000) {
+    return;
+  }
+  lastReport = now;
+  Serial.printf("Packets: %lu, messages: %lu, errors: %lu\n", packetsReceived, messagesReceived, packetErrors);
+  for (int i = 0; i < numberOfTags; i++) {
+    Serial.printf("POS ID: 0x%04x, x(mm): %d, y(mm): %d, z(mm): %d\n",
+                  positions[i].id, positions[i].x, positions[i].y, positions[i].z);
+  }
+}
+
 // ------------------------------
 // Setup the program
 // ------------------------------
@@ -149,9 +280,12 @@ void loop() {
    * This wil receive OSC
    */
 
-  // Checks if we received a message
-  receiveMessage();
+  // Handle every packet that is waiting, a packet that waits for a delay is late or dropped
+  while (receiveMessage()) {
+  }
+
+  report();
 
-  // Sets delay.. wait
-  delay(16);
+  // Let the WiFi stack do its work, without delaying the next packets
+  yield();
 }
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Gives many tags the same list of anchors quickly, and checks that they really hold it.
+
+The Pozyx protocol adds one device per ADD_DEVICE call, and for a remote tag every call is a round
+trip over UWB, so the time goes into calls that don't need to be made. AnchorProvisioner:
+
+    reads back the device list of a tag in two calls (its size and all ids at once) plus the
+    coordinates of every device, and compares a CRC32 of it with the one of the desired list
+    only adds the anchors that are missing or have other coordinates, and only clears the list when
+    it holds devices that don't belong there
+    writes the anchor selection register only when it differs, and saves to flash in one go
+    reads the list back after writing and retries just the devices that still don't match
+    provisions the tags behind different Pozyx devices (links) at the same time
+
+A tag that already holds the right list costs only the read back.
+"""
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from pypozyx import (Coordinates, Data, DeviceCoordinates, DeviceList, PozyxConstants, PozyxRegisters,
+                     SingleRegister, POZYX_SUCCESS, POZYX_FAILURE)
+from pypozyx.structures.generic import dataCheck
+
+
+# the most ids GET_DEVICE_LIST_IDS returns, and the most devices a Pozyx holds
+MAX_DEVICES = 20
+
+
+def checksum(devices):
+    """CRC32 of a list of (network id, (x, y, z)), independent of the order of the devices"""
+    packed = b''.join(struct.pack('<Hiii', network_id, *position) for network_id, position in sorted(devices))
+    return zlib.crc32(packed)
+
+
+class ProvisionReport(object):
+    """What provisioning a tag took"""
+
+    def __init__(self, tag_id):
+        self.tag_id = tag_id
+        self.status = POZYX_SUCCESS
+        self.written = 0
+        self.cleared = False
+        self.retries = 0
+        self.saved = False
+        self.checksum = None
+        self.verified = False
+        self.time = 0
+
+    def name(self):
+        return "local" if self.tag_id is None else "0x%0.4x" % self.tag_id
+
+    def __str__(self):
+        return "TAG {}: {}, anchors written: {}{}, retries: {}, saved: {}, checksum: {}, {:.0f}ms".format(
+            self.name(), "verified" if self.verified else "failure", self.written,
+            " (list cleared)" if self.cleared else "", self.retries, self.saved,
+            "0x%08x" % self.checksum if self.checksum is not None else "none", self.time * 1000)
+
+
+class AnchorProvisioner(object):
+    """Provisions the device list of many tags, writing only what differs and verifying the result"""
+
+    def __init__(self, anchors, anchor_select=PozyxConstants.ANCHOR_SELECT_AUTO, save_to_flash=True, retries=2):
+        """
+        Args:
+            anchors: DeviceCoordinates or [id, flag, x, y, z] of the anchors.
+            anchor_select (optional): the anchor selection mode written along, None leaves it alone.
+            save_to_flash (optional): save the device list of a tag when it changed.
+            retries (optional): times the devices that don't match after writing are written again.
+        """
+        self.anchors = []
+        for anchor in anchors:
+            if not dataCheck(anchor):
+                anchor = DeviceCoordinates(anchor[0], anchor[1], Coordinates(anchor[2], anchor[3], anchor[4]))
+            self.anchors.append(anchor)
+        if len(self.anchors) > MAX_DEVICES:
+            raise ValueError("A Pozyx holds at most %i devices, not %i" % (MAX_DEVICES, len(self.anchors)))
+        self.desired = {anchor.network_id: (int(anchor.pos.x), int(anchor.pos.y), int(anchor.pos.z))
+                        for anchor in self.anchors}
+        self.checksum = checksum(self.desired.items())
+        self.selection = None if anchor_select is None else (anchor_select << 7) + len(self.anchors)
+        self.save_to_flash = save_to_flash
+        self.retries = retries
+
+    def provision(self, links):
+        """Provisions the tags of every (pozyx, tag_ids) link, the links at the same time"""
+        if len(links) == 1:
+            return self.provisionLink(*links[0])
+        with ThreadPoolExecutor(max_workers=len(links)) as executor:
+            results = list(executor.map(lambda link: self.provisionLink(*link), links))
+        return [report for reports in results for report in reports]
+
+    def provisionLink(self, pozyx, tag_ids):
+        """Provisions the tags behind a single Pozyx one by one, they share its radio"""
+        return [self.provisionTag(pozyx, tag_id) for tag_id in tag_ids]
+
+    def provisionTag(self, pozyx, tag_id):
+        report = ProvisionReport(tag_id)
+        start = perf_counter()
+        stored = self.readDeviceList(pozyx, tag_id)
+        changed = False
+        for attempt in range(self.retries + 1):
+            if stored is not None:
+                report.checksum = checksum(stored.items())
+                if report.checksum == self.checksum:
+                    report.verified = True
+                    break
+            if attempt > 0:
+                report.retries += 1
+            changed = True
+            written, cleared = self.writeDevices(pozyx, tag_id, stored)
+            report.written += written
+            report.cleared |= cleared
+            stored = self.readDeviceList(pozyx, tag_id)
+
+        if report.verified:
+            if self.selection is not None:
+                selection = SingleRegister()
+                if pozyx.getRead(PozyxRegisters.POSITIONING_NUMBER_OF_ANCHORS, selection, tag_id) != POZYX_SUCCESS:
+                    report.status = POZYX_FAILURE
+                elif selection[0] != self.selection:
+                    report.status &= pozyx.setWrite(PozyxRegisters.POSITIONING_NUMBER_OF_ANCHORS,
+                                                    SingleRegister(self.selection), tag_id)
+                    changed = True
+            if changed and self.save_to_flash:
+                report.status &= self.saveDevices(pozyx, tag_id)
+                report.saved = True
+        else:
+            report.status = POZYX_FAILURE
+        report.time = perf_counter() - start
+        return report
+
+    def readDeviceList(self, pozyx, tag_id):
+        """The device list of the tag as a dictionary of id to (x, y, z), None when it couldn't be read"""
+        list_size = SingleRegister()
+        if pozyx.getDeviceListSize(list_size, tag_id) != POZYX_SUCCESS:
+            return None
+        if list_size[0] == 0:
+            return {}
+        # all ids in one call, getDeviceIds would read the size again first
+        device_ids = DeviceList(list_size=min(list_size[0], MAX_DEVICES))
+        if pozyx.useFunction(PozyxRegisters.GET_DEVICE_LIST_IDS, Data([0, len(device_ids)]), device_ids,
+                             tag_id) != POZYX_SUCCESS:
+            return None
+        devices = {}
+        for device_id in device_ids.data:
+            position = Coordinates()
+            if pozyx.getDeviceCoordinates(device_id, position, tag_id) != POZYX_SUCCESS:
+                return None
+            devices[device_id] = (int(position.x), int(position.y), int(position.z))
+        return devices
+
+    def writeDevices(self, pozyx, tag_id, stored):
+        """Adds the anchors the stored list lacks, returns how many were written and if the list was cleared"""
+        cleared = stored is None or any(device_id not in self.desired for device_id in stored)
+        if cleared:
+            # devices can only be removed by rebuilding the list
+            pozyx.clearDevices(tag_id)
+            stored = {}
+        written = 0
+        for anchor in self.anchors:
+            if stored.get(anchor.network_id) != self.desired[anchor.network_id]:
+                # adding a device that is in the list already replaces it
+                pozyx.addDevice(anchor, tag_id)
+                written += 1
+        return written, cleared
+
+    def saveDevices(self, pozyx, tag_id):
+        status = pozyx.saveConfiguration(PozyxConstants.FLASH_SAVE_NETWORK, remote_id=tag_id)
+        status &= pozyx.saveRegisters([PozyxRegisters.POSITIONING_NUMBER_OF_ANCHORS], remote_id=tag_id)
+        return status
+
+    def printReport(self, reports):
+        for report in reports:
+            print(report)
+        verified = sum(1 for report in reports if report.verified)
+        written = sum(report.written for report in reports)
+        print("Provisioned {} tags, {} verified, {} anchors written, {} retries".format(
+            len(reports), verified, written, sum(report.retries for report in reports)))
+
+
+def provision_one_by_one(pozyx, tag_ids, anchors):
+    """How the scripts did it: clear the list, add every anchor and save, for one tag after the other"""
+    for tag_id in tag_ids:
+        pozyx.clearDevices(tag_id)
+        for anchor in anchors:
+            pozyx.addDevice(anchor, tag_id)
+        pozyx.setSelectionOfAnchors(PozyxConstants.ANCHOR_SELECT_AUTO, len(anchors), remote_id=tag_id)
+        pozyx.saveConfiguration(PozyxConstants.FLASH_SAVE_NETWORK, remote_id=tag_id)
+        pozyx.saveRegisters([PozyxRegisters.POSITIONING_NUMBER_OF_ANCHORS], remote_id=tag_id)
+
+
+if __name__ == "__main__":
+    # provisions 16 anchors to 50 simulated tags behind 5 masters, from scratch, again when nothing
+    # changed and after the lists of a few tags were damaged, compared with one tag and anchor at a time
+    from simulated_pozyx import LatencyModel, SimulatedNetwork, SimulatedPozyxSerial
+
+    anchors = [DeviceCoordinates(0xa000 + i, 1, Coordinates(4000 * (i % 4), 4000 * (i // 4), 2500)) for i in range(16)]
+    masters = [0x6000 + i for i in range(5)]
+
+    def create_links(network):
+        for anchor in anchors:
+            network.addAnchor(anchor.network_id, (anchor.pos.x, anchor.pos.y, anchor.pos.z))
+        links = []
+        for master_id in masters:
+            network.addTag(master_id)
+            tag_ids = [master_id + 0x100 * i for i in range(1, 11)]
+            for tag_id in tag_ids:
+                network.addTag(tag_id)
+            links.append((SimulatedPozyxSerial(network, master_id), tag_ids))
+        return links
+
+    # without contention every master has its own channel, like the gateways of gateway_runner.py
+    network = SimulatedNetwork(LatencyModel(jitter=0.1, seed=1), air_contention=False)
+    links = create_links(network)
+    start = perf_counter()
+    for pozyx, tag_ids in links:
+        provision_one_by_one(pozyx, tag_ids, anchors)
+    print("One tag and anchor at a time: {:.1f}s".format(perf_counter() - start))
+
+    network = SimulatedNetwork(LatencyModel(jitter=0.1, seed=1), air_contention=False)
+    links = create_links(network)
+    provisioner = AnchorProvisioner(anchors)
+    for run in ["From scratch", "Nothing changed"]:
+        start = perf_counter()
+        reports = provisioner.provision(links)
+        print("{}: {:.1f}s".format(run, perf_counter() - start))
+        provisioner.printReport(reports)
+
+    # a tag that lost an anchor, one with a wrong position and one with a stray device
+    devices = network.devices
+    devices[0x6100].devices = devices[0x6100].devices[:-1]
+    devices[0x6201].devices[3] = (devices[0x6201].devices[3][0], 1, (0, 0, 0))
+    devices[0x6302].devices.append((0xbeef, 1, (1, 2, 3)))
+    start = perf_counter()
+    reports = provisioner.provision(links)
+    print("Three damaged tags: {:.1f}s".format(perf_counter() - start))
+    for report in reports:
+        if report.written:
+            print(report)
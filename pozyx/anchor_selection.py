@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Chooses on the host which anchors a tag ranges with, by the geometry of the anchors around it.
+
+With more than four anchors the scripts let the tag select its anchors automatically, and the tag
+then ranges with up to all of them: every extra anchor costs another ranging exchange per position.
+A few anchors around the tag, in different directions, give about the same precision.
+
+AnchorSelector divides the floor into a grid and computes once, for the middle of every cell, the
+smallest subset of anchors with a good geometric dilution of precision (GDOP): the square root of
+the trace of (H^T H)^-1, with H the unit vectors from the tag to the anchors, or their horizontal
+part in 2D and 2.5D. Lower is better, three anchors all on one side of the tag give a high GDOP.
+Only the nearest candidates of a cell are combined, which keeps this fast with many anchors.
+
+AnchorSubsets pushes the subset of a tag's cell to the tag with setPositioningAnchorIds and manual
+anchor selection, but only when the tag moves into a cell with another subset.
+"""
+from itertools import combinations
+from math import floor
+from time import perf_counter
+
+import numpy as np
+from pypozyx import PozyxConstants, POZYX_SUCCESS
+
+
+def gdop(unit_vectors):
+    """
+    The GDOP of many anchor subsets at once.
+
+    Args:
+        unit_vectors: array of (..., anchors, 2 or 3) unit vectors from the tag to the anchors.
+
+    Returns:
+        array of (...) GDOPs, inf for subsets that can't fix a position.
+    """
+    m = np.einsum('...ki,...kj->...ij', unit_vectors, unit_vectors)
+    if m.shape[-1] == 2:
+        det = m[..., 0, 0] * m[..., 1, 1] - m[..., 0, 1] * m[..., 1, 0]
+        trace_adjugate = m[..., 0, 0] + m[..., 1, 1]
+    else:
+        # the trace of the adjugate is the sum of the principal 2x2 minors
+        minors = [m[..., a, a] * m[..., b, b] - m[..., a, b] * m[..., b, a] for a, b in ((1, 2), (0, 2), (0, 1))]
+        trace_adjugate = minors[0] + minors[1] + minors[2]
+        det = np.linalg.det(m)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.sqrt(trace_adjugate / det)
+    return np.where(det > 1e-9, result, np.inf)
+
+
+class AnchorSelector(object):
+    """A lookup grid of the best anchor subset for every cell of the floor"""
+
+    def __init__(self, anchors, dimension=PozyxConstants.DIMENSION_3D, height=1000, cell_size=1000,
+                 min_anchors=4, max_anchors=6, max_gdop=2.0, candidates=8, max_range=None, bounds=None):
+        """
+        Args:
+            anchors: DeviceCoordinates of all anchors.
+            dimension (optional): 2D and 2.5D only count the horizontal geometry.
+            height (optional): height of the tags in mm, where the GDOP is computed.
+            cell_size (optional): width of a grid cell in mm.
+            min_anchors (optional): smallest subset to consider, at least 3.
+            max_anchors (optional): largest subset to consider.
+            max_gdop (optional): the smallest subset with at most this GDOP is taken, when no subset
+                gets that low the one with the lowest GDOP.
+            candidates (optional): the nearest anchors of a cell the subsets are made of.
+            max_range (optional): anchors farther than this many mm from a cell are left out.
+            bounds (optional): (x_min, y_min, x_max, y_max) of the grid, the anchors' by default.
+        """
+        self.anchors = anchors
+        self.dimension = dimension
+        self.height = height
+        self.cell_size = float(cell_size)
+        self.min_anchors = max(3, min(min_anchors, len(anchors)))
+        self.max_anchors = max(self.min_anchors, min(max_anchors, len(anchors)))
+        self.max_gdop = max_gdop
+        self.candidates = max(candidates, self.max_anchors)
+        self.max_range = max_range
+        self.positions = np.array([(anchor.pos.x, anchor.pos.y, anchor.pos.z) for anchor in anchors], dtype=float)
+        if bounds is None:
+            bounds = (self.positions[:, 0].min(), self.positions[:, 1].min(),
+                      self.positions[:, 0].max(), self.positions[:, 1].max())
+        self.origin = (bounds[0], bounds[1])
+        self.columns = max(1, int(np.ceil((bounds[2] - bounds[0]) / self.cell_size)))
+        self.rows = max(1, int(np.ceil((bounds[3] - bounds[1]) / self.cell_size)))
+        # per cell the anchor ids of its subset and its GDOP
+        self.subsets = [[None] * self.rows for _ in range(self.columns)]
+        self.gdops = np.full((self.columns, self.rows), np.inf)
+        self.build()
+
+    def build(self):
+        for column in range(self.columns):
+            for row in range(self.rows):
+                x = self.origin[0] + (column + 0.5) * self.cell_size
+                y = self.origin[1] + (row + 0.5) * self.cell_size
+                indices, value = self.best(x, y)
+                self.subsets[column][row] = tuple(self.anchors[index].network_id for index in indices)
+                self.gdops[column, row] = value
+
+    def best(self, x, y):
+        """The indices of the anchors to use at x, y and their GDOP"""
+        offsets = self.positions - np.array([x, y, self.height], dtype=float)
+        distances = np.linalg.norm(offsets, axis=1)
+        nearest = np.argsort(distances)
+        if self.max_range is not None:
+            in_range = nearest[distances[nearest] <= self.max_range]
+            # too few anchors in range: the nearest ones are still the best bet
+            nearest = in_range if len(in_range) >= self.min_anchors else nearest[:self.min_anchors]
+        nearest = nearest[:self.candidates]
+        units = offsets[nearest] / np.maximum(distances[nearest], 1.0)[:, None]
+        if self.dimension != PozyxConstants.DIMENSION_3D:
+            units = units[:, :2]
+
+        best_indices, best_value = tuple(nearest[:self.min_anchors]), np.inf
+        for size in range(self.min_anchors, min(self.max_anchors, len(nearest)) + 1):
+            subsets = np.array(list(combinations(range(len(nearest)), size)))
+            values = gdop(units[subsets])
+            index = int(np.argmin(values))
+            if values[index] < best_value:
+                best_indices, best_value = tuple(nearest[subsets[index]]), float(values[index])
+            if best_value <= self.max_gdop:
+                break
+        return best_indices, best_value
+
+    def cell(self, x, y):
+        column = int(floor((x - self.origin[0]) / self.cell_size))
+        row = int(floor((y - self.origin[1]) / self.cell_size))
+        return min(max(column, 0), self.columns - 1), min(max(row, 0), self.rows - 1)
+
+    def subset(self, x, y):
+        """The anchor ids to use at x, y"""
+        column, row = self.cell(x, y)
+        return self.subsets[column][row]
+
+
+class AnchorSubsets(object):
+    """Keeps the anchor subset of every tag in line with the cell it is in"""
+
+    def __init__(self, pozyx, selector):
+        self.pozyx = pozyx
+        self.selector = selector
+        # tag id to the subset it was last given
+        self.current = {}
+        self.pushes = 0
+
+    def update(self, tag_id, x, y):
+        """Gives the tag the subset of its position when it differs from the one it has"""
+        subset = self.selector.subset(x, y)
+        if self.current.get(tag_id) == subset:
+            return POZYX_SUCCESS
+        status = self.push(tag_id, subset)
+        if status == POZYX_SUCCESS:
+            self.current[tag_id] = subset
+        return status
+
+    def push(self, tag_id, subset):
+        self.pushes += 1
+        status = self.pozyx.setPositioningAnchorIds(list(subset), remote_id=tag_id)
+        status &= self.pozyx.setSelectionOfAnchors(PozyxConstants.ANCHOR_SELECT_MANUAL, len(subset),
+                                                   remote_id=tag_id)
+        return status
+
+    def reset(self, tag_id=None):
+        """Forgets the subset of a tag, or of all tags, after their anchors were configured again"""
+        if tag_id is None:
+            self.current = {}
+        else:
+            self.current.pop(tag_id, None)
+
+
+if __name__ == "__main__":
+    # positions five simulated tags in a hall of 24 by 16 meter with 15 anchors, first with automatic
+    # anchor selection (the tags range with all anchors), then with the subsets of the grid
+    import io
+    from contextlib import redirect_stdout
+
+    from pypozyx import Coordinates, DeviceCoordinates
+
+    from multitag_positioning import MultitagPositioning
+    from simulated_pozyx import LatencyModel, SimulatedNetwork, SimulatedPozyxSerial, circle
+
+    tag_ids = [0x1000, 0x1001, 0x1002, 0x1003, 0x1004]
+    duration = 4
+    anchors = [DeviceCoordinates(0xa000 + 5 * row + column, 1, Coordinates(6000 * column, 8000 * row, 2500 + 300 * (column % 2)))
+               for row in range(3) for column in range(5)]
+
+    start = perf_counter()
+    selector = AnchorSelector(anchors, cell_size=1000, height=1000)
+    build = perf_counter() - start
+    sizes = {}
+    for column in range(selector.columns):
+        for row in range(selector.rows):
+            size = len(selector.subsets[column][row])
+            sizes[size] = sizes.get(size, 0) + 1
+    print("Grid of {}x{} cells built in {:.0f}ms, subsets of {}, median GDOP {:.2f}".format(
+        selector.columns, selector.rows, build * 1000,
+        ", ".join("%i anchors: %i cells" % item for item in sorted(sizes.items())), float(np.median(selector.gdops))))
+
+    def simulate(select):
+        network = SimulatedNetwork(LatencyModel(jitter=0.1, seed=1), position_noise=30, seed=1)
+        for anchor in anchors:
+            network.addAnchor(anchor.network_id, (anchor.pos.x, anchor.pos.y, anchor.pos.z))
+        for index, tag_id in enumerate([0x6000] + tag_ids):
+            network.addTag(tag_id, trajectory=circle((12000, 8000, 1000), 2000 + 1000 * index, 8.0 + index))
+        pozyx = SimulatedPozyxSerial(network, 0x6000)
+        subsets = AnchorSubsets(pozyx, selector) if select else None
+        multitag = MultitagPositioning(pozyx, tag_ids, anchors, [], False, None, 0, anchor_subsets=subsets)
+        fixes = []
+        multitag.printPublishPosition = lambda position, network_id: fixes.append(network_id)
+        with redirect_stdout(io.StringIO()):
+            multitag.setAnchorsManual()
+            start = perf_counter()
+            while perf_counter() - start < duration:
+                multitag.loop()
+        return len(fixes) / duration, subsets
+
+    rate, _ = simulate(False)
+    print("Automatic selection of all {} anchors: {:.1f} positions/s".format(len(anchors), rate))
+    rate, subsets = simulate(True)
+    print("Subsets from the grid: {:.1f} positions/s, {} subsets pushed".format(rate, subsets.pushes))
@@ -8,13 +8,17 @@ from pypozyx import (PozyxConstants, Coordinates, POZYX_SUCCESS, PozyxRegisters,
 
 from pypozyx.tools.version_check import perform_latest_version_check
 
+from anchor_provisioning import AnchorProvisioner
+
 
 class Anchors(object):
 
-    def __init__(self, pozyx, anchors, remote_id=None):
+    def __init__(self, pozyx, anchors, remote_id=None, selector=None):
         self.pozyx = pozyx
         self.anchors = anchors
         self.remote_id = remote_id
+        # an anchor_selection.AnchorSelector picks the anchors for where the device is, instead of the device
+        self.selector = selector
 
     def setup(self):
         print("Device Information")
@@ -58,11 +62,15 @@ class Anchors(object):
             print("ANCHOR 0x%0.4x,%s" % (anchor.network_id, str(anchor.pos)))
 
     def setAnchorsManual(self):
-        status = self.pozyx.configureAnchors(self.anchors)
-        status = self.pozyx.clearDevices(self.remote_id)
-        for anchor in self.anchors:
-            status &= self.pozyx.addDevice(anchor, remote_id=self.remote_id)
-        if len(self.anchors) > 4:
+        # only the anchors the device doesn't hold yet are written, and the list is read back
+        provisioner = AnchorProvisioner(self.anchors, anchor_select=None, save_to_flash=False)
+        status = provisioner.provisionTag(self.pozyx, self.remote_id).status
+        subset = self.selectedAnchors() if len(self.anchors) > 4 else None
+        if subset is not None:
+            status &= self.pozyx.setPositioningAnchorIds(list(subset), remote_id=self.remote_id)
+            status &= self.pozyx.setSelectionOfAnchors(PozyxConstants.ANCHOR_SELECT_MANUAL, len(subset),
+                                                       remote_id=self.remote_id)
+        elif len(self.anchors) > 4:
             status &= self.pozyx.setSelectionOfAnchors(PozyxConstants.ANCHOR_SELECT_AUTO, len(self.anchors),
                                                        remote_id=self.remote_id)
         self.pozyx.saveAnchorIds(remote_id=self.remote_id)
@@ -70,6 +78,18 @@ class Anchors(object):
             [PozyxRegisters.POSITIONING_NUMBER_OF_ANCHORS], remote_id=self.remote_id)
         return status
 
+    def selectedAnchors(self):
+        """The anchor ids the selector picks for the last position of the device, None without one"""
+        if self.selector is None:
+            return None
+        position = Coordinates()
+        if self.pozyx.getCoordinates(position, remote_id=self.remote_id) != POZYX_SUCCESS:
+            return None
+        if position.x == 0 and position.y == 0 and position.z == 0:
+            # never positioned
+            return None
+        return self.selector.subset(position.x, position.y)
+
 
 if __name__ == "__main__":
     # shortcut to not have to find out the port yourself.
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""
+Runs the positioning scripts, their sinks, timers and a control API in one asyncio event loop.
+
+The scripts stay as they are: AsyncCore calls their loop (or get_position) over and over, and
+takes the positions they would print or publish. Every call that talks to a Pozyx runs in the
+serial executor of that Pozyx, a single thread, so scripts sharing a Pozyx take turns on its serial
+port instead of fighting over it, while the event loop stays free for everything else.
+
+Positions go to every sink through a queue of its own, so a slow sink (a broker, a disk) delays and
+drops only its own positions, never the device or the other sinks:
+
+    PrintSink:    prints the positions
+    MqttSink:     publishes them like PositionMqtt, on zwerm3/position
+    OscSink:      sends them as OSC bundles over UDP, with an osc_output.OscOutput
+    StoreSink:    appends them to a position_store.PositionStore, in blocks, off the event loop
+    CallbackSink: calls a function with every position
+
+A position is a tuple of (tag id, timestamp, x, y, z, latency in ms or None), timestamps in seconds
+since the epoch. The control API takes one command per line over TCP and answers with a line of
+JSON: status, pause, resume and stop. stop(), SIGINT and SIGTERM shut everything down cleanly: the
+loops finish the call they are in, the sinks handle what is queued, and the store is flushed.
+"""
+import asyncio
+import json
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, time
+
+from loop_current_position import CurrentPosition
+from multitag_positioning import MultitagPositioning
+from position import Position
+from position_mqtt import PositionMqtt
+
+
+class AsyncPozyx(object):
+    """A Pozyx whose calls run one at a time in a thread of their own, awaitable from the event loop"""
+
+    def __init__(self, pozyx):
+        self.pozyx = pozyx
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="serial")
+
+    async def run(self, function, *args):
+        """Runs function(*args), which uses the Pozyx, in the serial thread"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def __getattr__(self, name):
+        method = getattr(self.pozyx, name)
+
+        async def call(*args, **kwargs):
+            return await self.run(lambda: method(*args, **kwargs))
+        return call
+
+    def close(self):
+        # waits for the call that is running, the serial port is never left halfway a transaction
+        self.executor.shutdown(wait=True)
+
+
+class Sink(object):
+    """Handles positions from a queue of its own, newer positions push out the oldest when it is full"""
+
+    def __init__(self, queue_size=1024):
+        self.queue_size = queue_size
+        self.queue = None
+        self.handled = 0
+        self.dropped = 0
+
+    def put(self, fix):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.queue.task_done()
+            self.dropped += 1
+        self.queue.put_nowait(fix)
+
+    async def consume(self):
+        while True:
+            fixes = [await self.queue.get()]
+            while not self.queue.empty():
+                fixes.append(self.queue.get_nowait())
+            try:
+                await self.handle(fixes)
+                self.handled += len(fixes)
+            except Exception as error:
+                # a sink that fails on some positions must keep handling the next ones
+                print("Error in %s: %s" % (type(self).__name__, error))
+            finally:
+                for _ in fixes:
+                    self.queue.task_done()
+
+    async def handle(self, fixes):
+        """Handles the positions that were queued, oldest first"""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class PrintSink(Sink):
+    async def handle(self, fixes):
+        for tag_id, timestamp, x, y, z, latency in fixes:
+            print("POS ID: {}, x(mm): {}, y(mm): {}, z(mm): {}".format("0x%0.4x" % (tag_id or 0), x, y, z))
+
+
+class CallbackSink(Sink):
+    def __init__(self, callback, queue_size=1024):
+        Sink.__init__(self, queue_size)
+        self.callback = callback
+
+    async def handle(self, fixes):
+        for fix in fixes:
+            result = self.callback(fix)
+            if asyncio.iscoroutine(result):
+                await result
+
+
+class MqttSink(Sink):
+    """Publishes every position as JSON, with the tag id, on prefix/topic"""
+
+    def __init__(self, client, prefix="zwerm3", topic="position", qos=0, queue_size=1024):
+        Sink.__init__(self, queue_size)
+        self.client = client
+        self.topic = "%s/%s" % (prefix, topic)
+        self.qos = qos
+
+    async def handle(self, fixes):
+        for tag_id, timestamp, x, y, z, latency in fixes:
+            # paho only queues the message, its own network loop sends it
+            self.client.publish(self.topic, json.dumps({"tag": tag_id, "x": x, "y": y, "z": z, "lat": latency}),
+                                qos=self.qos)
+
+
+class OscSink(Sink):
+    """Sends the positions that were queued together, as one frame of OSC bundles"""
+
+    def __init__(self, output, queue_size=1024):
+        Sink.__init__(self, queue_size)
+        self.output = output
+
+    async def handle(self, fixes):
+        for tag_id, timestamp, x, y, z, latency in fixes:
+            self.output.update(tag_id, x, y, z)
+        # the socket doesn't block, no need for an executor
+        self.output.send()
+
+    async def close(self):
+        self.output.close()
+
+
+class StoreSink(Sink):
+    """Appends the positions to a PositionStore in a thread, as writing a chunk blocks"""
+
+    def __init__(self, store, queue_size=65536):
+        Sink.__init__(self, queue_size)
+        self.store = store
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="store")
+
+    async def handle(self, fixes):
+        columns = list(zip(*[(tag_id or 0, timestamp, x, y, z, latency or 0.0)
+                             for tag_id, timestamp, x, y, z, latency in fixes]))
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.store.extend, *columns)
+
+    async def close(self):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.store.flush)
+        self.executor.shutdown(wait=True)
+
+
+class ScriptLoop(object):
+    """Calls the loop of a script in the serial thread of its Pozyx, and passes on its positions"""
+
+    def __init__(self, script, serial, emit):
+        self.script = script
+        self.serial = serial
+        self.name = type(script).__name__
+        self.step = script.get_position if isinstance(script, CurrentPosition) else script.loop
+        self.calls = 0
+        self.fixes = 0
+        self.paused = asyncio.Event()
+        self.paused.set()
+        self.capture(emit)
+
+    def capture(self, emit):
+        """Replaces the method that prints or publishes the positions of the script"""
+        script = self.script
+
+        def fix(tag_id, position, latency):
+            self.fixes += 1
+            emit((tag_id, time(), position.x, position.y, position.z, latency))
+
+        if isinstance(script, MultitagPositioning):
+            script.printPublishPosition = lambda position, network_id: fix(network_id, position, None)
+        elif isinstance(script, PositionMqtt):
+            script.publishPosition = lambda position, latency: fix(script.remote_id or script.network_id,
+                                                                   position, latency)
+        elif isinstance(script, Position):
+            script.printPublishPosition = lambda position, latency: fix(script.remote_id or script.network_id,
+                                                                        position, latency)
+        elif isinstance(script, CurrentPosition):
+            script.printPublishPosition = lambda position, latency: fix(None, position, latency)
+        else:
+            raise ValueError("Don't know how to take the positions of %s" % self.name)
+
+    async def run(self):
+        while True:
+            await self.paused.wait()
+            await self.serial.run(self.step)
+            self.calls += 1
+
+
+class AsyncCore(object):
+    """The scripts, sinks, timers and control API of one process, in one event loop"""
+
+    def __init__(self, drain_timeout=2.0):
+        """
+        Args:
+            drain_timeout (optional): seconds the sinks get to handle what is queued when stopping.
+        """
+        self.drain_timeout = drain_timeout
+        self.serials = {}
+        self.loops = []
+        self.sinks = []
+        self.timers = []
+        self.control_port = None
+        self.server = None
+        self.event_loop = None
+        self.stopping = None
+        self.started = None
+        self.fixes = 0
+
+    def serial(self, pozyx):
+        """The AsyncPozyx of a Pozyx, one per Pozyx however many scripts use it"""
+        if id(pozyx) not in self.serials:
+            self.serials[id(pozyx)] = AsyncPozyx(pozyx)
+        return self.serials[id(pozyx)]
+
+    def addScript(self, script):
+        """Runs a Position, PositionMqtt, MultitagPositioning or CurrentPosition"""
+        loop = ScriptLoop(script, self.serial(script.pozyx), self.emit)
+        self.loops.append(loop)
+        return loop
+
+    def addSink(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def every(self, interval, function):
+        """Calls function, or awaits it when it is a coroutine function, every interval seconds"""
+        self.timers.append((interval, function))
+
+    def serve(self, port=9109):
+        """Serves the control API on port once running"""
+        self.control_port = port
+
+    def emit(self, fix):
+        # called from a serial thread
+        self.event_loop.call_soon_threadsafe(self.distribute, fix)
+
+    def distribute(self, fix):
+        self.fixes += 1
+        for sink in self.sinks:
+            sink.put(fix)
+
+    async def timer(self, interval, function):
+        while True:
+            await asyncio.sleep(interval)
+            result = function()
+            if asyncio.iscoroutine(result):
+                await result
+
+    async def handleControl(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode().strip()
+                if command == "status":
+                    answer = self.status()
+                elif command in ("pause", "resume"):
+                    for loop in self.loops:
+                        (loop.paused.clear if command == "pause" else loop.paused.set)()
+                    answer = {"result": command + "d"}
+                elif command == "stop":
+                    self.stop()
+                    answer = {"result": "stopping"}
+                else:
+                    answer = {"error": "unknown command %s" % command}
+                writer.write((json.dumps(answer) + "\n").encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+    def status(self):
+        elapsed = perf_counter() - self.started if self.started else 0.0
+        return {
+            "uptime": round(elapsed, 3),
+            "fixes": self.fixes,
+            "loops": [{"script": loop.name, "calls": loop.calls, "fixes": loop.fixes,
+                       "paused": not loop.paused.is_set()} for loop in self.loops],
+            "sinks": [{"sink": type(sink).__name__, "handled": sink.handled, "queued": sink.queue.qsize(),
+                       "dropped": sink.dropped} for sink in self.sinks],
+        }
+
+    def stop(self):
+        if self.stopping is not None:
+            self.stopping.set()
+
+    async def run(self, duration=None):
+        """Runs until stop() is called, a signal arrives or duration seconds have passed"""
+        self.event_loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.started = perf_counter()
+        for name in ("SIGINT", "SIGTERM"):
+            try:
+                self.event_loop.add_signal_handler(getattr(signal, name), self.stop)
+            except (NotImplementedError, AttributeError, RuntimeError):
+                # not on Windows, or not in the main thread
+                pass
+
+        for sink in self.sinks:
+            sink.queue = asyncio.Queue(sink.queue_size)
+        consumers = [asyncio.ensure_future(sink.consume()) for sink in self.sinks]
+        producers = [asyncio.ensure_future(loop.run()) for loop in self.loops]
+        producers += [asyncio.ensure_future(self.timer(interval, function)) for interval, function in self.timers]
+        if self.control_port is not None:
+            self.server = await asyncio.start_server(self.handleControl, "localhost", self.control_port)
+
+        try:
+            if duration is None:
+                await self.stopping.wait()
+            else:
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), duration)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self.shutdown(producers, consumers)
+
+    async def shutdown(self, producers, consumers):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for task in producers:
+            task.cancel()
+        await asyncio.gather(*producers, return_exceptions=True)
+        # the calls still running in the serial threads finish, and their positions are delivered
+        for serial in self.serials.values():
+            await self.event_loop.run_in_executor(None, serial.close)
+        await asyncio.sleep(0)
+        try:
+            await asyncio.wait_for(asyncio.gather(*[sink.queue.join() for sink in self.sinks]), self.drain_timeout)
+        except asyncio.TimeoutError:
+            print("Stopped with positions still queued")
+        for task in consumers:
+            task.cancel()
+        await asyncio.gather(*consumers, return_exceptions=True)
+        for sink in self.sinks:
+            await sink.close()
+
+
+if __name__ == "__main__":
+    # the local tag in ranging mode and two remote tags share one simulated Pozyx, their positions go to
+    # an MQTT client, a position store, a local OSC listener and a sink that takes 20ms per batch, while a client pauses and
+    # resumes the loops over the control API
+    import io
+    import os
+    import socket
+    import tempfile
+    from contextlib import redirect_stdout
+
+    from benchmark import ANCHORS, NullMqttClient, create_network
+    from osc_output import OscOutput, decode_packet
+    from position_store import PositionStore
+    from range_fusion import RangeFusion
+    from simulated_pozyx import LatencyModel
+
+    tag_ids = [0x1000, 0x1001]
+    duration = 3
+    port = 9109
+
+    pozyx = create_network(tag_ids, LatencyModel(jitter=0.1, seed=1), seed=1)
+    core = AsyncCore()
+    core.addScript(Position(pozyx, height=2500, range_fusion=RangeFusion(ANCHORS)))
+    core.addScript(MultitagPositioning(pozyx, tag_ids, ANCHORS, [], False, None, 0))
+
+    client = NullMqttClient()
+    store = PositionStore(os.path.join(tempfile.mkdtemp(), "history"))
+    core.addSink(MqttSink(client))
+    core.addSink(StoreSink(store))
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.setblocking(False)
+    core.addSink(OscSink(OscOutput([listener.getsockname()])))
+
+    async def slow(fix):
+        await asyncio.sleep(0.02)
+    slow_sink = core.addSink(CallbackSink(slow, queue_size=16))
+    ticks = []
+    core.every(0.5, lambda: ticks.append(core.fixes))
+    core.serve(port)
+
+    async def control():
+        await asyncio.sleep(1.0)
+        reader, writer = await asyncio.open_connection("localhost", port)
+        answers = []
+        for command in ["pause", "status", "resume"]:
+            writer.write((command + "\n").encode())
+            answers.append(json.loads(await reader.readline()))
+            await asyncio.sleep(0.5)
+        writer.close()
+        return answers
+
+    async def main():
+        task = asyncio.ensure_future(control())
+        await core.run(duration)
+        return await task
+
+    with redirect_stdout(io.StringIO()):
+        answers = asyncio.run(main())
+    osc_messages = 0
+    try:
+        while True:
+            osc_messages += len(decode_packet(listener.recv(65536)))
+    except BlockingIOError:
+        listener.close()
+    print("Status while paused:", json.dumps(answers[1]["loops"]))
+    print("{} positions in {}s, {} published, {} stored, {} OSC messages received, the slow sink handled {} and dropped {}".format(
+        core.fixes, duration, client.published, len(store), osc_messages, slow_sink.handled, slow_sink.dropped))
+    print("Positions every 0.5s:", ticks)
@@ -10,6 +10,13 @@ from pypozyx import (PozyxSerial, Data, AlgorithmData, get_first_pozyx_serial_po
 from pypozyx.structures.device_information import DeviceDetails
 from pypozyx.definitions.registers import POZYX_WHO_AM_I
 
+from register_snapshot import RegisterSnapshot
+
+
+# names of the registers in PozyxRegisters.ALL_POSITIONING_REGISTERS and ALL_UWB_REGISTERS
+POSITIONING_REGISTER_NAMES = ["Filter", "Algorithm & Dimension", "Ranging protocol", "Height"]
+UWB_REGISTER_NAMES = ["Channel", "Bitrate & PRF", "Preamble length", "Gain"]
+
 
 def readable_sensor_mode(number):
     modes = [
@@ -30,31 +37,34 @@ def readable_sensor_mode(number):
     return modes[number]
 
 
+def saved_flags(saved_registers, registers, names):
+    """Whether each of the registers is saved, from the flash details of getSavedRegisters"""
+    return {name: bool(saved_registers[register // 8] >> (register % 8) & 0x1)
+            for register, name in zip(registers, names)}
+
+
 def device_check(pozyx, remote_id=None):
-    system_details = DeviceDetails()
-    pozyx.getDeviceDetails(system_details, remote_id=remote_id)
+    record = device_record(pozyx, remote_id)
+    if record["status"] != "ok":
+        print("")
+        print("Device %s is unreachable" % ("0x%0.4x" % remote_id if remote_id is not None else "local"))
+        return
 
     # General Information
     print("")
     print("General Information")
     print("-----------------------------------")
     print("")
-    print("\tLocal %s with id 0x%0.4x" %
-          (system_details.device_name, system_details.id))
+    print("\tLocal %s with id %s" % (record["device_name"], record["device_id"]))
     print("\t-----------------------------------")
     print("")
-    print("\tWho am i: 0x%0.2x" % system_details.who_am_i)
-    print("\tFirmware version: v%s" % system_details.firmware_version_string)
-    print("\tHardware version: v%s" % system_details.hardware_version_string)
-    print("\tSelftest result: %s" % system_details.selftest_string)
-    print("\tError: 0x%0.2x" % system_details.error_code)
-    print("\tError message: %s" % system_details.error_message)
-    operation_mode = SingleRegister()
-    pozyx.getOperationMode(operation_mode)
-    if operation_mode == PozyxConstants.TAG_MODE:
-        print("\tDevice Type: Tag")
-    else:
-        print("\tDevice Type: Anchor")
+    print("\tWho am i: %s" % record["who_am_i"])
+    print("\tFirmware version: v%s" % record["firmware_version"])
+    print("\tHardware version: v%s" % record["hardware_version"])
+    print("\tSelftest result: %s" % record["selftest"])
+    print("\tError: 0x%0.2x" % record["error_code"])
+    print("\tError message: %s" % record["error_message"])
+    print("\tDevice Type: %s" % record["device_type"].capitalize())
     print("")
 
     # Positioning Settings
@@ -68,52 +78,38 @@ def device_check(pozyx, remote_id=None):
     # UWB Settings
     print("\tUWB settings")
     print("\t-----------------------------------")
-    uwb_settings = UWBSettings()
-    pozyx.getUWBSettings(uwb_settings, remote_id=remote_id)
-    print("\t%s" % uwb_settings)
+    print("\tCH: {}, bitrate: {}, prf: {}, plen: {}, gain: {} dB".format(
+        record["uwb_channel"], record["uwb_bitrate"], record["uwb_prf"], record["uwb_plen"], record["uwb_gain_db"]))
     print("")
 
     # Filter
     print("\tFilter")
     print("\t-----------------------------------")
-    filter_data = FilterData()
-    pozyx.getPositionFilterData(filter_data)
-    print("\t%s" % filter_data)
+    print("\t{} with strength {}".format(record["filter"], record["filter_strength"]))
     print("")
 
     # Positioning Algorithm
     print("\tAlgorithm")
     print("\t-----------------------------------")
-    algorithm_data = AlgorithmData()
-    pozyx.getPositioningAlgorithmData(algorithm_data)
-    print("\t%s" % algorithm_data)
+    print("\tAlgorithm {}, dimension {}".format(record["algorithm"], record["dimension"]))
     print("")
 
     # Update Interval
     print("\tUpdate Interval")
     print("\t-----------------------------------")
-    update_interval = Data([0])
-    pozyx.getUpdateInterval(update_interval)
-    print("\t%sms" % update_interval)
+    print("\t%sms" % record["update_interval_ms"])
     print("")
 
     # Update Interval
     print("\tRanging Protocol")
     print("\t-----------------------------------")
-    ranging_protocol = SingleRegister()
-    pozyx.getRangingProtocol(ranging_protocol)
-    if ranging_protocol == PozyxConstants.RANGE_PROTOCOL_PRECISION:
-        print("\tPrecision")
-    if ranging_protocol == PozyxConstants.RANGE_PROTOCOL_FAST:
-        print("\tFast")
+    print("\t%s" % record["ranging_protocol"].capitalize())
     print("")
 
     # Sensors Mode
     print("\tSensors Mode")
     print("\t-----------------------------------")
-    sensors_mode = SingleRegister()
-    pozyx.getSensorMode(sensors_mode)
-    print("\t%s" % readable_sensor_mode(int(str(sensors_mode), 16)))
+    print("\t%s" % record["sensor_mode"])
     print("")
 
     # Anchor Settings
@@ -124,47 +120,32 @@ def device_check(pozyx, remote_id=None):
     # Anchor Selection Mode
     print("\tAnchor Selection Mode")
     print("\t-----------------------------------")
-    anchor_selection_mode = SingleRegister()
-    pozyx.getAnchorSelectionMode(anchor_selection_mode)
-    if anchor_selection_mode == PozyxConstants.ANCHOR_SELECT_MANUAL:
+    if record["anchor_selection"] == "manual":
         print("\tFixed anchors: the anchor network IDs that have been supplied by POZYX_POS_SET_ANCHOR_IDS are used for positioning.")
-    if anchor_selection_mode == PozyxConstants.ANCHOR_SELECT_AUTO:
+    else:
         print("\tAutomatic anchor selection: Anchors from the internal anchor list are used to make the selection.")
     print("")
 
     # Get number of anchors
     print("\tAnchors")
     print("\t-----------------------------------")
-    number_of_anchors = SingleRegister()
-    pozyx.getNumberOfAnchors(number_of_anchors)
-    anchor_list = DeviceList(list_size=number_of_anchors[0])
-    pozyx.getPositioningAnchorIds(anchor_list)
-    print("\tThere are {} anchors in my list.".format(
-        int(str(number_of_anchors), 16)))
-    print("\t%s" % anchor_list)
+    print("\tThere are {} anchors in my list.".format(record["number_of_anchors"]))
+    print("\tIDs: %s" % ", ".join(record["anchors"]))
     print("")
 
     # Registers
-    print("THERE ARE %s SAVED REGISTERS" %
-          pozyx.getNumRegistersSaved(remote_id=remote_id))
+    print("THERE ARE %s SAVED REGISTERS" % record["saved_registers"])
     print("-----------------------------------")
     print("")
-    saved_registers = pozyx.getSavedRegisters(remote_id=remote_id)
-    if saved_registers:
+    if record["saved_registers"] is not None:
         print("\tFilled in positioning registers: ")
         print("\t-----------------------------------")
-        for register, register_name in zip(PozyxRegisters.ALL_POSITIONING_REGISTERS, ["Filter", "Algorithm & Dimension", "Ranging protocol", "Height"]):
-            byte_num = int(register / 8)
-            bit_num = register % 8
-            register_saved = bool(saved_registers[byte_num] >> bit_num & 0x1)
+        for register_name, register_saved in record["saved_positioning_registers"].items():
             print("\t{}: {}".format(register_name, register_saved))
         print("")
         print("\tFilled in UWB registers: ")
         print("\t-----------------------------------")
-        for register, register_name in zip(PozyxRegisters.ALL_UWB_REGISTERS, ["Channel", "Bitrate & PRF", "Preamble length", "Gain"]):
-            byte_num = int(register / 8)
-            bit_num = register % 8
-            register_saved = bool(saved_registers[byte_num] >> bit_num & 0x1)
+        for register_name, register_saved in record["saved_uwb_registers"].items():
             print("\t{}: {}".format(register_name, register_saved))
         print("")
     else:
@@ -180,6 +161,83 @@ def device_check(pozyx, remote_id=None):
         print("")
 
 
+def device_record(pozyx, remote_id=None):
+    """The settings device_check prints, as a dictionary, without clearing or discovering devices"""
+    # serve the many register reads below from a few bulk reads
+    if not isinstance(pozyx, RegisterSnapshot):
+        pozyx = RegisterSnapshot(pozyx)
+
+    record = {"network_id": remote_id, "status": "ok"}
+    system_details = DeviceDetails(remote_id)
+    if pozyx.getDeviceDetails(system_details, remote_id=remote_id) != POZYX_SUCCESS:
+        record["status"] = "unreachable"
+        return record
+    operation_mode = SingleRegister()
+    pozyx.getOperationMode(operation_mode, remote_id=remote_id)
+    record.update({
+        "device_type": "tag" if operation_mode == PozyxConstants.TAG_MODE else "anchor",
+        "device_name": system_details.device_name,
+        "device_id": "0x%0.4x" % system_details.id,
+        "who_am_i": "0x%0.2x" % system_details.who_am_i,
+        "firmware_version": system_details.firmware_version_string,
+        "hardware_version": system_details.hardware_version_string,
+        "selftest": system_details.selftest_string,
+        "error_code": system_details.error_code,
+        "error_message": system_details.error_message,
+    })
+
+    uwb_settings = UWBSettings()
+    pozyx.getUWBSettings(uwb_settings, remote_id=remote_id)
+    filter_data = FilterData()
+    pozyx.getPositionFilterData(filter_data, remote_id=remote_id)
+    algorithm_data = AlgorithmData()
+    pozyx.getPositioningAlgorithmData(algorithm_data, remote_id=remote_id)
+    update_interval = Data([0], 'H')
+    pozyx.getUpdateInterval(update_interval, remote_id=remote_id)
+    ranging_protocol = SingleRegister()
+    pozyx.getRangingProtocol(ranging_protocol, remote_id=remote_id)
+    sensors_mode = SingleRegister()
+    pozyx.getSensorMode(sensors_mode, remote_id=remote_id)
+    anchor_selection_mode = SingleRegister()
+    pozyx.getAnchorSelectionMode(anchor_selection_mode, remote_id=remote_id)
+    number_of_anchors = SingleRegister()
+    pozyx.getNumberOfAnchors(number_of_anchors, remote_id=remote_id)
+    anchors = []
+    if number_of_anchors[0] > 0:
+        anchor_list = DeviceList(list_size=number_of_anchors[0])
+        if pozyx.getPositioningAnchorIds(anchor_list, remote_id=remote_id) == POZYX_SUCCESS:
+            anchors = ["0x%0.4x" % anchor_id for anchor_id in anchor_list]
+    saved_registers = pozyx.getSavedRegisters(remote_id=remote_id)
+
+    record.update({
+        "uwb_channel": uwb_settings.channel,
+        "uwb_bitrate": uwb_settings.parse_bitrate(),
+        "uwb_prf": uwb_settings.parse_prf(),
+        "uwb_plen": uwb_settings.parse_plen(),
+        "uwb_gain_db": uwb_settings.gain_db,
+        "filter": filter_data.get_filter_name(),
+        "filter_strength": filter_data.filter_strength,
+        "algorithm": algorithm_data.get_algorithm_name(),
+        "dimension": algorithm_data.get_dimension_name(),
+        "update_interval_ms": update_interval[0],
+        "ranging_protocol": "precision" if ranging_protocol == PozyxConstants.RANGE_PROTOCOL_PRECISION else "fast",
+        "sensor_mode": readable_sensor_mode(sensors_mode[0]),
+        "anchor_selection": "manual" if anchor_selection_mode == PozyxConstants.ANCHOR_SELECT_MANUAL else "automatic",
+        "number_of_anchors": number_of_anchors[0],
+        "anchors": anchors,
+        "saved_registers": None,
+    })
+    if saved_registers:
+        # what getNumRegistersSaved counts, from the same flash details
+        record.update({
+            "saved_registers": sum(bin(byte).count("1") for byte in saved_registers),
+            "saved_positioning_registers": saved_flags(saved_registers, PozyxRegisters.ALL_POSITIONING_REGISTERS,
+                                                       POSITIONING_REGISTER_NAMES),
+            "saved_uwb_registers": saved_flags(saved_registers, PozyxRegisters.ALL_UWB_REGISTERS, UWB_REGISTER_NAMES),
+        })
+    return record
+
+
 if __name__ == '__main__':
     serial_port = get_first_pozyx_serial_port()
     if serial_port is None:
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the positioning scripts on a simulated Pozyx network.
+Runs Position.loop and PositionMqtt.loop (also in their ranging mode), MultitagPositioning.loop, HostPositioning.loop and
+CurrentPosition.get_position for a while and prints the positions per second and the latency percentiles of each.
+"""
+import io
+from contextlib import redirect_stdout
+from time import perf_counter, process_time
+
+from pypozyx import Coordinates, DeviceCoordinates
+
+from simulated_pozyx import LatencyModel, SimulatedNetwork, SimulatedPozyxSerial, circle
+from position import Position
+from position_mqtt import PositionMqtt
+from multitag_positioning import MultitagPositioning
+from multilateration import HostPositioning
+from range_fusion import RangeFusion
+from loop_current_position import CurrentPosition
+
+
+LOCAL_ID = 0x6000
+
+ANCHORS = [DeviceCoordinates(0xa000, 1, Coordinates(0, 0, 2500)),
+           DeviceCoordinates(0x6968, 1, Coordinates(0, 3100, 2500)),
+           DeviceCoordinates(0x6945, 1, Coordinates(1900, 0, 2500)),
+           DeviceCoordinates(0x696b, 1, Coordinates(1900, 3100, 2500))]
+
+
+class NullMqttClient(object):
+    """Takes the place of the paho client, so no broker is needed"""
+
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+
+
+class Benchmark(object):
+    """Collects the moment of every position a script reports"""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.end = None
+        self.cpu = 0
+        self.requests = 0
+        self.fixes = 0
+        self.latencies = []
+        self.last_fix = {}
+
+    def record(self, tag_id=None):
+        now = perf_counter()
+        self.fixes += 1
+        self.latencies.append(now - self.last_fix.get(tag_id, self.start))
+        self.last_fix[tag_id] = now
+
+    def count(self, target, method_name, tag_argument=None):
+        """Records a position every time target.method_name is called"""
+        method = getattr(target, method_name)
+
+        def counted(*args):
+            self.record(args[tag_argument] if tag_argument is not None else None)
+            return method(*args)
+        setattr(target, method_name, counted)
+
+    def run(self, step, duration, pozyx):
+        # the scripts print every position, which would drown the results
+        with redirect_stdout(io.StringIO()):
+            requests = pozyx.ser.requests
+            cpu = process_time()
+            self.start = perf_counter()
+            while perf_counter() - self.start < duration:
+                step()
+            self.end = perf_counter()
+            self.cpu = process_time() - cpu
+            self.requests = pozyx.ser.requests - requests
+
+    def percentile(self, fraction):
+        if not self.latencies:
+            return float('nan')
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def rate(self):
+        return self.fixes / (self.end - self.start)
+
+    def printResult(self):
+        print("BENCH {}: {:.1f}Hz, p50: {:.1f}ms, p95: {:.1f}ms, p99: {:.1f}ms, fixes: {}, cpu: {:.0f}%, "
+              "serial requests per fix: {:.1f}".format(
+                  self.name, self.rate(), self.percentile(0.5) * 1000, self.percentile(0.95) * 1000,
+                  self.percentile(0.99) * 1000, self.fixes, 100 * self.cpu / (self.end - self.start),
+                  self.requests / max(self.fixes, 1)))
+
+
+def create_network(tag_ids, latency, seed=None, position_noise=0.0):
+    """A network with the anchors of the scripts and tags going round in circles"""
+    network = SimulatedNetwork(latency, position_noise=position_noise, seed=seed)
+    for anchor in ANCHORS:
+        network.addAnchor(anchor.network_id, (anchor.pos.x, anchor.pos.y, anchor.pos.z))
+    for index, tag_id in enumerate([LOCAL_ID] + tag_ids):
+        network.addTag(tag_id, trajectory=circle((950, 1550, 1000), 300 + 50 * index, 5.0 + index))
+    pozyx = SimulatedPozyxSerial(network, LOCAL_ID)
+    for tag_id in [None] + tag_ids:
+        pozyx.configureAnchors(ANCHORS, remote_id=tag_id)
+    return pozyx
+
+
+def benchmark_position(latency, duration, seed, ranging=False):
+    pozyx = create_network([], latency, seed)
+    position = Position(pozyx, height=2500, range_fusion=RangeFusion(ANCHORS) if ranging else None)
+    benchmark = Benchmark("Position.loop" + (" (ranging)" if ranging else ""))
+    benchmark.count(position, "printPublishPosition")
+    benchmark.run(position.loop, duration, pozyx)
+    return benchmark
+
+
+def benchmark_position_mqtt(latency, duration, seed, ranging=False):
+    pozyx = create_network([], latency, seed)
+    position = PositionMqtt("localhost", 1883, pozyx, height=2500, client=NullMqttClient(),
+                            range_fusion=RangeFusion(ANCHORS) if ranging else None)
+    benchmark = Benchmark("PositionMqtt.loop" + (" (ranging)" if ranging else ""))
+    benchmark.count(position, "publishPosition")
+    benchmark.run(position.loop, duration, pozyx)
+    return benchmark
+
+
+def benchmark_multitag(latency, duration, seed, tag_ids, scheduled=False):
+    pozyx = create_network(tag_ids, latency, seed)
+    multitag = MultitagPositioning(pozyx, tag_ids, ANCHORS, [], False, None, 0, scheduled=scheduled)
+    benchmark = Benchmark("MultitagPositioning.loop" + (" (scheduled)" if scheduled else ""))
+    benchmark.count(multitag, "printPublishPosition", tag_argument=1)
+    benchmark.run(multitag.loop, duration, pozyx)
+    return benchmark
+
+
+def benchmark_host_positioning(latency, duration, seed, tag_ids):
+    pozyx = create_network(tag_ids, latency, seed)
+    host = HostPositioning(pozyx, tag_ids, ANCHORS)
+    benchmark = Benchmark("HostPositioning.loop")
+    benchmark.count(host, "printPublishPosition", tag_argument=1)
+    benchmark.run(host.loop, duration, pozyx)
+    return benchmark
+
+
+def benchmark_current_position(latency, duration, seed, interval, event_driven=False):
+    pozyx = create_network([], latency, seed)
+    # the tag positions on its own, CurrentPosition only reads the result
+    pozyx.setUpdateInterval(interval)
+    current_position = CurrentPosition(pozyx, event_driven)
+    if event_driven:
+        current_position.readInterval()
+    benchmark = Benchmark("CurrentPosition.get_position" + (" (event driven)" if event_driven else ""))
+    benchmark.count(current_position, "printPublishPosition")
+    benchmark.run(current_position.get_position, duration, pozyx)
+    return benchmark
+
+
+if __name__ == "__main__":
+    # seconds every script runs
+    duration = 3
+
+    # makes the timings and the measurement noise of a run reproducible
+    seed = 1
+
+    # remote tags for MultitagPositioning
+    tag_ids = [0x1000, 0x1001, 0x1002, 0x1003, 0x1004]
+
+    # update interval of the tag read by CurrentPosition in ms
+    interval = 200
+
+    # timings in seconds: a serial exchange, ranging with one anchor and a remote hop
+    latency = LatencyModel(serial_round_trip=0.001, ranging_time=0.006, hop_time=0.002, jitter=0.1, seed=seed)
+
+    benchmarks = [benchmark_position(latency, duration, seed),
+                  benchmark_position(latency, duration, seed, ranging=True),
+                  benchmark_position_mqtt(latency, duration, seed),
+                  benchmark_position_mqtt(latency, duration, seed, ranging=True),
+                  benchmark_multitag(latency, duration, seed, tag_ids),
+                  benchmark_multitag(latency, duration, seed, tag_ids, scheduled=True),
+                  benchmark_host_positioning(latency, duration, seed, tag_ids),
+                  benchmark_current_position(latency, duration, seed, interval),
+                  benchmark_current_position(latency, duration, seed, interval, event_driven=True)]
+    for benchmark in benchmarks:
+        benchmark.printResult()
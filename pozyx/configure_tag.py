@@ -8,13 +8,17 @@ from pypozyx import (AlgorithmData, Data, PozyxSerial, FilterData,
                      DeviceCoordinates, UWBSettings, PozyxRegisters)
 from pypozyx.structures.generic import dataCheck
 
+from anchor_provisioning import AnchorProvisioner
+from fleet_config import FleetConfigurator, TagConfiguration
+from register_snapshot import RegisterSnapshot
+
 
 class ConfigureTag:
     def __init__(self, tags, pozyx, uwb_settings, filter,
                  filter_strength, positioning_algorithm,
                  dimension, update_interval, anchor_selection_mode,
                  ranging_protocol, sensor_mode, anchor_list,
-                 save_to_flash=True):
+                 save_to_flash=True, only_changes=True):
         """"""
         self.pozyx = pozyx
         self.tags = tags
@@ -35,10 +39,15 @@ class ConfigureTag:
         self.anchor_list = anchor_list
         self.save_to_flash = save_to_flash
 
+        # only write the registers that differ from what the tags hold, see fleet_config.py
+        self.only_changes = only_changes
+
         # do configuration
         self.configure()
 
     def configure(self):
+        if self.only_changes:
+            return self.configure_changes()
         # print("")
         # print("Old Configuration")
         # print("-----------------------------------")
@@ -66,10 +75,22 @@ class ConfigureTag:
         # self.printConfiguration()
         # print("")
 
+    def configure_changes(self):
+        configuration = TagConfiguration(self.uwb_settings, self.filter, self.filter_strength,
+                                         self.positioning_algorithm, self.dimension, self.update_interval,
+                                         self.anchor_selection_mode, self.number_of_anchors,
+                                         self.ranging_protocol, self.sensor_mode, self.anchor_list)
+        configurator = FleetConfigurator(configuration, self.save_to_flash)
+        print("")
+        reports = configurator.apply([(self.pozyx, self.tags)])
+        configurator.printReport(reports)
+        print("")
+        return reports
+
     # Number of anchors
     def get_number_of_anchors(self):
         number_of_anchors = SingleRegister()
-        pozyx.getNumberOfAnchors(number_of_anchors)
+        self.pozyx.getNumberOfAnchors(number_of_anchors)
         return number_of_anchors[0]
 
     # UWB Settings
@@ -112,19 +133,18 @@ class ConfigureTag:
 
     # Sets the anchors
     def set_anchors(self, remote_id=None):
-        self.pozyx.clearDevices(remote_id)
-        for anchor in self.anchor_list:
-            if not dataCheck(anchor):
-                anchor = DeviceCoordinates(
-                    anchor[0], anchor[1], Coordinates(anchor[2], anchor[3], anchor[4]))
-            self.pozyx.addDevice(anchor, remote_id)
+        # writes only the anchors the tag lacks and reads the list back, see anchor_provisioning.py
+        provisioner = AnchorProvisioner(self.anchor_list, anchor_select=None, save_to_flash=False)
+        report = provisioner.provisionTag(self.pozyx, remote_id)
+        if not report.verified:
+            print("Device list of %s doesn't match the anchors" % ("local tag" if remote_id is None else hex(remote_id)))
         if len(self.anchor_list) < 3 or len(self.anchor_list) > 16:
             print("Not enough anchors to do positioning")
 
     # Saving
 
     def save_registers(self, remote_id=None):
-        registers = PozyxRegisters.ALL_UWB_REGISTERS
+        registers = list(PozyxRegisters.ALL_UWB_REGISTERS)
         registers.append(PozyxRegisters.POSITIONING_FILTER)
         registers.append(PozyxRegisters.POSITIONING_ALGORITHM)
         registers.append(PozyxRegisters.POSITIONING_INTERVAL)
@@ -136,35 +156,42 @@ class ConfigureTag:
     # Printing information
 
     def printConfiguration(self):
-        self.printUwbSettings()
-        self.printFilterSettings()
-        self.printAlgorithmSettings()
-        self.printUpdateInterval()
-        self.printAnchorSelectionMode()
-        self.printRangingProtocol()
-        self.printSensorMode()
-
-    def printUwbSettings(self):
+        # all settings come from the same few bulk reads
+        pozyx = RegisterSnapshot(self.pozyx)
+        self.printUwbSettings(pozyx)
+        self.printFilterSettings(pozyx)
+        self.printAlgorithmSettings(pozyx)
+        self.printUpdateInterval(pozyx)
+        self.printAnchorSelectionMode(pozyx)
+        self.printRangingProtocol(pozyx)
+        self.printSensorMode(pozyx)
+
+    def printUwbSettings(self, pozyx=None):
+        pozyx = self.pozyx if pozyx is None else pozyx
         uwb_settings = UWBSettings()
         pozyx.getUWBSettings(uwb_settings)
         print("- UWB settings: %s" % uwb_settings)
 
-    def printFilterSettings(self):
+    def printFilterSettings(self, pozyx=None):
+        pozyx = self.pozyx if pozyx is None else pozyx
         filter_data = FilterData()
-        self.pozyx.getPositionFilterData(filter_data)
+        pozyx.getPositionFilterData(filter_data)
         print("- FILTER: %s" % filter_data)
 
-    def printAlgorithmSettings(self):
+    def printAlgorithmSettings(self, pozyx=None):
+        pozyx = self.pozyx if pozyx is None else pozyx
         algorithm_data = AlgorithmData()
         pozyx.getPositioningAlgorithmData(algorithm_data)
         print("- ALGORITHM: %s" % algorithm_data)
 
-    def printUpdateInterval(self):
+    def printUpdateInterval(self, pozyx=None):
+        pozyx = self.pozyx if pozyx is None else pozyx
         update_interval = Data([0])
         pozyx.getUpdateInterval(update_interval)
         print("- UPDATE INTERVAL: %sms" % update_interval)
 
-    def printAnchorSelectionMode(self):
+    def printAnchorSelectionMode(self, pozyx=None):
+        pozyx = self.pozyx if pozyx is None else pozyx
         anchor_selection_mode = SingleRegister()
         pozyx.getAnchorSelectionMode(anchor_selection_mode)
         if anchor_selection_mode == PozyxConstants.ANCHOR_SELECT_MANUAL:
@@ -172,7 +199,8 @@ class ConfigureTag:
         if anchor_selection_mode == PozyxConstants.ANCHOR_SELECT_AUTO:
             print("- ANCHOR SELECTION MODE: Automatic")
 
-    def printRangingProtocol(self):
+    def printRangingProtocol(self, pozyx=None):
+        pozyx = self.pozyx if pozyx is None else pozyx
         ranging_protocol = SingleRegister()
         pozyx.getRangingProtocol(ranging_protocol)
         if ranging_protocol == PozyxConstants.RANGE_PROTOCOL_PRECISION:
@@ -180,7 +208,8 @@ class ConfigureTag:
         if ranging_protocol == PozyxConstants.RANGE_PROTOCOL_FAST:
             print("- RANGING PROTOCOL: Fast")
 
-    def printSensorMode(self):
+    def printSensorMode(self, pozyx=None):
+        pozyx = self.pozyx if pozyx is None else pozyx
         sensors_mode = SingleRegister()
         pozyx.getSensorMode(sensors_mode)
         print("- SENSORS MODE: %s" % int(str(sensors_mode), 16))
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Keeps the Pozyx devices of a script working: failure rates, backoff, reconnecting and re-provisioning.
+
+The scripts used to treat every failed positioning the same. Position printed it and tried again
+at once, PositionMqtt dropped it, and MultitagPositioning read the error code of the tag, and of the
+local Pozyx when that failed, for every failure. A tag out of range costs a remote timeout on every
+pass, a USB hiccup leaves a serial port that never works again, and a tag that reset forgot the
+anchors it was given without saving them to flash.
+
+A DeviceSupervisor is told the status of every positioning with record(), and keeps a smoothed
+failure rate per tag. After failures_before_backoff failures in a row it finds out why, with one or
+two reads instead of a read per failure:
+
+    the local Pozyx doesn't answer WHO_AM_I:  the serial link is lost, it is reopened every
+                                              reopen_interval seconds, growing up to
+                                              max_reopen_interval, and no tag is due meanwhile
+    the tag doesn't answer:                   it is out of range or without power, it backs off
+    the tag has fewer than min_devices in     it reset and lost its volatile configuration, it
+    its device list:                          is provisioned again right away
+    otherwise:                                its error code is read, it backs off when there is one
+
+A tag that backs off is not due for backoff seconds, doubling with every failed try up to
+max_backoff, so it doesn't take slots from the tags that work. One success ends the backoff. A tag
+that didn't answer is asked for its device list when its backoff ends, before it positions again:
+the read times out as fast as a positioning would, and a tag that comes back after it lost power is
+provisioned again on the way.
+
+pypozyx turns the I/O errors of the serial port into POZYX_FAILURE, so a lost link shows up as
+failures of every tag, and the WHO_AM_I check tells it apart from tags that fail on their own.
+"""
+from time import perf_counter, sleep
+
+from pypozyx import PozyxConnectionError, POZYX_SUCCESS, SingleRegister
+from serial import SerialException
+
+
+class TagHealth(object):
+    """Failure statistics and backoff of a single tag"""
+
+    def __init__(self, tag_id):
+        self.tag_id = tag_id
+        self.attempts = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.unreachable = False
+        # smoothed share of the attempts that failed
+        self.failure_rate = 0.0
+        self.failing_since = None
+        # tries in a row that ended in a backoff, the delay doubles with each
+        self.backoffs = 0
+        self.backoff_until = 0.0
+        self.reprovisions = 0
+
+    @property
+    def state(self):
+        if self.backoffs:
+            return "unreachable" if self.unreachable else "backing off"
+        return "failing" if self.consecutive_failures else "ok"
+
+
+class DeviceSupervisor(object):
+    """Tracks the failures of the tags of a script, backs them off and recovers the serial link and tags"""
+
+    def __init__(self, pozyx, tag_ids, provision=None, find_port=None, failures_before_backoff=2, backoff=1.0,
+                 max_backoff=16.0, reopen_interval=0.5, max_reopen_interval=5.0, min_devices=3, smoothing=0.1,
+                 max_wait=0.05):
+        """
+        Args:
+            pozyx: the local PozyxSerial.
+            tag_ids: the tags the script positions, None is the local Pozyx.
+            provision (optional): function of a tag id that configures the tag again after a reset, and
+                returns its status. Without it a reset tag only backs off.
+            find_port (optional): function returning the serial port to reopen, for a Pozyx that comes
+                back under another name, like get_first_pozyx_serial_port. The old port by default.
+            failures_before_backoff (optional): failures in a row before the cause is looked for.
+            backoff (optional): seconds of the first backoff of a tag.
+            max_backoff (optional): the longest backoff in seconds.
+            reopen_interval (optional): seconds between the first tries to reopen the serial port.
+            max_reopen_interval (optional): the most seconds between tries to reopen the serial port.
+            min_devices (optional): a tag with fewer devices in its list lost its configuration.
+            smoothing (optional): weight of the latest attempt in the failure rate.
+            max_wait (optional): the most seconds wait() sleeps.
+        """
+        self.pozyx = pozyx
+        self.tags = {tag_id: TagHealth(tag_id) for tag_id in tag_ids}
+        self.provision = provision
+        self.find_port = find_port
+        self.failures_before_backoff = failures_before_backoff
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.reopen_interval = reopen_interval
+        self.max_reopen_interval = max_reopen_interval
+        self.min_devices = min_devices
+        self.smoothing = smoothing
+        self.max_wait = max_wait
+
+        self.link_up = True
+        self.link_lost_at = None
+        self.reopen_at = 0.0
+        self.reopen_delay = reopen_interval
+        self.reconnects = 0
+
+    def health(self, tag_id):
+        tag = self.tags.get(tag_id)
+        if tag is None:
+            tag = self.tags[tag_id] = TagHealth(tag_id)
+        return tag
+
+    # asked by the loops
+
+    def maintain(self, now=None):
+        """Tries to reopen a lost serial link when it is time, returns whether the link is up"""
+        now = perf_counter() if now is None else now
+        if not self.link_up and now >= self.reopen_at:
+            self.reopen(now)
+        return self.link_up
+
+    def due(self, tag_id, now=None):
+        """Whether tag_id should be positioned now, not while it backs off or the link is lost"""
+        if not self.link_up:
+            return False
+        now = perf_counter() if now is None else now
+        tag = self.health(tag_id)
+        if tag.backoff_until > now:
+            return False
+        if tag.unreachable:
+            return self.probe(tag, now)
+        return True
+
+    def ready(self, tag_id):
+        """maintain() and due() for a script with a single tag, waits a little when the tag isn't due"""
+        now = perf_counter()
+        if self.maintain(now) and self.due(tag_id, now):
+            return True
+        self.wait(now)
+        return False
+
+    def wait(self, now=None):
+        """Sleeps until a tag is due or the link is tried again, at most max_wait, instead of spinning"""
+        now = perf_counter() if now is None else now
+        if self.link_up:
+            until = min(tag.backoff_until for tag in self.tags.values()) if self.tags else now
+        else:
+            until = self.reopen_at
+        sleep(min(max(until - now, 0.0), self.max_wait))
+
+    def record(self, tag_id, status, now=None):
+        """Counts the status of a positioning of tag_id and acts on failures in a row"""
+        now = perf_counter() if now is None else now
+        tag = self.health(tag_id)
+        tag.attempts += 1
+        if status == POZYX_SUCCESS:
+            tag.failure_rate -= self.smoothing * tag.failure_rate
+            if tag.backoffs:
+                self.handleEvent("recovered", tag_id, "after %.1fs" % (now - tag.failing_since))
+            tag.consecutive_failures = 0
+            tag.unreachable = False
+            tag.backoffs = 0
+            tag.backoff_until = 0.0
+            return
+        tag.failures += 1
+        tag.failure_rate += self.smoothing * (1.0 - tag.failure_rate)
+        tag.consecutive_failures += 1
+        if tag.consecutive_failures == 1:
+            tag.failing_since = now
+        if tag.consecutive_failures >= self.failures_before_backoff and self.link_up:
+            self.diagnose(tag, now)
+
+    # finding out why a tag fails
+
+    def diagnose(self, tag, now):
+        if not self.linkAlive():
+            self.linkLost(now)
+            return
+        if not self.probe(tag, now):
+            return
+        error_code = SingleRegister()
+        if self.pozyx.getErrorCode(error_code, tag.tag_id) != POZYX_SUCCESS:
+            self.backOff(tag, now, "no error code")
+        elif error_code.value != 0:
+            self.backOff(tag, now, self.pozyx.getErrorMessage(error_code))
+        else:
+            # lost messages, like results that collided on the air with those of another master
+            tag.consecutive_failures = 0
+
+    def probe(self, tag, now):
+        """Reads the device list size of a tag, returns whether it answered with its configuration in place"""
+        size = SingleRegister()
+        if self.pozyx.getDeviceListSize(size, tag.tag_id) != POZYX_SUCCESS:
+            if not self.linkAlive():
+                self.linkLost(now)
+                return False
+            tag.unreachable = True
+            self.backOff(tag, now, "no answer")
+            return False
+        tag.unreachable = False
+        if size.value < self.min_devices and self.provision is not None:
+            self.reprovision(tag, now, size.value)
+            return False
+        return True
+
+    def backOff(self, tag, now, reason):
+        delay = min(self.backoff * 2 ** tag.backoffs, self.max_backoff)
+        tag.backoffs += 1
+        tag.backoff_until = now + delay
+        self.handleEvent("backoff", tag.tag_id, "%s, next try in %.2fs" % (reason, delay))
+
+    def reprovision(self, tag, now, devices):
+        """Configures a tag that reset again, it gets the usual failures in a row to show it worked"""
+        tag.reprovisions += 1
+        status = self.provision(tag.tag_id)
+        self.handleEvent("reprovisioned", tag.tag_id, "%i devices in its list after a reset, %s" % (
+            devices, "success" if status == POZYX_SUCCESS else "failed"))
+        if status == POZYX_SUCCESS:
+            tag.consecutive_failures = 0
+        else:
+            self.backOff(tag, now, "provisioning failed")
+
+    # the serial link
+
+    def linkAlive(self):
+        who_am_i = SingleRegister()
+        try:
+            return self.pozyx.getWhoAmI(who_am_i) == POZYX_SUCCESS and who_am_i.value == 0x43
+        except (SerialException, OSError):
+            return False
+
+    def linkLost(self, now):
+        self.link_up = False
+        self.link_lost_at = now
+        self.reopen_at = now
+        self.reopen_delay = self.reopen_interval
+        self.handleEvent("link lost", None, self.pozyx.port)
+
+    def reopen(self, now):
+        """Closes the serial port and opens it again, backs off when the Pozyx isn't back yet"""
+        pozyx = self.pozyx
+        port = pozyx.port
+        if self.find_port is not None:
+            port = self.find_port() or port
+        try:
+            pozyx.ser.close()
+        except (SerialException, OSError):
+            pass
+        try:
+            pozyx.connectToPozyx(port, pozyx.baudrate, pozyx.timeout, pozyx.write_timeout)
+            alive = self.linkAlive()
+        except (PozyxConnectionError, SerialException, OSError):
+            alive = False
+        if not alive:
+            self.reopen_at = now + self.reopen_delay
+            self.reopen_delay = min(2 * self.reopen_delay, self.max_reopen_interval)
+            return
+        self.link_up = True
+        self.reconnects += 1
+        # the failures that showed the link was lost don't count, backoffs from before do
+        for tag in self.tags.values():
+            tag.consecutive_failures = 0
+        self.handleEvent("reconnected", None, "%s after %.1fs" % (port, now - self.link_lost_at))
+
+    # reporting
+
+    def handleEvent(self, kind, tag_id, detail):
+        """Called on a backoff, recovery, re-provisioning, lost link or reconnect, prints it"""
+        print("HEALTH ID: {}, {}: {}".format("0x%0.4x" % (tag_id or 0), kind, detail))
+
+    def printHealth(self):
+        for tag in self.tags.values():
+            print("HEALTH ID: {}, {} attempts, {} failed, failure rate {:.2f}, {} reprovisions, {}".format(
+                "0x%0.4x" % (tag.tag_id or 0), tag.attempts, tag.failures, tag.failure_rate, tag.reprovisions,
+                tag.state))
+        print("HEALTH serial link {}, {} reconnects".format("up" if self.link_up else "lost", self.reconnects))
+
+
+if __name__ == "__main__":
+    # runs MultitagPositioning on a simulated network through a tag going out of range, a tag that
+    # resets and loses its anchors, and the USB cable of the local Pozyx pulled out for a second,
+    # without and with a supervisor, and counts the positions per second of every tag
+    import contextlib
+    import io
+
+    from benchmark import ANCHORS, create_network
+    from multitag_positioning import MultitagPositioning
+    from simulated_pozyx import LatencyModel
+
+    tag_ids = [0x1000, 0x1001, 0x1002, 0x1003]
+    duration = 14
+    # seconds into the run, what happens
+    timeline = [(2.0, "0x1002 out of range"), (5.0, "0x1001 resets"), (8.0, "USB unplugged"), (9.0, "USB plugged in")]
+
+    for supervised in [False, True]:
+        pozyx = create_network(tag_ids, LatencyModel(), seed=1)
+        network = pozyx.network
+        supervisor = DeviceSupervisor(pozyx, tag_ids) if supervised else None
+        events = []
+        if supervisor is not None:
+            supervisor.handleEvent = lambda kind, tag_id, detail: events.append(
+                (perf_counter() - start, kind, tag_id, detail))
+        script = MultitagPositioning(pozyx, tag_ids, ANCHORS, [], False, None, 0, supervisor=supervisor)
+        fixes = {tag_id: [0] * duration for tag_id in tag_ids}
+        script.printPublishPosition = lambda position, tag_id: fixes[tag_id].__setitem__(
+            min(int(perf_counter() - start), duration - 1), fixes[tag_id][min(int(perf_counter() - start),
+                                                                              duration - 1)] + 1)
+
+        pending = list(timeline)
+        start = perf_counter()
+        # the error messages without a supervisor, a line per failure
+        with contextlib.redirect_stdout(io.StringIO()):
+            while perf_counter() - start < duration:
+                while pending and perf_counter() - start >= pending[0][0]:
+                    _, what = pending.pop(0)
+                    if what == "0x1002 out of range":
+                        network.remove(network.devices[0x1002])
+                    elif what == "0x1001 resets":
+                        network.devices[0x1001].reset()
+                    elif what == "USB unplugged":
+                        pozyx.device.unplug()
+                    else:
+                        pozyx.device.plug()
+                script.loop()
+
+        print("{} supervisor, events at {}".format("With" if supervised else "Without", ", ".join(
+            "{:.0f}s {}".format(at, what) for at, what in timeline)))
+        for tag_id in tag_ids:
+            print("BENCH device health {} supervisor, ID 0x{:04x}, positions per second: {}".format(
+                "with" if supervised else "without", tag_id, " ".join("%3i" % count for count in fixes[tag_id])))
+        for at, kind, tag_id, detail in events:
+            print("  {:5.2f}s HEALTH ID: {}, {}: {}".format(at, "0x%0.4x" % (tag_id or 0), kind, detail))
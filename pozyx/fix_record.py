@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Reusable fix records, so the positioning loops don't allocate objects for every position.
+
+Position.loop and PositionMqtt.loop made a new Coordinates for every position, and PositionMqtt a
+Position object and a copy of its __dict__ on top, which then waited in the publish queue. At
+hundreds of positions per second for days, that is a steady stream of objects for the garbage
+collector, and its collections show up as latency spikes.
+
+The loops now position into one Coordinates they keep, and PositionMqtt hands the publisher a
+FixRecord from a FixRing: records with __slots__, allocated once, that are filled in place. The ring
+holds one record more than the publish queue, so a record is only filled again after it left the
+queue, and the publisher copies a record into a dictionary or tuple as it takes it from the queue.
+The queue holds the records in messages from a ring of its own, so a loop allocates nothing at all.
+
+tune_gc() is the optional GC mode for long runs: it collects once, moves everything that exists
+after the setup into the permanent generation with gc.freeze, so later collections don't walk it,
+and raises the threshold of the youngest generation.
+"""
+import gc
+from itertools import cycle
+
+
+class FixRecord(object):
+    """A position of a tag at a moment, filled in place"""
+    __slots__ = ("tag_id", "timestamp", "x", "y", "z", "latency", "binary")
+
+    def __init__(self, binary=False):
+        self.tag_id = 0
+        self.timestamp = 0.0
+        self.x = 0
+        self.y = 0
+        self.z = 0
+        self.latency = 0
+        self.binary = binary
+
+    def load(self, tag_id, timestamp, position, latency):
+        self.tag_id = tag_id
+        self.timestamp = timestamp
+        self.x = position.x
+        self.y = position.y
+        self.z = position.z
+        self.latency = latency
+        return self
+
+    def snapshot(self):
+        """A copy that stays the same when the record is filled again, what PositionMqtt publishes"""
+        if self.binary:
+            return (self.tag_id, self.timestamp, self.x, self.y, self.z, self.latency)
+        return {"x": self.x, "y": self.y, "z": self.z, "lat": self.latency}
+
+
+class FixRing(object):
+    """A fixed number of FixRecords handed out in turn"""
+
+    def __init__(self, size, binary=False):
+        """
+        Args:
+            size: number of records, more than the fixes that can wait anywhere at once.
+            binary (optional): records snapshot to position_codec tuples instead of JSON objects.
+        """
+        self.records = [FixRecord(binary) for _ in range(size)]
+        # cycle hands out the records without an index that would grow
+        self.next_record = cycle(self.records).__next__
+
+    def next(self):
+        return self.next_record()
+
+
+def tune_gc(threshold=50000):
+    """Freezes what the setup made and collects the youngest generation less often, returns the old thresholds"""
+    thresholds = gc.get_threshold()
+    gc.collect()
+    gc.freeze()
+    gc.set_threshold(threshold, thresholds[1], thresholds[2])
+    return thresholds
+
+
+def untune_gc(thresholds):
+    gc.unfreeze()
+    gc.set_threshold(*thresholds)
+
+
+if __name__ == "__main__":
+    # runs the loops of Position and PositionMqtt against a Pozyx that answers at once, with the
+    # objects they used to allocate and as they are now, and measures what one loop allocates in steady
+    # state: bytes from the allocator, objects the collector has to track and collections per 100000 loops
+    import time
+    import tracemalloc
+    from math import ceil
+    from time import perf_counter
+
+    from pypozyx import Coordinates, POZYX_SUCCESS
+
+    from benchmark import NullMqttClient
+    from position import Position
+    from position_mqtt import PositionMqtt
+
+    class InstantPozyx(object):
+        """Answers doPositioning right away with positions made in advance, so only the loop allocates"""
+
+        def __init__(self, count=64):
+            self.positions = cycle([(1000 + i, 2000 + i, 1500) for i in range(count)]).__next__
+
+        def getNetworkId(self, network_id):
+            network_id.id = 0x6000
+            return POZYX_SUCCESS
+
+        def doPositioning(self, position, dimension=None, height=None, algorithm=None, remote_id=None):
+            # into data like pypozyx loads an answer, the x setter would scale and allocate
+            position.data[0], position.data[1], position.data[2] = self.positions()
+            return POZYX_SUCCESS
+
+    class AllocatingPosition(Position):
+        """Position.loop as it was, with a new Coordinates every loop"""
+
+        def loop(self):
+            position = Coordinates()
+            time_before = time.time()
+            status = self.pozyx.doPositioning(position, self.dimension, self.height, self.algorithm,
+                                              remote_id=self.remote_id)
+            latency = ceil((time.time() - time_before) * 1000)
+            if status == POZYX_SUCCESS:
+                self.printPublishPosition(position, latency)
+
+    class PositionObject:
+        def __init__(self, x, y, z, lat):
+            self.x = x
+            self.y = y
+            self.z = z
+            self.lat = lat
+
+    class AllocatingPositionMqtt(PositionMqtt):
+        """PositionMqtt.loop as it was, with a new Coordinates, Position object and dictionary every loop"""
+
+        def loop(self):
+            if self.time_before == 0:
+                self.time_before = time.time()
+            position = Coordinates()
+            status = self.pozyx.doPositioning(position, self.dimension, self.height, self.algorithm,
+                                              remote_id=self.remote_id)
+            if status == POZYX_SUCCESS:
+                self.handlePosition(position, ceil((time.time() - self.time_before) * 1000))
+
+        def publishPosition(self, position, latency):
+            self.publishMqttObject("position", PositionObject(position.x, position.y, position.z, latency).__dict__)
+
+    def measure(script, loops=20000, drain=None):
+        """Bytes allocated per loop, objects left for the collector per loop and collections per 100000 loops"""
+        for _ in range(1000):
+            script.loop()
+            drain()
+        allocated = 0
+        allocating = 0
+        tracemalloc.start()
+        for _ in range(loops):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            script.loop()
+            _, peak = tracemalloc.get_traced_memory()
+            allocated += peak - before
+            allocating += peak > before
+            # the publisher's thread takes what was queued, outside of the measurement
+            drain()
+        tracemalloc.stop()
+
+        gc.collect()
+        gc.disable()
+        count = gc.get_count()[0]
+        for _ in range(loops):
+            script.loop()
+        tracked = (gc.get_count()[0] - count) / loops
+        drain()
+        gc.enable()
+
+        collections = [0]
+
+        def count_collections(phase, info):
+            if phase == "start":
+                collections[0] += 1
+        gc.callbacks.append(count_collections)
+        start = perf_counter()
+        for _ in range(100000):
+            script.loop()
+            drain()
+        elapsed = perf_counter() - start
+        gc.callbacks.remove(count_collections)
+        return allocated / loops, allocating / loops, tracked, collections[0], elapsed / 100000
+
+    def no_drain():
+        pass
+
+    for name, script_class in [("Position", AllocatingPosition), ("Position", Position),
+                               ("PositionMqtt", AllocatingPositionMqtt), ("PositionMqtt", PositionMqtt)]:
+        for tuned in [False, True]:
+            if script_class is PositionMqtt or script_class is AllocatingPositionMqtt:
+                script = script_class(None, None, InstantPozyx(), client=NullMqttClient())
+                # the publisher thread is left out, the queue is emptied like it would
+                script.publisher.stop()
+                drain = script.publisher.queue.clear
+            else:
+                script = script_class(InstantPozyx())
+                script.printPublishPosition = lambda position, latency: None
+                drain = no_drain
+            thresholds = tune_gc() if tuned else None
+            allocated, allocating, tracked, collections, per_loop = measure(script, drain=drain)
+            if tuned:
+                untune_gc(thresholds)
+            print("BENCH allocations {:<12} {:<10}{}: {:.1f} bytes allocated per loop ({:.0%} of the loops allocate), "
+                  "{:.2f} objects left for the collector per loop, {} collections per 100000 loops, {:.1f}us per loop".format(
+                      name, "as it was" if script_class.__name__.startswith("Allocating") else "now",
+                      " with tune_gc" if tuned else "", allocated, allocating, tracked, collections, per_loop * 1e6))
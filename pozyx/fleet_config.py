@@ -0,0 +1,289 @@
+"""
+Brings a fleet of tags to a desired configuration, touching only what differs.
+
+Every tag's configuration registers are read back in one go and compared with the desired values.
+Only the registers that differ are written, the anchors are only re-added when the device list
+differs and the flash memory is only written when something changed or wasn't saved yet.
+Tags behind different serial links (Pozyx devices) are configured at the same time.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
+
+from pypozyx import (Coordinates, Data, DeviceCoordinates, DeviceList, PozyxConstants, PozyxRegisters,
+                     SingleRegister, POZYX_SUCCESS, POZYX_FAILURE)
+from pypozyx.structures.generic import dataCheck
+
+from anchor_provisioning import AnchorProvisioner, checksum
+
+
+# the positioning registers from the filter up to the sensor mode, the UWB settings among them, read in a single call
+CONFIG_START = PozyxRegisters.POSITIONING_FILTER
+CONFIG_SIZE = PozyxRegisters.SENSORS_MODE - CONFIG_START + 1
+
+REGISTER_NAMES = {
+    PozyxRegisters.POSITIONING_FILTER: "filter",
+    PozyxRegisters.POSITIONING_ALGORITHM: "algorithm",
+    PozyxRegisters.POSITIONING_NUMBER_OF_ANCHORS: "anchor selection",
+    PozyxRegisters.POSITIONING_INTERVAL: "update interval",
+    PozyxRegisters.POSITIONING_INTERVAL + 1: "update interval",
+    PozyxRegisters.RANGING_PROTOCOL: "ranging protocol",
+    PozyxRegisters.SENSORS_MODE: "sensor mode",
+}
+
+UWB_REGISTERS = [PozyxRegisters.UWB_CHANNEL, PozyxRegisters.UWB_RATES, PozyxRegisters.UWB_PLEN, PozyxRegisters.UWB_GAIN]
+
+
+class TagConfiguration(object):
+    """The desired configuration of a tag, as register values"""
+
+    def __init__(self, uwb_settings, filter, filter_strength, positioning_algorithm, dimension,
+                 update_interval, anchor_selection_mode, number_of_anchors, ranging_protocol,
+                 sensor_mode, anchors):
+        self.uwb_settings = uwb_settings
+        self.registers = {
+            PozyxRegisters.POSITIONING_FILTER: filter + (filter_strength << 4),
+            PozyxRegisters.POSITIONING_ALGORITHM: positioning_algorithm + (dimension << 4),
+            PozyxRegisters.POSITIONING_NUMBER_OF_ANCHORS: (anchor_selection_mode << 7) + number_of_anchors,
+            PozyxRegisters.POSITIONING_INTERVAL: update_interval & 0xFF,
+            PozyxRegisters.POSITIONING_INTERVAL + 1: update_interval >> 8,
+            PozyxRegisters.RANGING_PROTOCOL: ranging_protocol,
+            PozyxRegisters.SENSORS_MODE: sensor_mode,
+        }
+        self.anchors = []
+        for anchor in anchors:
+            if not dataCheck(anchor):
+                anchor = DeviceCoordinates(anchor[0], anchor[1], Coordinates(anchor[2], anchor[3], anchor[4]))
+            self.anchors.append(anchor)
+
+    def uwbRegisters(self):
+        channel, rates, plen, _ = self.uwb_settings.data
+        # rounded like PozyxLib.setUWBGain
+        gain = int(2.0 * self.uwb_settings.gain_db + 0.5)
+        return [channel, rates, plen, gain]
+
+    def anchorList(self):
+        return [(anchor.network_id, (int(anchor.pos.x), int(anchor.pos.y), int(anchor.pos.z)))
+                for anchor in self.anchors]
+
+
+class TagReport(object):
+    """What was changed on a tag and how long it took"""
+
+    def __init__(self, tag_id):
+        self.tag_id = tag_id
+        self.status = POZYX_SUCCESS
+        self.changed = []
+        self.anchors_changed = False
+        self.uwb_changed = False
+        self.saved = False
+        self.read_time = 0
+        self.write_time = 0
+        self.save_time = 0
+        self.total_time = 0
+
+    def name(self):
+        return "local" if self.tag_id is None else "0x%0.4x" % self.tag_id
+
+    def __str__(self):
+        changes = list(self.changed)
+        if self.uwb_changed:
+            changes.append("uwb")
+        if self.anchors_changed:
+            changes.append("anchors")
+        return "TAG {}: {}, changed: {}, saved: {}, read: {:.0f}ms, write: {:.0f}ms, save: {:.0f}ms, total: {:.0f}ms".format(
+            self.name(), "success" if self.status == POZYX_SUCCESS else "failure",
+            ", ".join(changes) if changes else "nothing", self.saved, self.read_time * 1000,
+            self.write_time * 1000, self.save_time * 1000, self.total_time * 1000)
+
+
+class FleetConfigurator(object):
+    """Applies a TagConfiguration to many tags, writing only the differences"""
+
+    def __init__(self, configuration, save_to_flash=True):
+        self.configuration = configuration
+        self.save_to_flash = save_to_flash
+
+    def apply(self, links):
+        """Configures the tags of every (pozyx, tag_ids) link, the links at the same time"""
+        if len(links) == 1:
+            return self.configureLink(*links[0])
+        with ThreadPoolExecutor(max_workers=len(links)) as executor:
+            results = list(executor.map(lambda link: self.configureLink(*link), links))
+        return [report for reports in results for report in reports]
+
+    def configureLink(self, pozyx, tag_ids):
+        """Configures the tags behind a single Pozyx one by one"""
+        # changing the UWB settings of the local device would cut it off from the remote tags
+        ordered = [tag_id for tag_id in tag_ids if tag_id is not None]
+        if None in tag_ids:
+            ordered.append(None)
+        return [self.configureTag(pozyx, tag_id) for tag_id in ordered]
+
+    def configureTag(self, pozyx, tag_id):
+        report = TagReport(tag_id)
+        start = perf_counter()
+
+        current = self.readRegisters(pozyx, tag_id)
+        current_anchors = self.readAnchors(pozyx, tag_id)
+        report.read_time = perf_counter() - start
+        if current is None:
+            report.status = POZYX_FAILURE
+            report.total_time = perf_counter() - start
+            return report
+
+        desired = self.configuration.registers
+        changed = sorted(address for address, value in desired.items() if current[address - CONFIG_START] != value)
+        report.changed = sorted(set(REGISTER_NAMES[address] for address in changed), key=list(REGISTER_NAMES.values()).index)
+        report.anchors_changed = current_anchors != self.configuration.anchorList()
+        uwb_start = PozyxRegisters.UWB_CHANNEL - CONFIG_START
+        report.uwb_changed = current[uwb_start:uwb_start + len(UWB_REGISTERS)] != self.configuration.uwbRegisters()
+
+        before_write = perf_counter()
+        report.status &= self.writeRegisters(pozyx, tag_id, changed)
+        if report.anchors_changed:
+            report.status &= self.setAnchors(pozyx, tag_id, current_anchors)
+        report.write_time = perf_counter() - before_write
+
+        before_save = perf_counter()
+        if self.save_to_flash and (changed or report.anchors_changed or not self.isSaved(pozyx, tag_id)):
+            report.status &= self.saveRegisters(pozyx, tag_id, report.anchors_changed, not report.uwb_changed)
+            report.saved = True
+        report.save_time = perf_counter() - before_save
+
+        # last, as a remote tag can't be reached on the old settings afterwards
+        if report.uwb_changed:
+            before_uwb = perf_counter()
+            report.status &= pozyx.setUWBSettings(self.configuration.uwb_settings, tag_id, self.save_to_flash)
+            report.saved |= self.save_to_flash
+            report.write_time += perf_counter() - before_uwb
+
+        report.total_time = perf_counter() - start
+        return report
+
+    # reading
+
+    def readRegisters(self, pozyx, tag_id):
+        registers = Data([0] * CONFIG_SIZE)
+        if pozyx.getRead(CONFIG_START, registers, tag_id) != POZYX_SUCCESS:
+            return None
+        return list(registers.data)
+
+    def readAnchors(self, pozyx, tag_id):
+        """The anchors in the device list of the tag, None when it couldn't be read"""
+        list_size = SingleRegister()
+        if pozyx.getDeviceListSize(list_size, tag_id) != POZYX_SUCCESS:
+            return None
+        if list_size[0] == 0:
+            return []
+        device_ids = DeviceList(list_size=list_size[0])
+        if pozyx.getDeviceIds(device_ids, tag_id) != POZYX_SUCCESS:
+            return None
+        anchors = []
+        for device_id in device_ids.data:
+            position = Coordinates()
+            if pozyx.getDeviceCoordinates(device_id, position, tag_id) != POZYX_SUCCESS:
+                return None
+            anchors.append((device_id, (int(position.x), int(position.y), int(position.z))))
+        return anchors
+
+    def isSaved(self, pozyx, tag_id):
+        """Whether all configuration registers are in the flash memory of the tag"""
+        details = pozyx.getSavedRegisters(tag_id)
+        if not dataCheck(details):
+            return False
+        for address in self.savedRegisters() + UWB_REGISTERS:
+            if not details[address // 8] & (1 << (address % 8)):
+                return False
+        return True
+
+    # writing
+
+    def writeRegisters(self, pozyx, tag_id, addresses):
+        """Writes the changed registers, consecutive ones in a single write"""
+        status = POZYX_SUCCESS
+        desired = self.configuration.registers
+        # the update interval is a 16 bit register, write it whole
+        addresses = set(addresses)
+        if addresses & {PozyxRegisters.POSITIONING_INTERVAL, PozyxRegisters.POSITIONING_INTERVAL + 1}:
+            addresses |= {PozyxRegisters.POSITIONING_INTERVAL, PozyxRegisters.POSITIONING_INTERVAL + 1}
+        for run in self.runs(sorted(addresses)):
+            status &= pozyx.setWrite(run[0], Data([desired[address] for address in run]), tag_id)
+        if PozyxRegisters.SENSORS_MODE in addresses:
+            # like PozyxLib.setSensorMode
+            sleep(PozyxConstants.DELAY_MODE_CHANGE)
+        return status
+
+    def runs(self, addresses):
+        runs = []
+        for address in addresses:
+            if runs and runs[-1][-1] == address - 1:
+                runs[-1].append(address)
+            else:
+                runs.append([address])
+        return runs
+
+    def setAnchors(self, pozyx, tag_id, current_anchors=None):
+        """Adds the anchors that are missing or wrong, clearing the list only when it holds others"""
+        provisioner = AnchorProvisioner(self.configuration.anchors, anchor_select=None, save_to_flash=False)
+        provisioner.writeDevices(pozyx, tag_id, None if current_anchors is None else dict(current_anchors))
+        stored = provisioner.readDeviceList(pozyx, tag_id)
+        return POZYX_SUCCESS if stored is not None and checksum(stored.items()) == provisioner.checksum else POZYX_FAILURE
+
+    def savedRegisters(self):
+        # registers are saved by their first address
+        return [address for address in sorted(self.configuration.registers)
+                if address != PozyxRegisters.POSITIONING_INTERVAL + 1]
+
+    def saveRegisters(self, pozyx, tag_id, anchors_changed, save_uwb):
+        """Saves the configuration, the UWB settings too unless they still have to change"""
+        registers = self.savedRegisters() + (UWB_REGISTERS if save_uwb else [])
+        status = pozyx.saveRegisters(registers, tag_id)
+        if anchors_changed:
+            status &= pozyx.saveConfiguration(PozyxConstants.FLASH_SAVE_NETWORK, remote_id=tag_id)
+            pozyx.saveAnchorIds(tag_id)
+        return status
+
+    def printReport(self, reports):
+        for report in reports:
+            print(report)
+        saved = sum(1 for report in reports if report.saved)
+        unchanged = sum(1 for report in reports if not (report.changed or report.uwb_changed or report.anchors_changed))
+        print("Configured {} tags, {} unchanged, {} saved to flash".format(len(reports), unchanged, saved))
+
+
+if __name__ == "__main__":
+    # configures two simulated masters with five tags each, twice, to show that the second run writes nothing
+    from pypozyx import UWBSettings
+    from simulated_pozyx import SimulatedNetwork, SimulatedPozyxSerial
+
+    anchors = [DeviceCoordinates(0xa000, 1, Coordinates(0, 0, 2500)),
+               DeviceCoordinates(0x6968, 1, Coordinates(0, 3100, 2500)),
+               DeviceCoordinates(0x6945, 1, Coordinates(1900, 0, 2500)),
+               DeviceCoordinates(0x696b, 1, Coordinates(1900, 3100, 2500))]
+
+    configuration = TagConfiguration(UWBSettings(channel=5, bitrate=0, prf=2, plen=0x08, gain_db=11.5),
+                                     PozyxConstants.FILTER_TYPE_MOVING_AVERAGE, 5,
+                                     PozyxConstants.POSITIONING_ALGORITHM_TRACKING, PozyxConstants.DIMENSION_3D,
+                                     0, PozyxConstants.ANCHOR_SELECT_AUTO, 4,
+                                     PozyxConstants.RANGE_PROTOCOL_FAST, 0, anchors)
+
+    network = SimulatedNetwork()
+    for anchor in anchors:
+        network.addAnchor(anchor.network_id, (anchor.pos.x, anchor.pos.y, anchor.pos.z))
+    links = []
+    for master_id in [0x6000, 0x6001]:
+        network.addTag(master_id)
+        tag_ids = [master_id + 0x100 * i for i in range(1, 6)]
+        for tag_id in tag_ids:
+            network.addTag(tag_id)
+        links.append((SimulatedPozyxSerial(network, master_id), tag_ids + [None]))
+
+    configurator = FleetConfigurator(configuration)
+    for run in ["first", "second"]:
+        start = perf_counter()
+        reports = configurator.apply(links)
+        print("%s run in %.1fs" % (run.capitalize(), perf_counter() - start))
+        configurator.printReport(reports)
+        print("")
+    print("Flash writes per device: %s" % sorted(set(device.flash_writes for device in network.devices.values()
+                                                     if not device.is_anchor)))
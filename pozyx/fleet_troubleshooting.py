@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Troubleshoots a whole installation in one pass and writes the results as JSON or CSV records.
+
+Every Pozyx connected over serial discovers the devices around it, after which the settings of each
+device are read like basic_troubleshooting.device_check does, but collected into a record with the
+time the check took instead of printed. Records are sorted by link and network id, so the files of
+two sweeps can be diffed to see what changed in the installation. A link that doesn't answer gets a
+single record with its serial port as link, the other links are swept as usual.
+
+The remote devices of one Pozyx are checked one after the other, as they share its UWB radio and
+its TX and RX buffers. Different Pozyx devices are swept at the same time.
+"""
+import csv
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, time
+
+from pypozyx import DeviceList, NetworkID, PozyxConstants, SingleRegister, POZYX_SUCCESS
+
+from basic_troubleshooting import device_record
+from register_snapshot import RegisterSnapshot
+
+
+# columns of the CSV output, in order
+FIELDS = ["link", "network_id", "status", "started", "elapsed_ms", "device_type", "who_am_i", "firmware_version",
+          "hardware_version", "selftest", "error_code", "error_message", "uwb_channel", "uwb_bitrate", "uwb_prf",
+          "uwb_plen", "uwb_gain_db", "filter", "filter_strength", "algorithm", "dimension", "update_interval_ms",
+          "ranging_protocol", "sensor_mode", "anchor_selection", "number_of_anchors", "anchors", "saved_registers"]
+
+
+class FleetTroubleshooter(object):
+    """Checks every device reachable from a set of serial links"""
+
+    def __init__(self, max_workers=4, discover=True):
+        """
+        Args:
+            max_workers (optional): number of links swept at the same time.
+            discover (optional): discover the devices around every link first. Without it only the
+                devices already in the device list of a link are checked. The device list is never
+                cleared, devices that were added but are gone show up as unreachable.
+        """
+        self.max_workers = max_workers
+        self.discover = discover
+
+    def sweep(self, links):
+        """Checks the devices of all links, returns a sorted list of records"""
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(links)))) as executor:
+            records = [record for link_records in executor.map(self.sweepLink, links) for record in link_records]
+        return sorted(records, key=lambda record: (record["link"] or "", record["network_id"] or ""))
+
+    def sweepLink(self, pozyx):
+        port = getattr(pozyx, "port", None)
+        pozyx = RegisterSnapshot(pozyx)
+        network_id = NetworkID()
+        if pozyx.getNetworkId(network_id) != POZYX_SUCCESS:
+            return [{"link": port, "network_id": None, "status": "link unreachable"}]
+        link = "0x%0.4x" % network_id.id
+
+        device_ids = self.deviceIds(pozyx)
+        records = [self.checkDevice(pozyx, link, None)]
+        records[0]["network_id"] = link
+        for device_id in device_ids:
+            if device_id != network_id.id:
+                records.append(self.checkDevice(pozyx, link, device_id))
+        return records
+
+    def deviceIds(self, pozyx):
+        if self.discover:
+            pozyx.doDiscovery(discovery_type=PozyxConstants.DISCOVERY_ALL_DEVICES)
+        list_size = SingleRegister()
+        if pozyx.getDeviceListSize(list_size) != POZYX_SUCCESS or list_size[0] == 0:
+            return []
+        device_list = DeviceList(list_size=list_size[0])
+        if pozyx.getDeviceIds(device_list) != POZYX_SUCCESS:
+            return []
+        return sorted(set(device_list))
+
+    def checkDevice(self, pozyx, link, device_id):
+        started = time()
+        start = perf_counter()
+        record = device_record(pozyx, device_id)
+        record.update({
+            "link": link,
+            "network_id": "0x%0.4x" % device_id if device_id is not None else None,
+            "started": round(started, 3),
+            "elapsed_ms": round((perf_counter() - start) * 1000, 1),
+        })
+        # the next device starts from an empty cache, and the master's own cache goes stale too
+        pozyx.invalidate(device_id)
+        return record
+
+
+def write_json(records, file):
+    json.dump(records, file, indent=2)
+    file.write("\n")
+
+
+def write_csv(records, file):
+    writer = csv.DictWriter(file, fieldnames=FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    for record in records:
+        row = dict(record)
+        row["anchors"] = " ".join(record.get("anchors", []))
+        writer.writerow(row)
+
+
+def print_summary(records, elapsed):
+    failed = [record for record in records if record["status"] != "ok"]
+    checked = [record["elapsed_ms"] for record in records if "elapsed_ms" in record]
+    print("Checked {} devices in {:.2f}s, slowest {:.0f}ms, {} with problems".format(
+        len(records), elapsed, max(checked) if checked else 0, len(failed)), file=sys.stderr)
+    for record in failed:
+        print("\t{} via {}: {}".format(record["network_id"], record["link"], record["status"]), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    # sweeps two simulated masters with five tags each and four anchors around them, and a third
+    # master whose USB cable was pulled
+    from simulated_pozyx import SimulatedNetwork, SimulatedPozyxSerial
+
+    output_format = "json"  # or "csv"
+    max_workers = 4
+
+    network = SimulatedNetwork()
+    for anchor_id, position in [(0xa000, (0, 0, 2500)), (0x6968, (0, 3100, 2500)),
+                                (0x6945, (1900, 0, 2500)), (0x696b, (1900, 3100, 2500))]:
+        network.addAnchor(anchor_id, position)
+    links = []
+    for master_id in [0x6000, 0x6001]:
+        network.addTag(master_id)
+        for i in range(1, 6):
+            network.addTag(master_id + 0x100 * i, (1000, 1000 + 200 * i, 1000))
+        links.append(SimulatedPozyxSerial(network, master_id))
+    network.addTag(0x6002)
+    links.append(SimulatedPozyxSerial(network, 0x6002))
+    network.devices[0x6002].unplug()
+
+    start = perf_counter()
+    records = FleetTroubleshooter(max_workers=max_workers).sweep(links)
+    elapsed = perf_counter() - start
+
+    if output_format == "csv":
+        write_csv(records, sys.stdout)
+    else:
+        write_json(records, sys.stdout)
+    print_summary(records, elapsed)
+    swept = set(record["link"] for record in records if record["status"] != "link unreachable")
+    print("Healthy links reported despite the dead one: {}".format(swept == {"0x6000", "0x6001"}), file=sys.stderr)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Assembles the positions of all tags into frames: one snapshot of every tag per tick.
+
+Positions of different tags arrive one after the other, each a little later than it was measured.
+FrameAssembler stamps every position with the host time it arrived at and with an estimate of when
+the device measured it, which is the arrival time minus the time the result took to reach the host.
+At a fixed rate it then produces frames: for every tick the positions of all tags at that moment,
+interpolated between the measurements around it, or extrapolated a little past the last one.
+
+Frames are produced a delay after their tick, so that positions measured before the tick but still
+on their way are taken into account. All times are perf_counter() seconds.
+"""
+import bisect
+from collections import deque
+from time import perf_counter
+
+from pypozyx import POZYX_SUCCESS, SingleRegister
+
+
+MEASURED = "measured"
+INTERPOLATED = "interpolated"
+EXTRAPOLATED = "extrapolated"
+
+
+class Fix(object):
+    __slots__ = ("tag_id", "x", "y", "z", "received", "measured")
+
+    def __init__(self, tag_id, x, y, z, received, measured):
+        self.tag_id = tag_id
+        self.x = x
+        self.y = y
+        self.z = z
+        self.received = received
+        self.measured = measured
+
+
+class Frame(object):
+    """The positions of all tags at one tick"""
+
+    def __init__(self, index, time):
+        self.index = index
+        self.time = time
+        # tag id to (x, y, z, how the position was obtained, age of the newest measurement used)
+        self.positions = {}
+        self.missing = []
+
+    def __str__(self):
+        tags = ", ".join("0x%0.4x: (%i, %i, %i) %s" % ((tag_id or 0,) + tuple(int(v) for v in value[:3]) + (value[3],))
+                         for tag_id, value in sorted(self.positions.items(), key=lambda item: item[0] or 0))
+        return "FRAME {} at {:.3f}s: {}".format(self.index, self.time, tags)
+
+
+class FrameAssembler(object):
+    """Turns the positions of many tags into frames at a fixed rate"""
+
+    def __init__(self, rate=10.0, delay=0.1, max_extrapolation=0.2, history=8, start=None):
+        """
+        Args:
+            rate (optional): frames per second.
+            delay (optional): seconds a frame waits after its tick for late positions.
+            max_extrapolation (optional): seconds past its last measurement a tag is extrapolated,
+                after that it is missing from the frames.
+            history (optional): measurements kept per tag.
+            start (optional): time of the first tick, now by default.
+        """
+        self.period = 1.0 / rate
+        self.delay = delay
+        self.max_extrapolation = max_extrapolation
+        self.history = history
+        self.start = perf_counter() if start is None else start
+        self.next_index = 0
+        self.fixes = {}
+        # seconds between a device measuring a position and it reaching the host, per tag
+        self.transit = {}
+        self.default_transit = 0.0
+
+    def add(self, tag_id, x, y, z, received=None):
+        """Adds a position that just arrived, or arrived at received"""
+        received = perf_counter() if received is None else received
+        fix = Fix(tag_id, x, y, z, received, received - self.transit.get(tag_id, self.default_transit))
+        fixes = self.fixes.get(tag_id)
+        if fixes is None:
+            fixes = self.fixes[tag_id] = deque(maxlen=self.history)
+        if not fixes or fixes[-1].measured <= fix.measured:
+            fixes.append(fix)
+        else:
+            # positions of a tag can come in out of order after calibrate() or from callers merging sources
+            ordered = list(fixes)
+            ordered.insert(bisect.bisect([f.measured for f in ordered], fix.measured), fix)
+            fixes.clear()
+            fixes.extend(ordered[-self.history:])
+        return fix
+
+    def calibrate(self, pozyx, tag_ids, samples=5):
+        """Estimates the transit time of every tag as half the fastest round trip of a register read"""
+        register = SingleRegister()
+        for tag_id in tag_ids:
+            fastest = None
+            for _ in range(samples):
+                start = perf_counter()
+                if pozyx.getWhoAmI(register, remote_id=tag_id) == POZYX_SUCCESS:
+                    round_trip = perf_counter() - start
+                    fastest = round_trip if fastest is None else min(fastest, round_trip)
+            if fastest is not None:
+                self.transit[tag_id] = fastest / 2
+        return self.transit
+
+    def frames(self, now=None):
+        """Yields the frames whose tick lies more than delay in the past, each only once"""
+        now = perf_counter() if now is None else now
+        while self.start + self.next_index * self.period <= now - self.delay:
+            yield self.frame(self.next_index)
+            self.next_index += 1
+
+    def frame(self, index):
+        frame = Frame(index, self.start + index * self.period)
+        for tag_id, fixes in self.fixes.items():
+            position = self.positionAt(fixes, frame.time)
+            if position is None:
+                frame.missing.append(tag_id)
+            else:
+                frame.positions[tag_id] = position
+        return frame
+
+    def positionAt(self, fixes, time):
+        if not fixes or time < fixes[0].measured:
+            return None
+        last = fixes[-1]
+        if time >= last.measured:
+            age = time - last.measured
+            if age > self.max_extrapolation:
+                return None
+            if len(fixes) < 2 or age == 0:
+                return (last.x, last.y, last.z, MEASURED if age == 0 else EXTRAPOLATED, age)
+            return self.blend(fixes[-2], last, time) + (EXTRAPOLATED, age)
+        # the newest measurement at or before the tick, and the one after it
+        for index in range(len(fixes) - 1, 0, -1):
+            if fixes[index - 1].measured <= time:
+                before, after = fixes[index - 1], fixes[index]
+                return self.blend(before, after, time) + (INTERPOLATED, time - before.measured)
+        return None
+
+    def blend(self, a, b, time):
+        span = b.measured - a.measured
+        if span <= 0:
+            return (b.x, b.y, b.z)
+        w = (time - a.measured) / span
+        return (a.x + w * (b.x - a.x), a.y + w * (b.y - a.y), a.z + w * (b.z - a.z))
+
+
+if __name__ == "__main__":
+    # assembles 10Hz frames from five simulated remote tags positioned one after the other
+    import io
+    from contextlib import redirect_stdout
+
+    from benchmark import ANCHORS, create_network
+    from multitag_positioning import MultitagPositioning
+    from simulated_pozyx import LatencyModel
+
+    tag_ids = [0x1000, 0x1001, 0x1002, 0x1003, 0x1004]
+    duration = 3
+    rate = 10.0
+
+    pozyx = create_network(tag_ids, LatencyModel(jitter=0.1, seed=1), seed=1)
+    assembler = FrameAssembler(rate=rate, delay=0.15, max_extrapolation=0.3)
+    print("Transit per tag: %s" % ", ".join("0x%0.4x: %.1fms" % (tag_id, transit * 1000) for tag_id, transit in
+                                             assembler.calibrate(pozyx, tag_ids).items()))
+
+    multitag = MultitagPositioning(pozyx, tag_ids, ANCHORS, [], False, None, 0, frame_assembler=assembler)
+    frames = []
+    multitag.handleFrame = frames.append
+    start = perf_counter()
+    with redirect_stdout(io.StringIO()):
+        while perf_counter() - start < duration:
+            multitag.loop()
+
+    emitted = [frame for frame in frames if frame.positions]
+    complete = sum(1 for frame in emitted if not frame.missing)
+    counts = {}
+    errors = []
+    latest_errors = []
+    for frame in emitted:
+        for tag_id, value in frame.positions.items():
+            counts[value[3]] = counts.get(value[3], 0) + 1
+            # compared with where the simulated tag really was at the tick, and with its latest position
+            truth = pozyx.network.devices[tag_id].true_position(frame.time)
+            latest = [fix for fix in assembler.fixes[tag_id] if fix.received <= frame.time]
+            errors.append(sum((value[i] - truth[i]) ** 2 for i in range(3)) ** 0.5)
+            if latest:
+                latest_errors.append(((latest[-1].x - truth[0]) ** 2 + (latest[-1].y - truth[1]) ** 2 +
+                                      (latest[-1].z - truth[2]) ** 2) ** 0.5)
+    print("{} frames, {} with every tag, positions: {}".format(len(emitted), complete, counts))
+    print("Mean error at the tick: {:.0f}mm, taking the latest position of every tag instead: {:.0f}mm".format(
+        sum(errors) / len(errors), sum(latest_errors) / max(len(latest_errors), 1)))
+    print(emitted[len(emitted) // 2])
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Positions remote tags through every Pozyx connected over USB, one worker process per gateway.
+
+A single master tag can only position so many remote tags per second. GatewayRunner finds all
+Pozyx serial ports, splits the tags over them and runs a MultitagPositioning loop for each port in
+its own process. The positions of all gateways come back as one stream, ordered by time.
+
+The tags are split in one of three ways:
+
+    static:    in the order given, the same number of tags per gateway give or take one
+    balanced:  by weight (how often a tag should be positioned), heaviest tags first to the gateway
+               with the least weight so far
+    proximity: to the nearest gateway, given the positions of the gateways and the last known
+               positions of the tags, without giving a gateway more than its share of tags
+
+Give every gateway its own UWB channel, or the gateways get in each other's way on the air.
+"""
+import heapq
+import multiprocessing
+import queue
+from math import ceil
+from time import monotonic, perf_counter, sleep
+
+from pypozyx import Coordinates, DeviceCoordinates, PozyxSerial, POZYX_SUCCESS
+from pypozyx.pozyx_serial import get_pozyx_ports
+
+from multitag_positioning import MultitagPositioning
+
+
+STRATEGIES = ["static", "balanced", "proximity"]
+
+
+def partition_tags(tag_ids, gateways, strategy="static", tag_weights=None, gateway_positions=None,
+                   tag_positions=None, slack=1.25):
+    """
+    Assigns every tag to a gateway.
+
+    Args:
+        tag_ids: the tags to position.
+        gateways: the serial ports (or any other name) of the gateways.
+        strategy (optional): "static", "balanced" or "proximity".
+        tag_weights (optional): dictionary of tag id to weight for "balanced", 1.0 when missing.
+        gateway_positions (optional): dictionary of gateway to (x, y, z) in mm for "proximity".
+        tag_positions (optional): dictionary of tag id to (x, y, z) in mm for "proximity". Tags
+            without a position are balanced over the gateways afterwards.
+        slack (optional): with "proximity", a gateway gets at most slack times its share of tags.
+
+    Returns:
+        a dictionary of gateway to the list of its tag ids.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError("Unknown strategy %s, use one of %s" % (strategy, ", ".join(STRATEGIES)))
+    if len(gateways) == 0:
+        raise ValueError("No gateways to assign tags to")
+    assignment = {gateway: [] for gateway in gateways}
+    tag_weights = tag_weights or {}
+
+    if strategy == "static":
+        # consecutive runs whose lengths differ by at most one, the first gateways take the extra tags
+        share, extra = divmod(len(tag_ids), len(gateways))
+        start = 0
+        for index, gateway in enumerate(gateways):
+            end = start + share + (1 if index < extra else 0)
+            assignment[gateway] = list(tag_ids[start:end])
+            start = end
+        return assignment
+
+    remaining = list(tag_ids)
+    if strategy == "proximity":
+        if gateway_positions is None:
+            raise ValueError("Proximity assignment needs the positions of the gateways")
+        tag_positions = tag_positions or {}
+        capacity = max(1, int(ceil(slack * len(tag_ids) / len(gateways))))
+        # the tags closest to a gateway pick first, so a full gateway turns away the farthest tags
+        candidates = []
+        for tag_id in tag_ids:
+            if tag_id not in tag_positions:
+                continue
+            for gateway in gateways:
+                candidates.append((distance(tag_positions[tag_id], gateway_positions[gateway]), tag_id, gateway))
+        candidates.sort(key=lambda candidate: candidate[0])
+        assigned = set()
+        for _, tag_id, gateway in candidates:
+            if tag_id not in assigned and len(assignment[gateway]) < capacity:
+                assignment[gateway].append(tag_id)
+                assigned.add(tag_id)
+        remaining = [tag_id for tag_id in tag_ids if tag_id not in assigned]
+
+    # longest processing time first: the heaviest tag goes to the least loaded gateway
+    loads = [(sum(tag_weights.get(tag_id, 1.0) for tag_id in assignment[gateway]), index, gateway)
+             for index, gateway in enumerate(gateways)]
+    heapq.heapify(loads)
+    for tag_id in sorted(remaining, key=lambda tag_id: -tag_weights.get(tag_id, 1.0)):
+        load, index, gateway = heapq.heappop(loads)
+        assignment[gateway].append(tag_id)
+        heapq.heappush(loads, (load + tag_weights.get(tag_id, 1.0), index, gateway))
+    return assignment
+
+
+def distance(a, b):
+    return sum((a[i] - b[i]) ** 2 for i in range(3)) ** 0.5
+
+
+def open_serial(port, tag_ids):
+    return PozyxSerial(port)
+
+
+class GatewayPositioning(MultitagPositioning):
+    """MultitagPositioning that hands its positions to the runner instead of printing them"""
+
+    def __init__(self, gateway, fixes, *args, **kwargs):
+        MultitagPositioning.__init__(self, *args, **kwargs)
+        self.gateway = gateway
+        self.fixes = fixes
+
+    def printPublishPosition(self, position, network_id):
+        self.fixes.put((monotonic(), self.gateway, network_id, position.x, position.y, position.z))
+
+
+def run_gateway(gateway, tag_ids, anchors, connect, fixes, stop, scheduled, configure):
+    """The worker process of one gateway"""
+    pozyx = connect(gateway, tag_ids)
+    anchors = [DeviceCoordinates(network_id, flag, Coordinates(x, y, z)) for network_id, flag, x, y, z in anchors]
+    positioning = GatewayPositioning(gateway, fixes, pozyx, tag_ids, anchors, [], False, None, 0, scheduled=scheduled)
+    if configure:
+        positioning.setAnchorsManual(save_to_flash=False)
+    while not stop.is_set():
+        positioning.loop()
+
+
+class GatewayRunner(object):
+    """Runs a positioning worker process per gateway and merges their positions"""
+
+    def __init__(self, tag_ids, anchors, gateways=None, strategy="static", connect=open_serial, scheduled=False,
+                 configure=True, reorder_delay=0.05, **partition_options):
+        """
+        Args:
+            tag_ids: the remote tags to position.
+            anchors: DeviceCoordinates of the anchors.
+            gateways (optional): the serial ports to use, all Pozyx serial ports when None.
+            strategy (optional): how the tags are split, see partition_tags.
+            connect (optional): function of a gateway and its tag ids that returns the Pozyx to use,
+                runs in the worker process. Opens the serial port by default.
+            scheduled (optional): use the MultitagScheduler in every worker.
+            configure (optional): give every tag the anchors before positioning starts.
+            reorder_delay (optional): seconds a position is held back, so that positions arriving
+                late from another process can still be put in order.
+            partition_options: tag_weights, gateway_positions, tag_positions and slack for partition_tags.
+        """
+        self.gateways = gateways if gateways is not None else get_pozyx_ports()
+        self.assignment = partition_tags(tag_ids, self.gateways, strategy, **partition_options)
+        self.anchors = [(anchor.network_id, anchor.flag, anchor.pos.x, anchor.pos.y, anchor.pos.z)
+                        for anchor in anchors]
+        self.connect = connect
+        self.scheduled = scheduled
+        self.configure = configure
+        self.reorder_delay = reorder_delay
+
+        self.fixes = multiprocessing.Queue()
+        self.stop_event = multiprocessing.Event()
+        self.processes = []
+        self.pending = []
+        self.received = {gateway: 0 for gateway in self.gateways}
+        self.out_of_order = 0
+        self.last_emitted = 0.0
+
+    def start(self):
+        for gateway in self.gateways:
+            if len(self.assignment[gateway]) == 0:
+                continue
+            process = multiprocessing.Process(
+                target=run_gateway, name="gateway %s" % gateway, daemon=True,
+                args=(gateway, self.assignment[gateway], self.anchors, self.connect, self.fixes,
+                      self.stop_event, self.scheduled, self.configure))
+            process.start()
+            self.processes.append(process)
+
+    def stop(self, timeout=2.0):
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+    def positions(self, timeout=0.1):
+        """Yields the (timestamp, gateway, tag id, x, y, z) that are due, in order of timestamp"""
+        try:
+            fix = self.fixes.get(timeout=timeout)
+            while True:
+                self.received[fix[1]] += 1
+                heapq.heappush(self.pending, fix)
+                fix = self.fixes.get_nowait()
+        except queue.Empty:
+            pass
+        due = monotonic() - self.reorder_delay
+        while self.pending and self.pending[0][0] <= due:
+            yield self.emit(heapq.heappop(self.pending))
+
+    def flush(self):
+        """Yields everything still held back"""
+        while self.pending:
+            yield self.emit(heapq.heappop(self.pending))
+
+    def emit(self, fix):
+        if fix[0] < self.last_emitted:
+            # arrived later than reorder_delay allowed for
+            self.out_of_order += 1
+        self.last_emitted = max(self.last_emitted, fix[0])
+        return fix
+
+    def run(self, duration=None, callback=None):
+        """Positions until duration has passed (or forever), calling callback with every position in order"""
+        self.start()
+        end = None if duration is None else perf_counter() + duration
+        try:
+            while end is None or perf_counter() < end:
+                for fix in self.positions():
+                    if callback is not None:
+                        callback(fix)
+        finally:
+            self.stop()
+            for fix in self.flush():
+                if callback is not None:
+                    callback(fix)
+
+
+def print_position(fix):
+    timestamp, gateway, tag_id, x, y, z = fix
+    print("POS ID: {}, x(mm): {}, y(mm): {}, z(mm): {}, gateway: {}".format("0x%0.4x" % tag_id, x, y, z, gateway))
+
+
+def simulated_gateway(gateway, tag_ids):
+    """A simulated master with its own anchors and tags, as if every gateway had its own UWB channel"""
+    from benchmark import create_network
+    from simulated_pozyx import LatencyModel
+    return create_network(tag_ids, LatencyModel(jitter=0.1, seed=hash(gateway) & 0xFFFF), seed=1)
+
+
+if __name__ == "__main__":
+    # positions 12 simulated remote tags through 1, 2, 3 and 4 simulated gateways
+    from benchmark import ANCHORS
+
+    tag_ids = [0x1000 + i for i in range(12)]
+    duration = 4
+    strategy = "balanced"
+
+    for number_of_gateways in [1, 2, 3, 4]:
+        gateways = ["sim%i" % i for i in range(number_of_gateways)]
+        runner = GatewayRunner(tag_ids, ANCHORS, gateways, strategy, connect=simulated_gateway, configure=False)
+        fixes = []
+        runner.run(duration, fixes.append)
+        ordered = all(fixes[i][0] <= fixes[i + 1][0] for i in range(len(fixes) - 1))
+        print("{} gateways: {:.1f} positions/s, per gateway {}, in order: {}".format(
+            number_of_gateways, len(fixes) / duration,
+            ", ".join("%.1f" % (runner.received[gateway] / duration) for gateway in gateways), ordered))
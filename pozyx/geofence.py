@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Geofencing of position streams: tells when a tag enters, leaves or stays in a zone.
+
+Zones are boxes or polygons in the xy plane, in mm. Geofence puts them in a uniform grid: every
+cell lists the zones that overlap it, and remembers of each whether it covers the cell completely.
+A position then only looks at the zones of its own cell, and only tests the edges of the polygons
+whose border runs through that cell, so evaluating a position costs about the same with 10 zones as
+with 10000 as long as the cells are about the size of the zones.
+
+Every tag keeps the zones it is in. update() compares them with the zones of the new position and
+returns only the changes:
+
+    enter: the tag is in a zone it wasn't in before
+    exit:  the tag left a zone
+    dwell: the tag has been in a zone for the dwell time of the zone, once per visit
+"""
+from math import floor
+from time import perf_counter, time
+
+
+ENTER = "enter"
+EXIT = "exit"
+DWELL = "dwell"
+
+
+class Zone(object):
+    """A box or polygon zone"""
+
+    def __init__(self, zone_id, points, dwell=None):
+        """
+        Args:
+            zone_id: name of the zone.
+            points: the (x, y) corners of the polygon, in order, without repeating the first.
+            dwell (optional): seconds after which a tag in the zone gets a dwell event.
+        """
+        if len(points) < 3:
+            raise ValueError("Zone %s needs at least three corners" % zone_id)
+        self.zone_id = zone_id
+        self.points = [(float(x), float(y)) for x, y in points]
+        self.dwell = dwell
+        xs = [x for x, _ in self.points]
+        ys = [y for _, y in self.points]
+        self.bounds = (min(xs), min(ys), max(xs), max(ys))
+        self.edges = list(zip(self.points, self.points[1:] + self.points[:1]))
+        self.is_box = len(points) == 4 and len(set(xs)) == 2 and len(set(ys)) == 2
+
+    @classmethod
+    def box(cls, zone_id, x_min, y_min, x_max, y_max, dwell=None):
+        return cls(zone_id, [(x_min, y_min), (x_max, y_min), (x_max, y_max), (x_min, y_max)], dwell)
+
+    def contains(self, x, y, edges=None):
+        """Whether x, y lies inside, counting crossings of only the given edges when they are known"""
+        x_min, y_min, x_max, y_max = self.bounds
+        if x < x_min or x > x_max or y < y_min or y > y_max:
+            return False
+        if self.is_box:
+            return True
+        inside = False
+        for (x1, y1), (x2, y2) in (self.edges if edges is None else edges):
+            if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+        return inside
+
+
+def segment_crosses_box(a, b, box):
+    """Whether the segment from a to b touches the box (x_min, y_min, x_max, y_max)"""
+    x_min, y_min, x_max, y_max = box
+    # Liang-Barsky clipping
+    t0, t1 = 0.0, 1.0
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    for p, q in ((-dx, a[0] - x_min), (dx, x_max - a[0]), (-dy, a[1] - y_min), (dy, y_max - a[1])):
+        if p == 0:
+            if q < 0:
+                return False
+        else:
+            t = q / p
+            if p < 0:
+                t0 = max(t0, t)
+            else:
+                t1 = min(t1, t)
+            if t0 > t1:
+                return False
+    return True
+
+
+class Geofence(object):
+    """Keeps the zones in a grid and turns the positions of tags into enter, exit and dwell events"""
+
+    def __init__(self, cell_size=1000.0):
+        """
+        Args:
+            cell_size (optional): width and height of a grid cell in mm, about the size of the zones.
+        """
+        self.cell_size = float(cell_size)
+        self.zones = {}
+        # (column, row) to a list of (zone, None when the zone covers the cell, else the edges crossing it)
+        # for polygons the edges are those between the cell and the right side of the zone, as the
+        # crossing test counts edges to the right of the point
+        self.cells = {}
+        # tag id to a dictionary of the zones it is in to (entered at, dwell reported)
+        self.inside = {}
+
+    def cell(self, x, y):
+        return int(floor(x / self.cell_size)), int(floor(y / self.cell_size))
+
+    def addZone(self, zone):
+        if zone.zone_id in self.zones:
+            self.removeZone(zone.zone_id)
+        self.zones[zone.zone_id] = zone
+        x_min, y_min, x_max, y_max = zone.bounds
+        column_min, row_min = self.cell(x_min, y_min)
+        column_max, row_max = self.cell(x_max, y_max)
+        for column in range(column_min, column_max + 1):
+            for row in range(row_min, row_max + 1):
+                entry = self.cellEntry(zone, column, row)
+                if entry is not None:
+                    self.cells.setdefault((column, row), []).append(entry)
+        return zone
+
+    def cellEntry(self, zone, column, row):
+        """What a cell needs to know of a zone, None when they don't overlap"""
+        size = self.cell_size
+        box = (column * size, row * size, (column + 1) * size, (row + 1) * size)
+        if zone.is_box:
+            x_min, y_min, x_max, y_max = zone.bounds
+            if x_min <= box[0] and y_min <= box[1] and x_max >= box[2] and y_max >= box[3]:
+                return (zone, None)
+            return (zone, zone.edges)
+        # a point in the cell crosses the edges in the band of rows of the cell, right of the cell
+        band = (box[0], box[1], zone.bounds[2], box[3])
+        edges = [edge for edge in zone.edges if segment_crosses_box(edge[0], edge[1], band)]
+        crossing = [edge for edge in edges if segment_crosses_box(edge[0], edge[1], box)]
+        center = ((box[0] + box[2]) / 2, (box[1] + box[3]) / 2)
+        if not crossing:
+            # the border doesn't run through the cell: it is completely inside or outside
+            return (zone, None) if zone.contains(center[0], center[1]) else None
+        return (zone, edges)
+
+    def removeZone(self, zone_id):
+        zone = self.zones.pop(zone_id)
+        for key in list(self.cells):
+            entries = [entry for entry in self.cells[key] if entry[0] is not zone]
+            if entries:
+                self.cells[key] = entries
+            else:
+                del self.cells[key]
+        for zones in self.inside.values():
+            zones.pop(zone_id, None)
+
+    def zonesAt(self, x, y):
+        """The ids of the zones x, y lies in"""
+        found = []
+        for zone, edges in self.cells.get(self.cell(x, y), ()):
+            if edges is None:
+                x_min, y_min, x_max, y_max = zone.bounds
+                if x_min <= x <= x_max and y_min <= y <= y_max:
+                    found.append(zone.zone_id)
+            elif zone.contains(x, y, edges):
+                found.append(zone.zone_id)
+        return found
+
+    def update(self, tag_id, x, y, timestamp=None):
+        """Returns the (event, tag id, zone id, timestamp) caused by the new position of a tag"""
+        timestamp = time() if timestamp is None else timestamp
+        inside = self.inside.get(tag_id)
+        if inside is None:
+            inside = self.inside[tag_id] = {}
+        events = []
+        current = self.zonesAt(x, y)
+        for zone_id in current:
+            state = inside.get(zone_id)
+            if state is None:
+                inside[zone_id] = [timestamp, False]
+                events.append((ENTER, tag_id, zone_id, timestamp))
+            elif not state[1]:
+                dwell = self.zones[zone_id].dwell
+                if dwell is not None and timestamp - state[0] >= dwell:
+                    state[1] = True
+                    events.append((DWELL, tag_id, zone_id, timestamp))
+        if len(inside) > len(current) or events:
+            for zone_id in [zone_id for zone_id in inside if zone_id not in current]:
+                del inside[zone_id]
+                events.append((EXIT, tag_id, zone_id, timestamp))
+        return events
+
+    def forget(self, tag_id):
+        """Forgets a tag, without exit events"""
+        self.inside.pop(tag_id, None)
+
+
+def naive_zones_at(zones, x, y):
+    """Tests every zone, what the grid saves"""
+    return [zone.zone_id for zone in zones if zone.contains(x, y)]
+
+
+if __name__ == "__main__":
+    # evaluates random walks of 50 tags against 100, 1000 and 10000 box and polygon zones, with and
+    # without the grid, in a hall of 100 by 100 meter
+    import random
+    from math import cos, pi, sin
+
+    random.seed(1)
+    size = 100000
+    tags = 50
+    steps = 400
+
+    def random_zone(zone_id, polygon):
+        cx, cy = random.uniform(0, size), random.uniform(0, size)
+        radius = random.uniform(300, 1500)
+        if not polygon:
+            return Zone.box(zone_id, cx - radius, cy - radius, cx + radius, cy + radius, dwell=2.0)
+        corners = random.randint(5, 9)
+        return Zone(zone_id, [(cx + radius * random.uniform(0.5, 1) * cos(2 * pi * i / corners),
+                               cy + radius * random.uniform(0.5, 1) * sin(2 * pi * i / corners))
+                              for i in range(corners)], dwell=2.0)
+
+    walks = []
+    for tag_id in range(tags):
+        x, y = random.uniform(0, size), random.uniform(0, size)
+        walk = []
+        for _ in range(steps):
+            x = min(max(x + random.gauss(0, 200), 0), size)
+            y = min(max(y + random.gauss(0, 200), 0), size)
+            walk.append((x, y))
+        walks.append(walk)
+    fixes = [(tag_id, walks[tag_id][step][0], walks[tag_id][step][1], step * 0.1)
+             for step in range(steps) for tag_id in range(tags)]
+
+    for polygon in [False, True]:
+        for count in [100, 1000, 10000]:
+            zones = [random_zone(index, polygon) for index in range(count)]
+            geofence = Geofence(cell_size=2000)
+            start = perf_counter()
+            for zone in zones:
+                geofence.addZone(zone)
+            build = perf_counter() - start
+
+            events = {ENTER: 0, EXIT: 0, DWELL: 0}
+            timings = []
+            for tag_id, x, y, timestamp in fixes:
+                start = perf_counter()
+                for event in geofence.update(tag_id, x, y, timestamp):
+                    events[event[0]] += 1
+                timings.append(perf_counter() - start)
+            timings.sort()
+
+            sample = fixes[:2000]
+            start = perf_counter()
+            for _, x, y, _ in sample:
+                naive_zones_at(zones, x, y)
+            naive = (perf_counter() - start) / len(sample)
+            agree = all(sorted(geofence.zonesAt(x, y)) == sorted(naive_zones_at(zones, x, y))
+                        for _, x, y, _ in sample[:500])
+
+            print("BENCH geofence {} {}: {:.1f}us per fix (p99 {:.1f}us), without the grid {:.1f}us, "
+                  "index built in {:.0f}ms, events: {}, same zones as without the grid: {}".format(
+                      count, "polygons" if polygon else "boxes", sum(timings) / len(timings) * 1e6,
+                      timings[int(0.99 * len(timings))] * 1e6, naive * 1e6, build * 1000,
+                      ", ".join("%s %i" % item for item in sorted(events.items())), agree))
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Latency histograms per stage and per tag, cheap enough to record on every position.
+
+Every stage of the hot path records how long it took in a LatencyHistogram: a fixed array of
+log-linear buckets like an HDR histogram, so memory doesn't grow with the number of samples and
+percentiles stay within about 1.5% of the real value. The stages the scripts record are:
+
+    positioning: from sending the positioning request to having the response from the device
+    publish:     from handing a position to the publisher to it being published
+    interval:    between two positions of the same tag
+
+LatencyMetrics holds the histograms, keyed by stage and tag, and reports their percentiles and
+rates with snapshot(). It can print them periodically, or serve them as JSON over HTTP to be pulled.
+"""
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from time import perf_counter, sleep
+
+
+class LatencyHistogram(object):
+    """Counts latencies in log-linear buckets, from 1us up to about an hour"""
+
+    def __init__(self, sub_bucket_bits=7, max_exponent=25):
+        # values below sub_bucket_count microseconds get a bucket each, above that every power of
+        # two is split into sub_bucket_count / 2 buckets
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_bucket_count = 1 << sub_bucket_bits
+        self.half_count = self.sub_bucket_count // 2
+        self.counts = [0] * (self.sub_bucket_count + max_exponent * self.half_count)
+        self.highest = (self.sub_bucket_count << max_exponent) - 1
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, seconds):
+        value = min(max(int(seconds * 1000000), 0), self.highest)
+        if value < self.sub_bucket_count:
+            index = value
+        else:
+            shift = value.bit_length() - self.sub_bucket_bits
+            index = self.sub_bucket_count + (shift - 1) * self.half_count + (value >> shift) - self.half_count
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def bucketValue(self, index):
+        """The middle of a bucket in microseconds"""
+        if index < self.sub_bucket_count:
+            return index
+        shift = (index - self.sub_bucket_count) // self.half_count + 1
+        top = (index - self.sub_bucket_count) % self.half_count + self.half_count
+        return (top << shift) + (1 << shift) // 2
+
+    def percentile(self, fraction):
+        """The latency in seconds below which fraction of the samples fall"""
+        if self.count == 0:
+            return float('nan')
+        rank = max(1, int(fraction * self.count + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(max(self.bucketValue(index), self.min), self.max) / 1000000.0
+        return self.max / 1000000.0
+
+    def mean(self):
+        return self.total / self.count / 1000000.0 if self.count else float('nan')
+
+    def reset(self):
+        for index in range(len(self.counts)):
+            self.counts[index] = 0
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+
+class LatencyMetrics(object):
+    """The latency histograms and counters of all stages and tags"""
+
+    def __init__(self, sub_bucket_bits=7):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.started = perf_counter()
+        self.dump_thread = None
+        self.server = None
+
+    def histogram(self, stage, tag_id=None):
+        key = (stage, tag_id)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, LatencyHistogram(self.sub_bucket_bits))
+        return histogram
+
+    def record(self, stage, seconds, tag_id=None):
+        """Records one latency, a histogram is only ever recorded into from a single thread"""
+        histogram = self.histograms.get((stage, tag_id))
+        if histogram is None:
+            histogram = self.histogram(stage, tag_id)
+        histogram.record(seconds)
+
+    def since(self, stage, start, tag_id=None):
+        """Records the time since start, a perf_counter() value, and returns the current perf_counter()"""
+        now = perf_counter()
+        self.record(stage, now - start, tag_id)
+        return now
+
+    def snapshot(self, reset=False):
+        """A list of dictionaries with the count, rate and percentiles in ms of every histogram"""
+        now = perf_counter()
+        elapsed = max(now - self.started, 1e-9)
+        with self.lock:
+            items = sorted(self.histograms.items(), key=lambda item: (item[0][0], str(item[0][1])))
+            if reset:
+                # recording goes on into fresh histograms, the old ones are only read from here on
+                self.histograms = {key: LatencyHistogram(self.sub_bucket_bits) for key, _ in items}
+                self.started = now
+        stats = []
+        for (stage, tag_id), histogram in items:
+            if histogram.count == 0:
+                continue
+            stats.append({
+                "stage": stage,
+                "tag": "0x%0.4x" % tag_id if isinstance(tag_id, int) else tag_id,
+                "count": histogram.count,
+                "rate": round(histogram.count / elapsed, 2),
+                "mean": round(histogram.mean() * 1000, 3),
+                "p50": round(histogram.percentile(0.5) * 1000, 3),
+                "p95": round(histogram.percentile(0.95) * 1000, 3),
+                "p99": round(histogram.percentile(0.99) * 1000, 3),
+                "max": round(histogram.max / 1000.0, 3),
+            })
+        return stats
+
+    def dump(self, file=None, reset=False):
+        file = file or sys.stdout
+        for stats in self.snapshot(reset):
+            print("LATENCY {stage} {tag}: {count} samples, {rate}Hz, mean: {mean}ms, p50: {p50}ms, p95: {p95}ms, "
+                  "p99: {p99}ms, max: {max}ms".format(**stats), file=file)
+
+    def startDump(self, interval=10.0, file=None, reset=True):
+        """Dumps the histograms every interval seconds from a background thread"""
+        def run():
+            while True:
+                sleep(interval)
+                self.dump(file, reset)
+        self.dump_thread = threading.Thread(target=run, name="latency_dump", daemon=True)
+        self.dump_thread.start()
+
+    def serve(self, port=9108, host="127.0.0.1"):
+        """Serves the snapshot as JSON on http://host:port/ from a background thread, host "" serves all interfaces"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(metrics.snapshot()).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, name="latency_server", daemon=True).start()
+        return self.server
+
+
+if __name__ == "__main__":
+    # checks the percentiles against exact ones and measures what recording costs
+    import random
+
+    samples = [random.lognormvariate(-4, 0.6) for _ in range(200000)]
+    histogram = LatencyHistogram()
+    start = perf_counter()
+    for sample in samples:
+        histogram.record(sample)
+    record_time = (perf_counter() - start) / len(samples)
+
+    ordered = sorted(samples)
+    for fraction in [0.5, 0.95, 0.99]:
+        exact = ordered[int(fraction * len(ordered)) - 1]
+        print("p{:g}: {:.3f}ms, exact {:.3f}ms".format(fraction * 100, histogram.percentile(fraction) * 1000,
+                                                        exact * 1000))
+    print("record: {:.2f}us per sample, {} buckets".format(record_time * 1e6, len(histogram.counts)))
+
+    metrics = LatencyMetrics()
+    start = perf_counter()
+    for sample in samples:
+        metrics.record("positioning", sample, 0x1000)
+    print("LatencyMetrics.record: {:.2f}us per sample".format((perf_counter() - start) / len(samples) * 1e6))
+    metrics.dump()
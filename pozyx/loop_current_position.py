@@ -2,14 +2,19 @@
 """
 A script that will read the positioning data on the tag
 """
-from time import sleep, time
+from time import perf_counter, sleep, time
 from math import ceil
 from pypozyx import (PozyxSerial, get_first_pozyx_serial_port, PositioningData, SingleRegister,
                      PozyxConstants, POZYX_SUCCESS, Coordinates)
+from pypozyx.definitions.bitmasks import PozyxBitmasks
+
+from latency_metrics import LatencyMetrics
+from positioning_reader import PositioningReader
 
 
 class CurrentPosition:
-    def __init__(self, pozyx):
+    def __init__(self, pozyx, event_driven=False, min_poll_delay=0.001, max_poll_delay=0.05, metrics=None,
+                 fields=None):
         self.pozyx = pozyx
         self.time_before = time()
         self.x = 0
@@ -17,20 +22,95 @@ class CurrentPosition:
         self.z = 0
         self.latency = 0
 
+        # event driven reading waits for the positioning interrupt instead of reading the position non stop
+        self.event_driven = event_driven
+        self.min_poll_delay = min_poll_delay
+        self.max_poll_delay = max_poll_delay
+        self.poll_delay = min_poll_delay
+        self.interval = 0
+        self.next_read = 0
+
+        # serial reads and reported positions, to compare both ways of reading
+        self.reads = 0
+        self.fixes = 0
+
+        # a latency_metrics.LatencyMetrics records the time to read a position and between positions
+        self.metrics = metrics
+        self.last_fix = None
+
+        # a positioning_reader.PositioningReader reads more fields than the position in the same call,
+        # the latest are in self.reader.last()
+        self.reader = None if fields is None else PositioningReader(pozyx, ["position"] + list(fields))
+
+        # the position is read into the same objects every time
+        self.position = Coordinates()
+        self.position_data = PositioningData(0b1)
+
     def setup(self):
+        if self.event_driven:
+            self.readInterval()
         self.get_position()
 
+    def readInterval(self):
+        """Reads the POSITIONING_INTERVAL of the tag, the time between two positions"""
+        interval = SingleRegister(size=2)
+        if self.pozyx.getUpdateInterval(interval) == POZYX_SUCCESS:
+            self.interval = interval.value / 1000.0
+            if self.interval > 0:
+                # polling more than a few times per position gains nothing
+                self.max_poll_delay = min(self.max_poll_delay, self.interval / 4)
+
+    def waitForPosition(self):
+        """Sleeps until the tag reports a new position, returns False when none came"""
+        now = time()
+        if now < self.next_read:
+            sleep(self.next_read - now)
+        interrupt = SingleRegister()
+        deadline = time() + (2 * self.interval if self.interval > 0 else 1.0)
+        while True:
+            self.reads += 1
+            status = self.pozyx.getInterruptStatus(interrupt)
+            if status == POZYX_SUCCESS and interrupt[0] & PozyxBitmasks.INT_STATUS_POS:
+                self.poll_delay = self.min_poll_delay
+                return True
+            if time() > deadline:
+                return False
+            # back off while nothing happens, a position is rarely late
+            sleep(self.poll_delay)
+            self.poll_delay = min(2 * self.poll_delay, self.max_poll_delay)
+
     def get_position(self):
-        position = Coordinates()
-        position_data = PositioningData(0b1)
-        status = self.pozyx.getPositioningData(position_data)
+        if self.event_driven and not self.waitForPosition():
+            return
+        position = self.position
+        self.reads += 1
+        start = perf_counter()
+        if self.reader is not None:
+            status = self.reader.read()
+        else:
+            status = self.pozyx.getPositioningData(self.position_data)
+        if self.metrics is not None and status == POZYX_SUCCESS:
+            self.metrics.since("positioning", start)
+        if self.event_driven and self.interval > 0:
+            # the next position won't be there before the interval has almost passed
+            self.next_read = time() + 0.9 * self.interval
         if status == POZYX_SUCCESS:
-            position.load_bytes(position_data.byte_data)
+            if self.reader is not None:
+                row = self.reader.last()
+                position.x, position.y, position.z = int(row["x"]), int(row["y"]), int(row["z"])
+            else:
+                position.load_bytes(self.position_data.byte_data)
             if self.x != position.x or self.y != position.y or self.z != position.z:
                 self.x = position.x
                 self.y = position.y
                 self.z = position.z
                 self.latency = ceil((time() - self.time_before) * 1000)
+                self.fixes += 1
+                if self.metrics is not None:
+                    now = perf_counter()
+                    if self.last_fix is not None:
+                        self.metrics.record("interval", now - self.last_fix)
+                    self.last_fix = now
                 self.printPublishPosition(position, self.latency)
                 self.time_before = time()
 
@@ -54,8 +134,20 @@ if __name__ == '__main__':
     # do positioning if needed
     position = False
 
+    # wait for the positioning interrupt instead of reading the position continuously
+    event_driven = True
+
+    # positioning data fields to read along with the position, see positioning_reader.FIELDS
+    fields = None
+
+    # print the latency percentiles every 10 seconds
+    use_metrics = False
+    metrics = LatencyMetrics() if use_metrics else None
+    if use_metrics:
+        metrics.startDump(10.0)
+
     # create current position object
-    current_position = CurrentPosition(pozyx)
+    current_position = CurrentPosition(pozyx, event_driven, metrics=metrics, fields=fields)
 
     # get position
     current_position.setup()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Publishes MQTT messages from a background thread, so a slow broker never stalls the positioning loop.
+
+Messages wait in a bounded queue. When the broker can't keep up the oldest messages are dropped,
+a stale position is worth less than a fresh one. Several messages for the same topic can be
+combined into one MQTT message holding a JSON list.
+"""
+import json
+import threading
+from collections import deque
+from itertools import cycle
+from time import perf_counter, sleep
+
+from fix_record import FixRecord
+
+
+class QueuedMessage(object):
+    """A message waiting in the queue, filled in place"""
+    __slots__ = ("topic", "object", "queued_at")
+
+    def __init__(self):
+        self.topic = None
+        self.object = None
+        self.queued_at = 0.0
+
+
+class MqttPublisher(object):
+    """Publishes JSON objects to an MQTT client from a background thread"""
+
+    def __init__(self, client, prefix="zwerm3", queue_size=256, batch_size=1, batch_interval=0.0, qos=0,
+                 encoder=None, metrics=None):
+        """
+        Args:
+            client: a connected paho client, or anything with a publish(topic, payload, qos) method.
+            prefix (optional): prepended to every topic.
+            queue_size (optional): messages kept while the broker is slow, older ones are dropped.
+            batch_size (optional): number of messages combined into one, 1 publishes every message as is.
+            batch_interval (optional): seconds to wait for a batch to fill up before publishing it anyway,
+                0 waits until it is full.
+            qos (optional): MQTT quality of service of the messages.
+            encoder (optional): turns a list of objects into a payload, like position_codec.encode.
+                Without one every object is published as JSON.
+            metrics (optional): a latency_metrics.LatencyMetrics, records the time every message spent
+                queued as the publish stage, per topic.
+        """
+        self.client = client
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.qos = qos
+        self.encoder = encoder
+        self.metrics = metrics
+
+        # deque drops from the other end once it is full, the messages it holds come from a ring with
+        # one more than it, so a message is only filled again after it left the queue
+        self.queue = deque(maxlen=queue_size)
+        self.messages_ring = [QueuedMessage() for _ in range(queue_size + 1)]
+        self.next_message = cycle(self.messages_ring).__next__
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        # whether the thread waits for messages, notifying a condition nobody waits on still allocates
+        self.waiting = False
+        self.thread = None
+        self.running = False
+
+        self.taken = 0
+        self.published = 0
+        self.dropped = 0
+        self.messages = 0
+        self.errors = 0
+
+    def start(self):
+        """Starts the network loop of the client and the publishing thread"""
+        if self.running:
+            return
+        if hasattr(self.client, "loop_start"):
+            self.client.loop_start()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="mqtt_publisher", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=1.0):
+        """Publishes what is still queued and stops the thread and the network loop"""
+        if not self.running:
+            return
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join(timeout)
+        if hasattr(self.client, "loop_stop"):
+            self.client.loop_stop()
+
+    def publish(self, topic, object):
+        """Queues an object to be published as JSON, never blocks and allocates nothing"""
+        # acquire and release instead of a with block, which makes a new bound __exit__ every call
+        self.lock.acquire()
+        try:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            # counted when taken, a growing count would make a new int for every message here
+            message = self.next_message()
+            message.topic = topic
+            message.object = object
+            message.queued_at = perf_counter()
+            self.queue.append(message)
+            if self.waiting and len(self.queue) >= self.batch_size:
+                self.waiting = False
+                self.condition.notify()
+        finally:
+            self.lock.release()
+
+    @property
+    def queued(self):
+        return self.taken + self.dropped + len(self.queue)
+
+    def pending(self):
+        return len(self.queue)
+
+    def take(self):
+        """The oldest queued message, a FixRecord is copied before it is filled again"""
+        message = self.queue.popleft()
+        self.taken += 1
+        object = message.object
+        if isinstance(object, FixRecord):
+            object = object.snapshot()
+        return message.topic, object, message.queued_at
+
+    def run(self):
+        while True:
+            with self.condition:
+                if self.running and len(self.queue) < self.batch_size:
+                    self.waiting = True
+                    self.condition.wait(self.batch_interval if self.batch_interval > 0 else None)
+                    self.waiting = False
+                if not self.queue:
+                    if not self.running:
+                        return
+                    continue
+                batch = [self.take() for _ in range(min(self.batch_size, len(self.queue)))]
+            try:
+                self.send(batch)
+            except Exception as error:
+                # a message that can't be encoded or sent must not stop the ones after it
+                self.errors += 1
+                print("Error publishing MQTT message: %s" % error)
+                continue
+            if self.metrics is not None:
+                now = perf_counter()
+                for topic, _, queued_at in batch:
+                    self.metrics.record("publish", now - queued_at, topic)
+
+    def send(self, batch):
+        """Publishes a batch, combining the objects of the same topic into one JSON list"""
+        if self.encoder is not None:
+            self.sendEncoded(batch)
+            return
+        if self.batch_size == 1:
+            for topic, object, _ in batch:
+                self.sendMessage(topic, json.dumps(object), 1)
+            return
+        topics = {}
+        for topic, object, _ in batch:
+            topics.setdefault(topic, []).append(object)
+        for topic, objects in topics.items():
+            self.sendMessage(topic, json.dumps(objects), len(objects))
+
+    def sendEncoded(self, batch):
+        topics = {}
+        for topic, object, _ in batch:
+            topics.setdefault(topic, []).append(object)
+        for topic, objects in topics.items():
+            if isinstance(objects[0], dict):
+                # events like those of the geofence stay JSON next to the encoded positions
+                self.sendMessage(topic, json.dumps(objects if self.batch_size > 1 else objects[0]), len(objects))
+            else:
+                self.sendMessage(topic, self.encoder(objects), len(objects))
+
+    def sendMessage(self, topic, payload, count):
+        self.client.publish(f"{self.prefix}/{topic}", payload, qos=self.qos)
+        self.published += count
+        self.messages += 1
+
+    def printStats(self):
+        print("MQTT queued: {}, published: {} in {} messages, dropped: {}, errors: {}, pending: {}".format(
+            self.queued, self.published, self.messages, self.dropped, self.errors, self.pending()))
+
+
+if __name__ == "__main__":
+    # publishes fixes at 100Hz through a broker that takes 20ms per message
+
+    class SlowMqttClient(object):
+        """Stands in for a paho client connected to a slow broker"""
+
+        def __init__(self, delay):
+            self.delay = delay
+            self.payloads = []
+
+        def publish(self, topic, payload=None, qos=0, retain=False):
+            sleep(self.delay)
+            self.payloads.append(payload)
+
+    rate = 100
+    duration = 2
+    broker_delay = 0.02
+
+    for batch_size in [1, 10]:
+        client = SlowMqttClient(broker_delay)
+        publisher = MqttPublisher(client, queue_size=64, batch_size=batch_size, batch_interval=0.05)
+        publisher.start()
+        longest = 0
+        start = perf_counter()
+        for i in range(rate * duration):
+            before = perf_counter()
+            publisher.publish("position", {"x": i, "y": 2 * i, "z": 1000, "lat": 10})
+            longest = max(longest, perf_counter() - before)
+            sleep(max(0, start + (i + 1) / rate - perf_counter()))
+        publisher.stop()
+        print("Batch size %i, longest publish call: %.3fms" % (batch_size, longest * 1000))
+        publisher.printStats()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Positions tags on the host from raw ranges, instead of on the tags with doPositioning.
+
+Multilateration solves a whole batch of tags at once with NumPy: a linearized least squares
+estimate of x and y, followed by a few Gauss-Newton iterations on the distances themselves. Ranges
+are given as an array with a row per tag and a column per anchor, in mm, with NaN for the anchors a
+tag didn't (or shouldn't) range with. That leaves the choice of anchors to the host.
+
+HostPositioning collects the ranges of a set of tags with doRanging and positions them all in one go.
+"""
+from time import perf_counter
+
+import numpy as np
+from pypozyx import Coordinates, DeviceRange, PozyxConstants, POZYX_SUCCESS
+
+
+class Multilateration(object):
+    """Solves the positions of many tags from their ranges to a fixed set of anchors"""
+
+    def __init__(self, anchors, dimension=PozyxConstants.DIMENSION_3D, height=1000, iterations=5,
+                 tolerance=1.0, damping=1e-3):
+        """
+        Args:
+            anchors: DeviceCoordinates of the anchors, in the order of the range columns.
+            dimension (optional): in 3D the height is solved too, otherwise it stays at height.
+            height (optional): height of the tags in mm. In 3D it is the starting point of the height,
+                which picks the side of the anchor plane when the anchors are (nearly) at the same height.
+            iterations (optional): maximum number of Gauss-Newton iterations.
+            tolerance (optional): stop iterating once no tag moves more than this many mm.
+            damping (optional): keeps the Gauss-Newton steps finite for badly placed anchors.
+        """
+        self.anchor_ids = [anchor.network_id for anchor in anchors]
+        self.anchors = np.array([[anchor.pos.x, anchor.pos.y, anchor.pos.z] for anchor in anchors], dtype=float)
+        self.solve_height = dimension == PozyxConstants.DIMENSION_3D
+        self.height = height
+        self.iterations = iterations
+        self.tolerance = tolerance
+        self.damping = damping
+        # rows of the linear system in x, y and x² + y², the same for every tag
+        self.linear = np.column_stack([-2 * self.anchors[:, 0], -2 * self.anchors[:, 1], np.ones(len(anchors))])
+
+    def solve(self, ranges, heights=None):
+        """
+        Args:
+            ranges: array of shape (tags, anchors) in mm, NaN where there is no range.
+            heights (optional): starting (or fixed) height per tag, like the previous solution.
+
+        Returns:
+            positions of shape (tags, 3), the RMS range residual per tag in mm and whether each tag
+            had enough ranges to be solved. Positions of tags that couldn't be solved are NaN.
+        """
+        ranges = np.atleast_2d(np.asarray(ranges, dtype=float))
+        weights = np.isfinite(ranges).astype(float)
+        ranges = np.where(weights > 0, ranges, 0.0)
+        valid = weights.sum(axis=1) >= 3
+
+        if heights is None:
+            heights = np.full(len(ranges), float(self.height))
+        positions = self.linearSolve(ranges, weights, np.asarray(heights, dtype=float))
+        positions, residuals = self.refine(positions, ranges, weights)
+
+        positions[~valid] = np.nan
+        residuals[~valid] = np.nan
+        return positions, residuals, valid
+
+    def linearSolve(self, ranges, weights, heights):
+        """x and y from the ranges squared, with the height of every tag fixed"""
+        # r² = (x - ax)² + (y - ay)² + (z - az)², moved around to be linear in x, y and x² + y²
+        rhs = (ranges ** 2 - self.anchors[:, 0] ** 2 - self.anchors[:, 1] ** 2 -
+               (heights[:, None] - self.anchors[:, 2]) ** 2)
+        normal = np.einsum('tn,ni,nj->tij', weights, self.linear, self.linear)
+        projected = np.einsum('tn,ni,tn->ti', weights, self.linear, rhs)
+        # the pseudo-inverse copes with tags that miss too many ranges, they're marked invalid anyway
+        solution = np.einsum('tij,tj->ti', np.linalg.pinv(normal), projected)
+        return np.column_stack([solution[:, 0], solution[:, 1], heights])
+
+    def refine(self, positions, ranges, weights):
+        """Gauss-Newton on the distances, for all tags at once"""
+        identity = self.damping * np.eye(3)
+        for _ in range(self.iterations):
+            offsets = positions[:, None, :] - self.anchors[None, :, :]
+            distances = np.maximum(np.linalg.norm(offsets, axis=2), 1.0)
+            jacobian = offsets / distances[:, :, None]
+            if not self.solve_height:
+                jacobian[:, :, 2] = 0.0
+            errors = weights * (ranges - distances)
+            normal = np.einsum('tni,tn,tnj->tij', jacobian, weights, jacobian) + identity
+            step = np.linalg.solve(normal, np.einsum('tni,tn->ti', jacobian, errors)[:, :, None])[:, :, 0]
+            positions = positions + step
+            if np.all(np.abs(step) < self.tolerance):
+                break
+        distances = np.linalg.norm(positions[:, None, :] - self.anchors[None, :, :], axis=2)
+        counts = np.maximum(weights.sum(axis=1), 1)
+        residuals = np.sqrt((weights * (ranges - distances) ** 2).sum(axis=1) / counts)
+        return positions, residuals
+
+
+class HostPositioning(object):
+    """Ranges every tag with the anchors and positions all tags at once on the host"""
+
+    def __init__(self, pozyx, tag_ids, anchors, dimension=PozyxConstants.DIMENSION_3D, height=1000):
+        self.pozyx = pozyx
+        self.tag_ids = tag_ids
+        self.anchors = anchors
+        self.solver = Multilateration(anchors, dimension, height)
+        self.ranges = np.full((len(tag_ids), len(anchors)), np.nan)
+        self.heights = np.full(len(tag_ids), float(height))
+        self.solve_time = 0.0
+
+    def collectRanges(self):
+        """Fills self.ranges, NaN where ranging failed"""
+        device_range = DeviceRange()
+        for row, tag_id in enumerate(self.tag_ids):
+            for column, anchor in enumerate(self.anchors):
+                if self.pozyx.doRanging(anchor.network_id, device_range, tag_id) == POZYX_SUCCESS:
+                    self.ranges[row, column] = device_range.distance
+                else:
+                    self.ranges[row, column] = np.nan
+        return self.ranges
+
+    def loop(self):
+        """Ranges all tags, then positions and prints them"""
+        self.collectRanges()
+        start = perf_counter()
+        positions, residuals, valid = self.solver.solve(self.ranges, self.heights)
+        self.solve_time += perf_counter() - start
+        for row, tag_id in enumerate(self.tag_ids):
+            if valid[row]:
+                # the next frame starts from the height found now
+                self.heights[row] = positions[row, 2]
+                x, y, z = (int(round(value)) for value in positions[row])
+                self.printPublishPosition(Coordinates(x, y, z), tag_id)
+            else:
+                print("Error positioning on ID %s, not enough ranges" % ("0x%0.4x" % (tag_id or 0)))
+
+    def printPublishPosition(self, position, network_id):
+        if network_id is None:
+            network_id = 0
+        print("POS ID: {}, x(mm): {}, y(mm): {}, z(mm): {}".format("0x%0.4x" % network_id,
+                                                                   position.x, position.y, position.z))
+
+
+if __name__ == "__main__":
+    # solves batches of noisy ranges and compares the solver with a tag at a time
+    from pypozyx import DeviceCoordinates
+
+    anchors = [DeviceCoordinates(0xa000, 1, Coordinates(0, 0, 2500)),
+               DeviceCoordinates(0x6968, 1, Coordinates(0, 3100, 2500)),
+               DeviceCoordinates(0x6945, 1, Coordinates(1900, 0, 2500)),
+               DeviceCoordinates(0x696b, 1, Coordinates(1900, 3100, 2500)),
+               DeviceCoordinates(0x6951, 1, Coordinates(950, 1550, 200))]
+    range_noise = 50
+    repetitions = 20
+
+    solver = Multilateration(anchors)
+    random = np.random.default_rng(1)
+    for number_of_tags in [1, 10, 100, 1000]:
+        truth = random.uniform([0, 0, 500], [1900, 3100, 1800], size=(number_of_tags, 3))
+        ranges = np.linalg.norm(truth[:, None, :] - solver.anchors[None, :, :], axis=2)
+        ranges += random.normal(0, range_noise, ranges.shape)
+
+        start = perf_counter()
+        for _ in range(repetitions):
+            positions, residuals, valid = solver.solve(ranges)
+        batched = (perf_counter() - start) / repetitions
+
+        start = perf_counter()
+        for row in range(min(number_of_tags, 100)):
+            solver.solve(ranges[row:row + 1])
+        single = (perf_counter() - start) / min(number_of_tags, 100)
+
+        error = np.linalg.norm(positions - truth, axis=1)
+        print("{} tags: {:.3f}ms per batch, {:.1f}us per tag batched, {:.1f}us per tag one by one, "
+              "median error {:.0f}mm".format(number_of_tags, batched * 1000, batched / number_of_tags * 1e6,
+                                             single * 1e6, np.median(error)))
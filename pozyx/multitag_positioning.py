@@ -7,23 +7,67 @@ This tutorial requires at least the contents of the Pozyx Ready to Localize kit.
 of the Pozyx device both locally and remotely. Follow the steps to correctly set up your environment in the link, change the
 parameters and upload this sketch. Watch the coordinates change as you move your device around!
 """
-from time import sleep, time
+from time import perf_counter, sleep, time
 from math import ceil
 from pypozyx import (PozyxConstants, Coordinates, POZYX_SUCCESS, PozyxRegisters, version,
                      DeviceCoordinates, PozyxSerial, get_first_pozyx_serial_port, SingleRegister)
 from pypozyx.tools.version_check import perform_latest_version_check
 
+from multitag_scheduler import MultitagScheduler
+from tracking_filter import KalmanFilterBank
+from latency_metrics import LatencyHistogram, LatencyMetrics
+from position_store import PositionStore
+from osc_output import OscOutput
+from device_health import DeviceSupervisor
+
 
 class MultitagPositioning(object):
     """Continuously performs multitag positioning"""
 
     def __init__(self, pozyx, tag_ids, anchors, log_tag_ids,
                  calculate_latency, latency_tag,
-                 latency_samples):
+                 latency_samples, scheduled=False, tag_weights=None, tracking_filter=None,
+                 metrics=None, frame_assembler=None, position_store=None, geofence=None, anchor_subsets=None,
+                 osc_output=None, supervisor=None):
         self.pozyx = pozyx
         self.tag_ids = tag_ids
         self.anchors = anchors
 
+        # a tracking_filter.KalmanFilterBank smooths the positions of all tags of a loop at once
+        self.tracking_filter = tracking_filter
+
+        # a frame_assembler.FrameAssembler combines the positions of all tags into frames at a fixed rate
+        self.frame_assembler = frame_assembler
+
+        # a position_store.PositionStore keeps the history of the positions on disk
+        self.position_store = position_store
+        self.last_stored = {}
+
+        # an osc_output.OscOutput sends the positions of every loop as OSC bundles, to the ESP32 nodes
+        self.osc_output = osc_output
+
+        # a geofence.Geofence turns the positions into enter, exit and dwell events of zones
+        self.geofence = geofence
+
+        # an anchor_selection.AnchorSubsets gives every tag the anchors that suit where it is, the
+        # subsets are pushed between positionings
+        self.anchor_subsets = anchor_subsets
+
+        # a device_health.DeviceSupervisor backs off failing tags, reconnects the serial port and
+        # configures tags that reset again with configureTag, instead of reading error codes on every failure
+        self.supervisor = supervisor
+        if supervisor is not None and supervisor.provision is None:
+            supervisor.provision = self.configureTag
+
+        # a latency_metrics.LatencyMetrics records the positioning latency and the interval of every tag
+        self.metrics = metrics
+        self.last_fix = {}
+
+        # scheduled positioning gives the tags slots by weight and speed instead of one each per loop
+        self.scheduler = None
+        if scheduled:
+            self.scheduler = MultitagScheduler(pozyx, tag_ids, weights=tag_weights, metrics=metrics)
+
         # logging
         self.log_tag_ids = log_tag_ids
 
@@ -31,7 +75,7 @@ class MultitagPositioning(object):
         self.time_before = time()
         self.calculate_latency = calculate_latency
         self.latency_tag = latency_tag
-        self.latency_table = []
+        self.latency_histogram = LatencyHistogram()
         self.latency_samples = latency_samples
 
     def setup(self):
@@ -53,31 +97,131 @@ class MultitagPositioning(object):
 
     def loop(self):
         """Performs positioning and prints the results."""
-        for tag_id in self.tag_ids:
-            position = Coordinates()
-            status = self.pozyx.doPositioning(
-                position, height=2500, remote_id=tag_id)
+        received = {}
+        if self.supervisor is not None and not self.supervisor.maintain():
+            # no tag can be positioned without the serial link
+            self.supervisor.wait()
+            return
+        if self.scheduler is not None:
+            results = self.scheduler.step()
+            now = perf_counter()
+            received = {tag_id: now for tag_id, _, _ in results}
+        else:
+            results = []
+            for tag_id in self.tag_ids:
+                if self.supervisor is not None and not self.supervisor.due(tag_id):
+                    continue
+                position = Coordinates()
+                start = perf_counter()
+                status = self.pozyx.doPositioning(
+                    position, height=2500, remote_id=tag_id)
+                received[tag_id] = perf_counter()
+                if self.metrics is not None and status == POZYX_SUCCESS:
+                    self.metrics.record("positioning", received[tag_id] - start, tag_id)
+                results.append((tag_id, status, position))
+            if self.supervisor is not None and len(results) == 0:
+                self.supervisor.wait()
+        if self.tracking_filter is not None:
+            self.filterPositions(results)
+        if self.osc_output is not None:
+            # before anything else, this is what the nodes wait for
+            for tag_id, status, position in results:
+                if status == POZYX_SUCCESS:
+                    self.osc_output.update(tag_id, position.x, position.y, position.z)
+            self.osc_output.send()
+        for tag_id, status, position in results:
+            self.handlePosition(tag_id, status, position)
+        if self.anchor_subsets is not None:
+            for tag_id, status, position in results:
+                if status == POZYX_SUCCESS:
+                    self.anchor_subsets.update(tag_id, position.x, position.y)
+        if self.position_store is not None:
+            self.storePositions(results)
+        if self.geofence is not None:
+            for tag_id, status, position in results:
+                if status == POZYX_SUCCESS:
+                    for event in self.geofence.update(tag_id, position.x, position.y):
+                        self.handleGeofenceEvent(event)
+        if self.frame_assembler is not None:
+            for tag_id, status, position in results:
+                if status == POZYX_SUCCESS:
+                    self.frame_assembler.add(tag_id, position.x, position.y, position.z, received[tag_id])
+            for frame in self.frame_assembler.frames():
+                self.handleFrame(frame)
+
+    def close(self):
+        """Writes the positions that are still in memory to the store"""
+        if self.position_store is not None:
+            self.position_store.close()
+        if self.osc_output is not None:
+            self.osc_output.close()
+
+    def storePositions(self, results):
+        """Appends the successful positions to the store, with the ms since the previous one of the tag"""
+        now = time()
+        for tag_id, status, position in results:
             if status == POZYX_SUCCESS:
-                # if we need to calculate the latency
-                if self.calculate_latency == True:
-                    if tag_id == self.latency_tag and len(self.latency_table) >= self.latency_samples:
-                        print("Latency for tag {} with {} samples is now {}ms.".format(
-                            hex(self.latency_tag), self.latency_samples, ceil((sum(self.latency_table) / len(self.latency_table)) * 1000)))
-                        self.latency_table = []
-                    elif tag_id == self.latency_tag:
-                        current_time = time()
-                        self.latency_table.append(
-                            current_time - self.time_before)
-                        self.time_before = current_time
-                # if we just want to publish the position
-                else:
-                    if len(self.log_tag_ids) == 0 or tag_id in self.log_tag_ids:
-                        self.printPublishPosition(position, tag_id)
+                latency = (now - self.last_stored[tag_id]) * 1000 if tag_id in self.last_stored else 0.0
+                self.position_store.append(tag_id, now, position.x, position.y, position.z, latency)
+                self.last_stored[tag_id] = now
+
+    def handleGeofenceEvent(self, event):
+        """Prints a tag entering, leaving or staying in a zone"""
+        kind, tag_id, zone_id, _ = event
+        print("GEOFENCE ID: {}, {} zone {}".format("0x%0.4x" % (tag_id or 0), kind, zone_id))
+
+    def handleFrame(self, frame):
+        """Prints a frame with the positions of all tags at one moment"""
+        print(frame)
+
+    def filterPositions(self, results):
+        """Replaces the positions of the successful results by the filtered ones"""
+        successes = [(tag_id, position) for tag_id, status, position in results if status == POZYX_SUCCESS]
+        if not successes:
+            return
+        filtered, _ = self.tracking_filter.update([tag_id for tag_id, _ in successes],
+                                                  [(position.x, position.y, position.z) for _, position in successes],
+                                                  time())
+        for (_, position), (x, y, z) in zip(successes, filtered):
+            position.x, position.y, position.z = int(round(x)), int(round(y)), int(round(z))
+
+    def handlePosition(self, tag_id, status, position):
+        """Handles the positioning result of a single tag."""
+        if self.supervisor is not None:
+            self.supervisor.record(tag_id, status)
+        if status == POZYX_SUCCESS:
+            if self.metrics is not None:
+                now = perf_counter()
+                if tag_id in self.last_fix:
+                    self.metrics.record("interval", now - self.last_fix[tag_id], tag_id)
+                self.last_fix[tag_id] = now
+            # if we need to calculate the latency
+            if self.calculate_latency == True:
+                if tag_id == self.latency_tag:
+                    current_time = time()
+                    self.latency_histogram.record(current_time - self.time_before)
+                    self.time_before = current_time
+                    if self.latency_histogram.count >= self.latency_samples:
+                        print("Latency for tag {} with {} samples is now p50: {}ms, p95: {}ms, p99: {}ms.".format(
+                            hex(self.latency_tag), self.latency_histogram.count,
+                            ceil(self.latency_histogram.percentile(0.5) * 1000),
+                            ceil(self.latency_histogram.percentile(0.95) * 1000),
+                            ceil(self.latency_histogram.percentile(0.99) * 1000)))
+                        self.latency_histogram.reset()
+            # if we just want to publish the position
             else:
-                self.printPublishErrorCode("positioning", tag_id)
+                if len(self.log_tag_ids) == 0 or tag_id in self.log_tag_ids:
+                    self.printPublishPosition(position, tag_id)
+        elif self.supervisor is not None:
+            # the supervisor reports what goes wrong, a tag that backs off isn't scheduled meanwhile
+            if self.scheduler is not None:
+                schedule = self.scheduler.tag(tag_id)
+                schedule.next_allowed = max(schedule.next_allowed, self.supervisor.health(tag_id).backoff_until)
+        else:
+            self.printPublishErrorCode("positioning", tag_id)
 
     def printPublishPosition(self, position, network_id):
-        """Prints the Pozyx's position and possibly sends it as a OSC packet"""
+        """Prints the Pozyx's position, the OSC output already sent it"""
         if network_id is None:
             network_id = 0
         s = "POS ID: {}, x(mm): {}, y(mm): {}, z(mm): {}".format("0x%0.4x" % network_id,
@@ -87,20 +231,27 @@ class MultitagPositioning(object):
     def setAnchorsManual(self, save_to_flash=False):
         """Adds the manually measured anchors to the Pozyx's device list one for one."""
         for tag_id in self.tag_ids:
-            status = self.pozyx.clearDevices(tag_id)
-            for anchor in self.anchors:
-                status &= self.pozyx.addDevice(anchor, tag_id)
-            if len(anchors) > 4:
-                status &= self.pozyx.setSelectionOfAnchors(PozyxConstants.ANCHOR_SELECT_AUTO, len(anchors),
-                                                           remote_id=tag_id)
-            # enable these if you want to save the configuration to the devices.
-            if save_to_flash:
-                self.pozyx.saveAnchorIds(tag_id)
-                self.pozyx.saveRegisters(
-                    [PozyxRegisters.POSITIONING_NUMBER_OF_ANCHORS], tag_id)
-
+            status = self.configureTag(tag_id, save_to_flash)
             self.printPublishConfigurationResult(status, tag_id)
 
+    def configureTag(self, tag_id, save_to_flash=False):
+        """Adds the anchors to the device list of one tag, also after the tag reset and lost them."""
+        status = self.pozyx.clearDevices(tag_id)
+        for anchor in self.anchors:
+            status &= self.pozyx.addDevice(anchor, tag_id)
+        if len(self.anchors) > 4:
+            status &= self.pozyx.setSelectionOfAnchors(PozyxConstants.ANCHOR_SELECT_AUTO, len(self.anchors),
+                                                       remote_id=tag_id)
+        if self.anchor_subsets is not None:
+            # the tag selects its anchors itself until its first position
+            self.anchor_subsets.reset(tag_id)
+        # enable these if you want to save the configuration to the devices.
+        if save_to_flash:
+            self.pozyx.saveAnchorIds(tag_id)
+            self.pozyx.saveRegisters(
+                [PozyxRegisters.POSITIONING_NUMBER_OF_ANCHORS], tag_id)
+        return status
+
     def printPublishConfigurationResult(self, status, tag_id):
         """Prints the configuration explicit result, prints and publishes error if one occurs"""
         if tag_id is None:
@@ -111,7 +262,7 @@ class MultitagPositioning(object):
             self.printPublishErrorCode("configuration", tag_id)
 
     def printPublishErrorCode(self, operation, network_id):
-        """Prints the Pozyx's error and possibly sends it as a OSC packet"""
+        """Prints the Pozyx's error"""
         error_code = SingleRegister()
         status = self.pozyx.getErrorCode(error_code, network_id)
         if network_id is None:
@@ -163,9 +314,38 @@ if __name__ == "__main__":
     latency_tag = 0x1000
     latency_samples = 50
 
+    # give fast moving tags and the tags in tag_weights more positionings than the others, instead of
+    # positioning every tag once per loop
+    scheduled = False
+    tag_weights = {}
+
+    # smooth the positions of all tags on this computer instead of with the filter of the Pozyx
+    use_tracking_filter = False
+    tracking_filter = KalmanFilterBank(measurement_noise=100) if use_tracking_filter else None
+
+    # keep the history of the positions in this directory, None to not keep it
+    history_directory = None
+    position_store = PositionStore(history_directory) if history_directory else None
+
+    # stream the positions as OSC to these (host, port) destinations, like the ESP32 nodes on port 8888
+    osc_destinations = []
+    osc_output = OscOutput(osc_destinations) if osc_destinations else None
+
+    # back off failing tags, reopen the serial port after a USB hiccup and configure tags that reset again
+    use_supervisor = True
+    supervisor = DeviceSupervisor(pozyx, tag_ids, find_port=get_first_pozyx_serial_port) if use_supervisor else None
+
+    # print the latency percentiles of every tag and stage every 10 seconds
+    use_metrics = False
+    metrics = LatencyMetrics() if use_metrics else None
+    if use_metrics:
+        metrics.startDump(10.0)
+
     # create a new multitag object
     r = MultitagPositioning(pozyx, tag_ids, anchors, log_tag_ids,
-                            calculate_latency, latency_tag, latency_samples)
+                            calculate_latency, latency_tag, latency_samples,
+                            scheduled, tag_weights, tracking_filter=tracking_filter, metrics=metrics,
+                            position_store=position_store, osc_output=osc_output, supervisor=supervisor)
 
     # setup the thingy
     r.setup()
@@ -173,9 +353,12 @@ if __name__ == "__main__":
     # check if we need to loop or not
     loop = True
 
-    # do the logic
-    if loop:
-        while True:
+    # do the logic, the history still in memory is written on Ctrl+C or an error too
+    try:
+        if loop:
+            while True:
+                r.loop()
+        else:
             r.loop()
-    else:
-        r.loop()
+    finally:
+        r.close()
@@ -0,0 +1,208 @@
+"""
+Weighted fair positioning of many remote tags through one Pozyx master.
+
+MultitagPositioning.loop positions every tag in turn, so every tag gets the
+same share of the master however fast it moves. The MultitagScheduler instead
+decides which tag goes next by weighted fair scheduling on per-tag virtual
+deadlines: a tag with weight w gets w times the slots of a tag with weight 1,
+tags that move faster get a higher weight, and a tag can be capped at the rate
+it's useful at. The rate every tag achieved is reported in Hz.
+
+The tags are positioned one at a time. The master has a single UWB radio and a
+single RX buffer, so results of overlapping requests on the shared channel
+overwrite each other and keeping several in flight doesn't raise the total rate.
+"""
+from time import perf_counter, sleep
+
+from pypozyx import Coordinates, PozyxConstants, POZYX_SUCCESS
+
+
+class TagSchedule(object):
+    """Scheduling state and statistics of a single tag"""
+
+    def __init__(self, tag_id, weight=1.0, max_rate=None):
+        self.tag_id = tag_id
+        self.base_weight = weight
+        self.weight = weight
+        self.max_rate = max_rate
+
+        # virtual deadline used for the weighted fair ordering
+        self.deadline = 0.0
+        self.next_allowed = 0.0
+
+        self.fixes = 0
+        self.failures = 0
+        self.latency = None
+        self.last_position = None
+        self.last_fix_time = None
+        self.speed = 0.0
+
+
+class MultitagScheduler(object):
+    """Positions the tags of one Pozyx master in weighted fair order
+
+    Args:
+        pozyx: PozyxSerial (or SimulatedPozyxSerial) of the master device.
+        tag_ids: IDs of the tags to position, None is the master itself.
+        weights (optional): dict of tag ID to base weight, 1.0 by default.
+        max_rates (optional): dict of tag ID to the highest useful rate in Hz.
+        speed_reference (optional): speed in mm/s that doubles a tag's weight, None disables it.
+        max_weight_boost (optional): the highest factor speed can multiply a weight with.
+        dimension (optional): the positioning dimension, as for doPositioning.
+        height (optional): the height in mm for 2.5D positioning, as for doPositioning.
+        algorithm (optional): the positioning algorithm, as for doPositioning.
+        timeout (optional): seconds to wait for a result, None uses the default of doPositioning.
+        metrics (optional): a latency_metrics.LatencyMetrics, records the positioning latency of every result.
+    """
+
+    def __init__(self, pozyx, tag_ids, weights=None, max_rates=None, speed_reference=1000.0, max_weight_boost=4.0,
+                 dimension=PozyxConstants.DIMENSION_3D, height=2500, algorithm=None, timeout=None, metrics=None):
+        self.pozyx = pozyx
+        weights = {} if weights is None else weights
+        max_rates = {} if max_rates is None else max_rates
+        self.tags = [TagSchedule(tag_id, weights.get(tag_id, 1.0), max_rates.get(tag_id))
+                     for tag_id in tag_ids]
+        self.speed_reference = speed_reference
+        self.max_weight_boost = max_weight_boost
+        self.dimension = dimension
+        self.height = height
+        self.algorithm = algorithm
+        self.timeout = timeout
+        self.metrics = metrics
+
+        self.virtual_time = 0.0
+        self.start_time = perf_counter()
+
+    def tag(self, tag_id):
+        for tag in self.tags:
+            if tag.tag_id == tag_id:
+                return tag
+
+    # scheduling
+
+    def step(self):
+        """Positions the tag that is due and returns its [(tag_id, status, position)], [] while all tags wait"""
+        now = perf_counter()
+        tag = self.nextTag(now)
+        if tag is None:
+            sleep(self.idleTime(now))
+            return []
+        self.advanceDeadline(tag, now)
+        position = Coordinates()
+        status = self.pozyx.doPositioning(position, self.dimension, self.height, self.algorithm,
+                                          remote_id=tag.tag_id, timeout=self.timeout)
+        self.finish(tag, status, position, now)
+        return [(tag.tag_id, status, position)]
+
+    def run(self, duration, callback=None):
+        """Runs the scheduler for duration seconds, calling callback(tag_id, status, position) per result"""
+        end = perf_counter() + duration
+        while perf_counter() < end:
+            for tag_id, status, position in self.step():
+                if callback is not None:
+                    callback(tag_id, status, position)
+
+    def nextTag(self, now):
+        """Picks the tag with the earliest virtual deadline of the ones allowed to go"""
+        candidates = [tag for tag in self.tags if tag.next_allowed <= now]
+        if len(candidates) == 0:
+            return None
+        return min(candidates, key=lambda tag: max(tag.deadline, self.virtual_time))
+
+    def idleTime(self, now):
+        return max(min(tag.next_allowed for tag in self.tags) - now, 0.0) if self.tags else \
+            PozyxConstants.DELAY_POLLING_FAST
+
+    def advanceDeadline(self, tag, now):
+        start = max(tag.deadline, self.virtual_time)
+        self.virtual_time = start
+        tag.deadline = start + 1.0 / tag.weight
+        if tag.max_rate:
+            tag.next_allowed = now + 1.0 / tag.max_rate
+
+    def finish(self, tag, status, position, started):
+        now = perf_counter()
+        if status != POZYX_SUCCESS:
+            tag.failures += 1
+            return
+        latency = now - started
+        tag.latency = latency if tag.latency is None else 0.9 * tag.latency + 0.1 * latency
+        if self.metrics is not None:
+            self.metrics.record("positioning", latency, tag.tag_id)
+        self.updateSpeed(tag, position, now)
+        tag.fixes += 1
+        tag.last_position = position
+        tag.last_fix_time = now
+
+    def updateSpeed(self, tag, position, now):
+        """Keeps a smoothed speed per tag and derives the tag's weight from it"""
+        if tag.last_position is None or self.speed_reference is None:
+            return
+        dt = now - tag.last_fix_time
+        if dt <= 0:
+            return
+        distance = ((position.x - tag.last_position.x) ** 2 + (position.y - tag.last_position.y) ** 2 +
+                    (position.z - tag.last_position.z) ** 2) ** 0.5
+        tag.speed = 0.8 * tag.speed + 0.2 * distance / dt
+        boost = min(1.0 + tag.speed / self.speed_reference, self.max_weight_boost)
+        tag.weight = tag.base_weight * boost
+
+    # reporting
+
+    def rates(self):
+        """Returns the achieved positioning rate in Hz per tag ID"""
+        elapsed = perf_counter() - self.start_time
+        return {tag.tag_id: tag.fixes / elapsed if elapsed > 0 else 0.0 for tag in self.tags}
+
+    def printRates(self):
+        rates = self.rates()
+        for tag in self.tags:
+            print("RATE ID: {}, {:.1f}Hz, weight: {:.2f}, failures: {}".format(
+                "0x%0.4x" % (tag.tag_id or 0), rates[tag.tag_id], tag.weight, tag.failures))
+
+
+if __name__ == "__main__":
+    # compares positioning every tag in turn with the scheduler on a simulated network
+    from simulated_pozyx import LatencyModel, SimulatedNetwork, SimulatedPozyxSerial, circle
+    from pypozyx import DeviceCoordinates
+
+    # latency of a single serial call in seconds, change to match your USB link
+    serial_round_trip = 0.001
+    duration = 3
+    tag_ids = [0x1000, 0x1001, 0x1002, 0x1003, 0x1004]
+    # 0x1000 counts double, 0x1004 is only useful up to 2Hz, 0x1001 walks and gets more slots for it
+    weights = {0x1000: 2.0}
+    max_rates = {0x1004: 2.0}
+
+    anchors = [DeviceCoordinates(0xa000, 1, Coordinates(0, 0, 2500)),
+               DeviceCoordinates(0x6968, 1, Coordinates(0, 3100, 2500)),
+               DeviceCoordinates(0x6945, 1, Coordinates(1900, 0, 2500)),
+               DeviceCoordinates(0x696b, 1, Coordinates(1900, 3100, 2500))]
+
+    network = SimulatedNetwork(LatencyModel(serial_round_trip=serial_round_trip))
+    for anchor in anchors:
+        network.addAnchor(anchor.network_id, (anchor.pos.x, anchor.pos.y, anchor.pos.z))
+    network.addTag(0x6000)
+    for index, tag_id in enumerate(tag_ids):
+        if tag_id == 0x1001:
+            network.addTag(tag_id, trajectory=circle((950, 1550, 1000), 800, 2.0))
+        else:
+            network.addTag(tag_id, (200 * index, 300 * index, 1000))
+    pozyx = SimulatedPozyxSerial(network, 0x6000)
+    for tag_id in tag_ids:
+        pozyx.configureAnchors(anchors, remote_id=tag_id)
+
+    print("Every tag in turn")
+    fixes = dict((tag_id, 0) for tag_id in tag_ids)
+    start = perf_counter()
+    while perf_counter() - start < duration:
+        for tag_id in tag_ids:
+            if pozyx.doPositioning(Coordinates(), height=2500, remote_id=tag_id) == POZYX_SUCCESS:
+                fixes[tag_id] += 1
+    for tag_id in tag_ids:
+        print("RATE ID: {}, {:.1f}Hz".format("0x%0.4x" % tag_id, fixes[tag_id] / duration))
+
+    print("Scheduler")
+    scheduler = MultitagScheduler(pozyx, tag_ids, weights=weights, max_rates=max_rates)
+    scheduler.run(duration)
+    scheduler.printRates()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+A load generator for OSC receivers, with a local stand-in for the loop of esp32/osc_esp32.
+
+The generator sends frames of tag positions at a fixed rate with an osc_output.OscOutput, either as
+bundles or as a datagram per position, and counts what the receiver handled: packets per second and
+the share of the positions that never arrived.
+
+DeviceStandIn receives on a UDP socket with a small receive buffer, like the few packet buffers of
+the WiFi stack of an ESP, and runs the loop of the sketch: the old one reads a single packet and
+then waits 16ms, the new one reads every waiting packet into one buffer and dispatches the messages
+through a routing table of address to handler.
+"""
+import socket
+import threading
+from time import perf_counter, sleep
+
+from osc_output import ADDRESS, OscOutput, decode_packet, send_messages
+
+
+class DeviceStandIn(object):
+    """Receives OSC like the ESP sketch, in a thread"""
+
+    def __init__(self, drain=True, loop_delay=0.0, receive_buffer=8192, max_packet=1472):
+        """
+        Args:
+            drain (optional): read every waiting packet per loop, instead of one.
+            loop_delay (optional): seconds the loop waits after reading, the old sketch waited 16ms.
+            receive_buffer (optional): bytes the socket buffers, the packet buffers of the ESP.
+            max_packet (optional): size of the buffer packets are read into.
+        """
+        self.drain = drain
+        self.loop_delay = loop_delay
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.settimeout(0.05)
+        self.buffer = bytearray(max_packet)
+        self.routes = {}
+        self.packets = 0
+        self.messages = 0
+        self.unrouted = 0
+        self.running = False
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.socket.getsockname()
+
+    def route(self, address, handler):
+        """Calls handler(arguments) for every message to address"""
+        self.routes[address] = handler
+
+    def receive(self):
+        """Reads and dispatches one packet, returns False when there was none"""
+        try:
+            size = self.socket.recv_into(self.buffer)
+        except (socket.timeout, BlockingIOError):
+            return False
+        self.packets += 1
+        for address, arguments in decode_packet(memoryview(self.buffer)[:size]):
+            self.messages += 1
+            handler = self.routes.get(address)
+            if handler is None:
+                self.unrouted += 1
+            else:
+                handler(arguments)
+        return True
+
+    def loop(self):
+        if self.drain:
+            self.socket.settimeout(0.05)
+            if self.receive():
+                self.socket.setblocking(False)
+                while self.receive():
+                    pass
+        else:
+            self.receive()
+        if self.loop_delay:
+            sleep(self.loop_delay)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            self.loop()
+
+    def stop(self):
+        # let it handle what is still waiting
+        sleep(0.1)
+        self.running = False
+        self.thread.join()
+        self.socket.close()
+
+
+def generate(destination, tags, rate, duration, bundles=True):
+    """
+    Sends frames of positions of tags to destination.
+
+    Returns:
+        the number of positions and datagrams sent.
+    """
+    output = OscOutput([destination])
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    interval = 1.0 / rate
+    frames = int(rate * duration)
+    start = perf_counter()
+    for frame in range(frames):
+        positions = [(0x1000 + tag, frame, tag, 1000) for tag in range(tags)]
+        if bundles:
+            output.sendPositions(positions)
+        else:
+            send_messages(sock, [destination], positions)
+        # busy waiting, sleep is too coarse for high rates
+        while perf_counter() - start < (frame + 1) * interval:
+            pass
+    sock.close()
+    output.close()
+    datagrams = output.sent if bundles else frames * tags
+    return frames * tags, datagrams
+
+
+if __name__ == "__main__":
+    # 20 tags at 10, 50 and 200 frames per second, to the old loop of the sketch with a message per
+    # datagram and to the new one with a message per datagram and with bundles
+    tags = 20
+    duration = 2.0
+
+    for rate in [10, 50, 200]:
+        for name, drain, delay, bundles in [("old loop, a datagram per position", False, 0.016, False),
+                                            ("new loop, a datagram per position", True, 0.0, False),
+                                            ("new loop, bundles", True, 0.0, True)]:
+            device = DeviceStandIn(drain=drain, loop_delay=delay)
+            received = {}
+            device.route(ADDRESS, lambda arguments: received.__setitem__(arguments[0], arguments))
+            device.route("/hello", lambda arguments: None)
+            device.start()
+            start = perf_counter()
+            positions, datagrams = generate(device.address, tags, rate, duration, bundles)
+            elapsed = perf_counter() - start
+            device.stop()
+            print("BENCH osc load {} frames/s, {}: {} datagrams sent, {:.0f} packets/s handled, "
+                  "{:.1%} of {} positions dropped, all tags seen: {}".format(
+                      rate, name, datagrams, device.packets / elapsed, 1 - device.messages / positions, positions,
+                      len(received) == tags))
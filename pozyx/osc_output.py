@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Streams positions as OSC over UDP, to the ESP32 OSC nodes in esp32/osc_esp32 or anything else that
+speaks OSC.
+
+Every position is an OSC message /position with four int32 arguments: tag id, x, y and z in mm.
+The messages of a frame go out together in OSC bundles, as few datagrams as fit the positions, with
+the timetag "immediately" so a receiver acts on them as they arrive.
+
+The datagrams are laid out once: when a tag shows up its message is encoded in full, address and
+type tags included, into the bundle with room left, and after that update() only writes the four
+arguments at their fixed offset with struct.pack_into. send() hands the bundles that changed to a
+non-blocking socket, for every destination, so encoding and sending a frame allocates nothing. A
+bundle always carries the latest position of all its tags, also of those that didn't move.
+
+Destinations are (host, port) pairs, resolved when the output is made. A multicast group as host
+reaches every node that joined it with a single send.
+"""
+import ipaddress
+import socket
+import struct
+from time import perf_counter
+
+
+ADDRESS = "/position"
+# the timetag 1 means immediately
+BUNDLE_HEADER = b"#bundle\0" + struct.pack(">II", 0, 1)
+SIZE = struct.Struct(">i")
+ARGUMENTS = struct.Struct(">iiii")
+
+# fits an Ethernet frame without fragmenting, and the receive buffer of the ESP32
+MAX_DATAGRAM = 1400
+
+
+def osc_string(value):
+    """An OSC string: the bytes, a zero and zeros up to a multiple of 4 bytes"""
+    encoded = value.encode("ascii") + b"\0"
+    return encoded + b"\0" * (-len(encoded) % 4)
+
+
+def encode_message(address, *arguments):
+    """Encodes a message with int32, float32 and string arguments, the way that allocates"""
+    tags = ","
+    data = b""
+    for argument in arguments:
+        if isinstance(argument, int):
+            tags += "i"
+            data += struct.pack(">i", argument)
+        elif isinstance(argument, float):
+            tags += "f"
+            data += struct.pack(">f", argument)
+        else:
+            tags += "s"
+            data += osc_string(argument)
+    return osc_string(address) + osc_string(tags) + data
+
+
+def read_string(data, offset):
+    end = data.index(b"\0", offset)
+    return data[offset:end].decode("ascii"), end + 1 + (-(end + 1 - offset) % 4)
+
+
+def decode_packet(data):
+    """The (address, arguments) of every message in a packet, bundles included"""
+    data = bytes(data)
+    if data[:8] == b"#bundle\0":
+        messages = []
+        offset = len(BUNDLE_HEADER)
+        while offset < len(data):
+            size, = SIZE.unpack_from(data, offset)
+            messages.extend(decode_packet(data[offset + SIZE.size:offset + SIZE.size + size]))
+            offset += SIZE.size + size
+        return messages
+    address, offset = read_string(data, 0)
+    tags, offset = read_string(data, offset)
+    arguments = []
+    for tag in tags[1:]:
+        if tag == "i":
+            arguments.append(struct.unpack_from(">i", data, offset)[0])
+            offset += 4
+        elif tag == "f":
+            arguments.append(struct.unpack_from(">f", data, offset)[0])
+            offset += 4
+        elif tag == "s":
+            value, offset = read_string(data, offset)
+            arguments.append(value)
+        else:
+            raise ValueError("Unsupported OSC type tag %s" % tag)
+    return [(address, arguments)]
+
+
+class OscOutput(object):
+    """Sends the positions of all tags as OSC bundles over UDP"""
+
+    def __init__(self, destinations, address=ADDRESS, max_datagram=MAX_DATAGRAM, multicast_ttl=1,
+                 multicast_loop=False):
+        """
+        Args:
+            destinations: (host, port) pairs, hosts can be multicast groups.
+            address (optional): the OSC address of the position messages.
+            max_datagram (optional): the most bytes a datagram holds, more tags take more bundles.
+            multicast_ttl (optional): the routers a multicast datagram may cross, 1 keeps it on the network.
+            multicast_loop (optional): whether this computer receives its own multicast datagrams.
+        """
+        self.destinations = []
+        multicast = False
+        for host, port in destinations:
+            host = socket.gethostbyname(host)
+            multicast |= ipaddress.ip_address(host).is_multicast
+            self.destinations.append((host, port))
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        if multicast:
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, multicast_ttl)
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, int(multicast_loop))
+
+        self.template = osc_string(address) + osc_string(",iiii")
+        self.element_size = SIZE.size + len(self.template) + ARGUMENTS.size
+        self.per_datagram = (max_datagram - len(BUNDLE_HEADER)) // self.element_size
+        if self.per_datagram < 1:
+            raise ValueError("A datagram of %i bytes can't hold a position" % max_datagram)
+        # tag id to (index of its datagram, offset of its arguments)
+        self.slots = {}
+        self.datagrams = []
+        self.changed = []
+        self.sent = 0
+        self.dropped = 0
+
+    def slot(self, tag_id):
+        """Lays out the message of a new tag, in the last bundle when it has room left"""
+        index = len(self.datagrams) - 1
+        if index < 0 or len(self.datagrams[index]) + self.element_size > len(BUNDLE_HEADER) + \
+                self.per_datagram * self.element_size:
+            self.datagrams.append(bytearray(BUNDLE_HEADER))
+            self.changed.append(False)
+            index += 1
+        datagram = self.datagrams[index]
+        datagram += SIZE.pack(len(self.template) + ARGUMENTS.size) + self.template
+        slot = self.slots[tag_id] = (index, len(datagram))
+        datagram += ARGUMENTS.pack(tag_id, 0, 0, 0)
+        return slot
+
+    def update(self, tag_id, x, y, z):
+        """Sets the position of a tag for the next send, in whole mm"""
+        tag_id = tag_id or 0
+        slot = self.slots.get(tag_id)
+        if slot is None:
+            slot = self.slot(tag_id)
+        ARGUMENTS.pack_into(self.datagrams[slot[0]], slot[1], tag_id, int(x), int(y), int(z))
+        self.changed[slot[0]] = True
+
+    def send(self):
+        """Sends the bundles with new positions to every destination, without waiting"""
+        for index in range(len(self.datagrams)):
+            if self.changed[index]:
+                self.changed[index] = False
+                datagram = self.datagrams[index]
+                for destination in self.destinations:
+                    try:
+                        self.socket.sendto(datagram, destination)
+                        self.sent += 1
+                    except (BlockingIOError, InterruptedError):
+                        # the socket buffer is full, the next frame replaces this one anyway
+                        self.dropped += 1
+
+    def sendPositions(self, positions):
+        """Sends a frame of (tag_id, x, y, z) positions"""
+        for tag_id, x, y, z in positions:
+            self.update(tag_id, x, y, z)
+        self.send()
+
+    def close(self):
+        self.socket.close()
+
+
+def send_messages(sock, destinations, positions, address=ADDRESS):
+    """A datagram with a freshly encoded message per position, what OscOutput saves"""
+    for tag_id, x, y, z in positions:
+        message = encode_message(address, tag_id, x, y, z)
+        for destination in destinations:
+            sock.sendto(message, destination)
+
+
+if __name__ == "__main__":
+    # sends frames of 20 and 100 tags to two local UDP listeners, checks what they decode and
+    # measures the time from a frame to its arrival, and the memory allocated per frame, compared
+    # with encoding a message per position
+    import threading
+    import tracemalloc
+
+    frames = 2000
+
+    def listen():
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        listener.bind(("127.0.0.1", 0))
+        listener.settimeout(0.5)
+        received = []
+
+        def receive():
+            while True:
+                try:
+                    data = listener.recv(65536)
+                except socket.timeout:
+                    return
+                received.append((perf_counter(), data))
+        thread = threading.Thread(target=receive)
+        thread.start()
+        return listener, thread, received
+
+    def positions(frame, tags):
+        return [(0x1000 + tag, 100 * frame + tag, -50 * frame, 1000 + tag) for tag in range(tags)]
+
+    for tags in [20, 100]:
+        listeners = [listen() for _ in range(2)]
+        destinations = [listener.getsockname() for listener, _, _ in listeners]
+        output = OscOutput(destinations)
+        sent_at = []
+        for frame in range(frames):
+            sent_at.append(perf_counter())
+            output.sendPositions(positions(frame, tags))
+            # a frame rate the listeners keep up with
+            while perf_counter() - sent_at[-1] < 0.0005:
+                pass
+
+        received = []
+        for listener, thread, messages in listeners:
+            thread.join()
+            listener.close()
+            received.append(messages)
+
+        # the latency of every datagram, the positions in it give its frame
+        latencies = []
+        correct = True
+        for messages in received:
+            decoded = {}
+            for arrival, data in messages:
+                for address, (tag_id, x, y, z) in decode_packet(data):
+                    frame = (x - (tag_id - 0x1000)) // 100
+                    correct &= address == ADDRESS and (tag_id, x, y, z) == positions(frame, tags)[tag_id - 0x1000]
+                    decoded[tag_id, frame] = True
+                latencies.append(arrival - sent_at[frame])
+            correct &= len(decoded) == tags * frames
+        latencies.sort()
+
+        # allocations of sending frames, a warm output so every tag has its slot
+        def measure(send):
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            start = perf_counter()
+            for frame in range(200):
+                send(frame)
+            elapsed = perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            return elapsed / 200, peak - before
+
+        frame_positions = [positions(frame, tags) for frame in range(200)]
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind(("127.0.0.1", 0))
+        sink.setblocking(False)
+        drain = [sink.getsockname()]
+
+        bundled = OscOutput(drain)
+        bundled.sendPositions(frame_positions[0])
+
+        def send_bundles(frame):
+            for tag_id, x, y, z in frame_positions[frame]:
+                bundled.update(tag_id, x, y, z)
+            bundled.send()
+        bundle_time, bundle_memory = measure(send_bundles)
+        bundle_datagrams = len(bundled.datagrams)
+        bundled.close()
+
+        def send_each(frame):
+            try:
+                send_messages(bundled_socket, drain, frame_positions[frame])
+            except BlockingIOError:
+                pass
+        bundled_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        bundled_socket.setblocking(False)
+        each_time, each_memory = measure(send_each)
+        bundled_socket.close()
+        sink.close()
+
+        print("BENCH osc {} tags: {} frames to {} listeners, decoded correctly: {}, {} datagrams sent, {} dropped, "
+              "latency p50 {:.0f}us, p99 {:.0f}us".format(
+                  tags, frames, len(destinations), correct, output.sent, output.dropped,
+                  latencies[len(latencies) // 2] * 1e6, latencies[int(0.99 * len(latencies))] * 1e6))
+        print("BENCH osc {} tags: bundles {:.0f}us per frame in {} datagrams, peak {} bytes allocated; "
+              "a message per position {:.0f}us per frame in {} datagrams, peak {} bytes allocated".format(
+                  tags, bundle_time * 1e6, bundle_datagrams, bundle_memory, each_time * 1e6, tags, each_memory))
+        output.close()
@@ -7,16 +7,27 @@ import time
 from math import ceil
 from pypozyx import (POZYX_POS_ALG_UWB_ONLY, POZYX_3D, Coordinates, POZYX_SUCCESS, PozyxConstants, version,
                      DeviceCoordinates, PozyxSerial, get_first_pozyx_serial_port, SingleRegister, DeviceList, PozyxRegisters,
-                     NetworkID)
+                     NetworkID, DeviceRange)
+from range_fusion import RangeFusion
+from fix_record import tune_gc
+from device_health import DeviceSupervisor
 
 class Position(object):
-    def __init__(self, pozyx, algorithm=POZYX_POS_ALG_UWB_ONLY, dimension=POZYX_3D, height=1000, remote_id=None):
+    def __init__(self, pozyx, algorithm=POZYX_POS_ALG_UWB_ONLY, dimension=POZYX_3D, height=1000, remote_id=None,
+                 range_fusion=None, supervisor=None):
       self.pozyx = pozyx
       self.algorithm = algorithm
       self.dimension = dimension
       self.height = height
       self.remote_id = remote_id
       self.network_id = self.getNetworkId()
+      # a range_fusion.RangeFusion ranges with one anchor per loop and positions on this computer instead
+      self.range_fusion = range_fusion
+      self.device_range = DeviceRange()
+      # positioned into by every loop, printPublishPosition gets the same object every time
+      self.position = Coordinates()
+      # a device_health.DeviceSupervisor backs off while positioning fails and reconnects the serial port
+      self.supervisor = supervisor
 
     def setup(self):
       self.getNetworkId()
@@ -38,16 +49,44 @@ class Position(object):
 
     def loop(self):
       """Performs positioning and displays/exports the results."""
-      position = Coordinates()
+      if self.supervisor is not None and not self.supervisor.ready(self.remote_id):
+        return
+      if self.range_fusion is not None and self.range_fusion.initialized:
+        self.rangingLoop()
+        return
+      position = self.position
       time_before = time.time()
       status = self.pozyx.doPositioning(
           position, self.dimension, self.height, self.algorithm, remote_id=self.remote_id)
       latency = ceil((time.time() - time_before) * 1000)
+      if self.supervisor is not None:
+        self.supervisor.record(self.remote_id, status)
       if status == POZYX_SUCCESS:
+        if self.range_fusion is not None:
+          # the first position starts the filter of the ranging mode
+          self.range_fusion.initialize((position.x, position.y, position.z), time.time())
         self.printPublishPosition(position, latency)
-      else:
+      elif self.supervisor is None:
           print("Something went wrong in positioning...")
 
+    def rangingLoop(self):
+      """Ranges with the next anchor and displays/exports the position the range leads to."""
+      anchor_index = self.range_fusion.nextAnchor()
+      time_before = time.time()
+      status = self.pozyx.doRanging(self.range_fusion.anchors[anchor_index].network_id, self.device_range,
+                                    remote_id=self.remote_id)
+      now = time.time()
+      latency = ceil((now - time_before) * 1000)
+      if self.supervisor is not None:
+        self.supervisor.record(self.remote_id, status)
+      if status == POZYX_SUCCESS:
+        (x, y, z), _ = self.range_fusion.update(anchor_index, self.device_range.distance, now)
+        position = self.position
+        position.x, position.y, position.z = int(round(x)), int(round(y)), int(round(z))
+        self.printPublishPosition(position, latency)
+      elif self.supervisor is None:
+          print("Something went wrong in ranging...")
+
     def printPublishPosition(self, position, latency):
       """Prints the Pozyx's position in mm"""
       print("POS ID {}: x: {pos.x}, y: {pos.y}, z: {pos.z}, lat: {latency}ms".format(
@@ -69,10 +108,27 @@ if __name__ == "__main__":
     # height of device, required in 2.5D positioning
     height = 2500
 
+    # range with one anchor per loop and estimate the position on this computer, for more positions per second
+    ranging_only = False
+    anchors = [DeviceCoordinates(0xa000, 1, Coordinates(0, 0, 2500)),
+               DeviceCoordinates(0x6968, 1, Coordinates(0, 3100, 2500)),
+               DeviceCoordinates(0x6945, 1, Coordinates(1900, 0, 2500)),
+               DeviceCoordinates(0x696b, 1, Coordinates(1900, 3100, 2500))]
+    range_fusion = RangeFusion(anchors, dimension, height) if ranging_only else None
+
     # create a new pozyx object
     pozyx = PozyxSerial(serial_port)
 
-    r = Position(pozyx, algorithm, dimension, height)
+    # back off while positioning fails and reopen the serial port after a USB hiccup
+    use_supervisor = True
+    supervisor = DeviceSupervisor(pozyx, [None], find_port=get_first_pozyx_serial_port) if use_supervisor else None
+
+    # collect garbage less often once set up, against latency spikes in long runs
+    use_tune_gc = False
+
+    r = Position(pozyx, algorithm, dimension, height, range_fusion=range_fusion, supervisor=supervisor)
     r.setup()
+    if use_tune_gc:
+      tune_gc()
     while True:
       r.loop()
\ No newline at end of file
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+A compact binary encoding for positions, as an alternative to a JSON object per position.
+
+A frame starts with a header and holds any number of fixes:
+
+    header: magic 'P' (uint8), version (uint8), number of fixes (uint16)
+    fix:    tag id (uint16), timestamp in seconds (float64), x, y, z in mm (int32), latency in ms (uint16)
+
+Everything is little-endian, a fix takes 24 bytes and a frame 4 bytes more.
+"""
+import json
+import struct
+from time import perf_counter, time
+
+MAGIC = 0x50
+VERSION = 1
+
+HEADER = struct.Struct('<BBH')
+FIX = struct.Struct('<HdiiiH')
+
+MAX_FIXES = 0xFFFF
+MAX_LATENCY = 0xFFFF
+
+
+def encode(fixes):
+    """Packs (tag_id, timestamp, x, y, z, latency) tuples into a single frame"""
+    count = len(fixes)
+    if count > MAX_FIXES:
+        raise ValueError("A frame holds at most %i fixes, not %i" % (MAX_FIXES, count))
+    frame = bytearray(HEADER.size + FIX.size * count)
+    HEADER.pack_into(frame, 0, MAGIC, VERSION, count)
+    offset = HEADER.size
+    for tag_id, timestamp, x, y, z, latency in fixes:
+        FIX.pack_into(frame, offset, tag_id or 0, timestamp, int(x), int(y), int(z),
+                      max(0, min(int(latency), MAX_LATENCY)))
+        offset += FIX.size
+    return bytes(frame)
+
+
+def decode(frame):
+    """Unpacks a frame into a list of (tag_id, timestamp, x, y, z, latency) tuples"""
+    if len(frame) < HEADER.size:
+        raise ValueError("Frame of %i bytes is too short" % len(frame))
+    magic, version, count = HEADER.unpack_from(frame, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a position frame, magic is 0x%0.2x" % magic)
+    if version != VERSION:
+        raise ValueError("Unsupported position frame version %i" % version)
+    end = HEADER.size + FIX.size * count
+    if len(frame) < end:
+        raise ValueError("Frame of %i bytes is too short for %i fixes" % (len(frame), count))
+    return list(FIX.iter_unpack(memoryview(frame)[HEADER.size:end]))
+
+
+if __name__ == "__main__":
+    # compares the JSON objects published now with binary frames
+    number_of_fixes = 10000
+    batch_size = 50
+
+    now = time()
+    fixes = [(0x1000 + i % 20, now + i * 0.01, 1000 + i, 2000 - i, 1500, 12) for i in range(number_of_fixes)]
+    objects = [{"x": x, "y": y, "z": z, "lat": latency} for _, _, x, y, z, latency in fixes]
+    batches = [fixes[i:i + batch_size] for i in range(0, number_of_fixes, batch_size)]
+    object_batches = [objects[i:i + batch_size] for i in range(0, number_of_fixes, batch_size)]
+
+    def measure(name, encoder, decoder, messages):
+        start = perf_counter()
+        payloads = [encoder(message) for message in messages]
+        encoding = perf_counter() - start
+        start = perf_counter()
+        for payload in payloads:
+            decoder(payload)
+        decoding = perf_counter() - start
+        size = sum(len(payload) for payload in payloads)
+        print("{}: encode {:.2f}us, decode {:.2f}us, {:.1f} bytes per fix".format(
+            name, encoding / number_of_fixes * 1e6, decoding / number_of_fixes * 1e6, size / number_of_fixes))
+
+    measure("JSON per fix", json.dumps, json.loads, objects)
+    measure("JSON batch of %i" % batch_size, json.dumps, json.loads, object_batches)
+    measure("binary per fix", lambda fix: encode([fix]), decode, fixes)
+    measure("binary batch of %i" % batch_size, encode, decode, batches)
@@ -4,30 +4,46 @@ Continuously calls the Pozyx positioning function and prints its position.
 """
 
 import time
-from time import sleep
-import json
+from time import perf_counter, sleep
 from math import ceil
 import paho.mqtt.client as paho
+from mqtt_publisher import MqttPublisher
+import position_codec
+from tracking_filter import KalmanFilterBank
+from latency_metrics import LatencyMetrics
+from position_store import PositionStore
 from pypozyx import (POZYX_POS_ALG_UWB_ONLY, POZYX_3D, Coordinates, POZYX_SUCCESS, PozyxConstants, version,
                      DeviceCoordinates, PozyxSerial, get_first_pozyx_serial_port, SingleRegister, DeviceList, PozyxRegisters,
-                     NetworkID)
-
-
-class Position:
-    def __init__(self, x, y, z, lat):
-        self.x = x
-        self.y = y
-        self.z = z
-        self.lat = lat
+                     NetworkID, DeviceRange)
+from range_fusion import RangeFusion
+from fix_record import FixRing, tune_gc
+from device_health import DeviceSupervisor
 
 
 class PositionMqtt(object):
-    def __init__(self, broker, port, pozyx, algorithm=POZYX_POS_ALG_UWB_ONLY, dimension=POZYX_3D, height=1000, remote_id=None):
-        # MQTT
+    def __init__(self, broker, port, pozyx, algorithm=POZYX_POS_ALG_UWB_ONLY, dimension=POZYX_3D, height=1000, remote_id=None,
+                 client=None, qos=0, queue_size=256, batch_size=1, batch_interval=0.0, binary=False,
+                 tracking_filter=None, metrics=None, position_store=None, geofence=None, range_fusion=None,
+                 supervisor=None):
+        # MQTT, pass a client to publish somewhere else than a broker
         self.broker = broker
         self.port = port
-        self.client = paho.Client('position_mqtt')
-        self.client.connect(broker, port)
+        self.client = client
+        if self.client is None:
+            self.client = paho.Client('position_mqtt')
+            self.client.connect(broker, port)
+
+        # publishing happens on a background thread, a batch_size above 1 publishes JSON lists of positions
+        # binary publishes position_codec frames on zwerm3/position/binary instead
+        self.binary = binary
+        encoder = position_codec.encode if binary else None
+        # a latency_metrics.LatencyMetrics records the positioning, publish and interval latencies
+        self.metrics = metrics
+        self.publisher = MqttPublisher(self.client, "zwerm3", queue_size, batch_size, batch_interval, qos, encoder,
+                                       metrics)
+        self.publisher.start()
+        # records of the positions waiting to be published, one more than the queue holds
+        self.fix_ring = FixRing(queue_size + 1, binary)
 
         # POZYX
         self.pozyx = pozyx
@@ -38,6 +54,24 @@ class PositionMqtt(object):
         self.network_id = self.getNetworkId()
         self.time_before = 0
 
+        # a range_fusion.RangeFusion ranges with one anchor per loop and positions on this computer instead
+        self.range_fusion = range_fusion
+        self.device_range = DeviceRange()
+        # positioned into by every loop
+        self.position = Coordinates()
+
+        # a tracking_filter.KalmanFilterBank smooths the positions before they are published
+        self.tracking_filter = tracking_filter
+
+        # a position_store.PositionStore keeps the history of the positions on disk
+        self.position_store = position_store
+
+        # a geofence.Geofence publishes enter, exit and dwell events of zones on zwerm3/geofence
+        self.geofence = geofence
+
+        # a device_health.DeviceSupervisor backs off while positioning fails and reconnects the serial port
+        self.supervisor = supervisor
+
     def setup(self):
         self.getNetworkId()
         self.printDeviceInfo()
@@ -46,7 +80,13 @@ class PositionMqtt(object):
         print("Connected with result code "+str(rc))
 
     def publishMqttObject(self, topic, object):
-        self.client.publish(f"zwerm3/{topic}", json.dumps(object))
+        self.publisher.publish(topic, object)
+
+    def close(self):
+        """Publishes the positions that are still queued and stops publishing"""
+        self.publisher.stop()
+        if self.position_store is not None:
+            self.position_store.flush()
 
     def getNetworkId(self):
         network_id = NetworkID()
@@ -66,18 +106,73 @@ class PositionMqtt(object):
     def loop(self):
         """Performs positioning and displays/exports the results."""
         if(self.time_before == 0):
-            self.time_before = time.time()
-        position = Coordinates()
+            self.time_before = perf_counter()
+        if self.supervisor is not None and not self.supervisor.ready(self.remote_id):
+            return
+        if self.range_fusion is not None and self.range_fusion.initialized:
+            self.rangingLoop()
+            return
+        position = self.position
+        start = perf_counter()
         status = self.pozyx.doPositioning(
             position, self.dimension, self.height, self.algorithm, remote_id=self.remote_id)
+        if self.supervisor is not None:
+            self.supervisor.record(self.remote_id, status)
         if status == POZYX_SUCCESS:
-            latency = ceil((time.time() - self.time_before) * 1000)
-            self.publishPosition(position, latency)
-            self.time_before = time.time()
+            if self.metrics is not None:
+                self.metrics.since("positioning", start, self.remote_id)
+                self.metrics.record("interval", perf_counter() - self.time_before, self.remote_id)
+            latency = ceil((perf_counter() - self.time_before) * 1000)
+            if self.range_fusion is not None:
+                # the first position starts the filter of the ranging mode
+                self.range_fusion.initialize((position.x, position.y, position.z), time.time())
+            if self.tracking_filter is not None:
+                self.filterPosition(position)
+            self.handlePosition(position, latency)
+
+    def rangingLoop(self):
+        """Ranges with the next anchor and publishes the position the range leads to."""
+        anchor_index = self.range_fusion.nextAnchor()
+        start = perf_counter()
+        status = self.pozyx.doRanging(self.range_fusion.anchors[anchor_index].network_id, self.device_range,
+                                      remote_id=self.remote_id)
+        if self.supervisor is not None:
+            self.supervisor.record(self.remote_id, status)
+        if status == POZYX_SUCCESS:
+            now = time.time()
+            elapsed = perf_counter() - self.time_before
+            if self.metrics is not None:
+                self.metrics.since("ranging", start, self.remote_id)
+                self.metrics.record("interval", elapsed, self.remote_id)
+            (x, y, z), _ = self.range_fusion.update(anchor_index, self.device_range.distance, now)
+            position = self.position
+            position.x, position.y, position.z = int(round(x)), int(round(y)), int(round(z))
+            self.handlePosition(position, ceil(elapsed * 1000))
+
+    def handlePosition(self, position, latency):
+        self.publishPosition(position, latency)
+        if self.position_store is not None:
+            self.position_store.append(self.remote_id or self.network_id, time.time(), position.x, position.y,
+                                       position.z, latency)
+        if self.geofence is not None:
+            self.checkGeofence(position)
+        self.time_before = perf_counter()
+
+    def filterPosition(self, position):
+        filtered, _ = self.tracking_filter.update([self.remote_id or self.network_id],
+                                                  [(position.x, position.y, position.z)], time.time())
+        position.x, position.y, position.z = (int(round(value)) for value in filtered[0])
+
+    def checkGeofence(self, position):
+        for kind, tag_id, zone_id, timestamp in self.geofence.update(self.remote_id or self.network_id,
+                                                                     position.x, position.y):
+            self.publishMqttObject("geofence", {"event": kind, "tag": tag_id, "zone": zone_id,
+                                                "timestamp": timestamp})
 
     def publishPosition(self, position, latency):
-        position_obj = Position(position.x, position.y, position.z, latency)
-        self.publishMqttObject("position", position_obj.__dict__)
+        # the publisher copies the record as it takes it from the queue
+        record = self.fix_ring.next().load(self.remote_id or self.network_id, time.time(), position, latency)
+        self.publishMqttObject("position/binary" if self.binary else "position", record)
 
 
 if __name__ == "__main__":
@@ -96,10 +191,55 @@ if __name__ == "__main__":
     # height of device, required in 2.5D positioning
     height = 2500
 
+    # MQTT quality of service, and how many positions go in one message (1 sends every position on its own)
+    qos = 0
+    batch_size = 1
+
+    # publish compact binary frames instead of JSON, see position_codec.py
+    binary = False
+
+    # smooth the positions on this computer instead of with the filter of the Pozyx
+    use_tracking_filter = False
+    tracking_filter = KalmanFilterBank(measurement_noise=100) if use_tracking_filter else None
+
+    # range with one anchor per loop and estimate the position on this computer, for more positions per second
+    ranging_only = False
+    anchors = [DeviceCoordinates(0xa000, 1, Coordinates(0, 0, 2500)),
+               DeviceCoordinates(0x6968, 1, Coordinates(0, 3100, 2500)),
+               DeviceCoordinates(0x6945, 1, Coordinates(1900, 0, 2500)),
+               DeviceCoordinates(0x696b, 1, Coordinates(1900, 3100, 2500))]
+    range_fusion = RangeFusion(anchors, dimension, height) if ranging_only else None
+
+    # keep the history of the positions in this directory, None to not keep it
+    history_directory = None
+    position_store = PositionStore(history_directory) if history_directory else None
+
+    # back off while positioning fails and reopen the serial port after a USB hiccup
+    use_supervisor = True
+
+    # collect garbage less often once set up, against latency spikes in long runs
+    use_tune_gc = False
+
+    # print the latency percentiles every 10 seconds, and serve them as JSON on http://localhost:9108/
+    use_metrics = False
+    metrics = LatencyMetrics() if use_metrics else None
+    if use_metrics:
+        metrics.startDump(10.0)
+        metrics.serve(9108)
+
     # create a new pozyx object
     pozyx = PozyxSerial(serial_port)
+    supervisor = DeviceSupervisor(pozyx, [None], find_port=get_first_pozyx_serial_port) if use_supervisor else None
 
-    r = PositionMqtt("localhost", 1883, pozyx, algorithm, dimension, height)
+    r = PositionMqtt("localhost", 1883, pozyx, algorithm, dimension, height, qos=qos, batch_size=batch_size,
+                     binary=binary, tracking_filter=tracking_filter, metrics=metrics,
+                     position_store=position_store, range_fusion=range_fusion, supervisor=supervisor)
     r.setup()
-    while True:
-        r.loop()
+    if use_tune_gc:
+        tune_gc()
+    # publishes what is queued and writes the history still in memory, also on Ctrl+C or an error
+    try:
+        while True:
+            r.loop()
+    finally:
+        r.close()
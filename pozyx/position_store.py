@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Keeps the history of all positions on disk, column by column, and finds them back by tag and time.
+
+PositionStore collects positions in memory and writes them as a chunk once chunk_size have come in,
+or once the oldest of them waited flush_interval seconds, so a crash loses at most that much history.
+A chunk is a directory with a NumPy .npy file per column (tag id, timestamp, x, y, z and latency),
+sorted by tag and then by time, so every column can be memory-mapped and every tag is one
+contiguous run of rows. Next to the chunks an index holds, per chunk, its first and last timestamp
+and, per tag, where its rows start and end:
+
+    index.npy:                 chunk number, first and last timestamp and number of rows of every chunk
+    chunk_000000/tag_id.npy:   uint16, sorted
+    chunk_000000/timestamp.npy float64 seconds since the epoch, sorted per tag
+    chunk_000000/x.npy ...     int32 mm for x, y and z, float32 ms for latency
+    chunk_000000/tags.npy      the tags in the chunk and the row their run starts at
+
+A query only opens the chunks whose time range overlaps it, and within a chunk only reads the rows
+of the tags asked for, found with a binary search on the timestamps.
+"""
+import os
+from time import perf_counter, time
+
+import numpy as np
+
+
+COLUMNS = [("tag_id", np.uint16), ("timestamp", np.float64), ("x", np.int32), ("y", np.int32), ("z", np.int32),
+           ("latency", np.float32)]
+FIX = np.dtype(COLUMNS)
+INDEX = np.dtype([("chunk", np.uint32), ("first", np.float64), ("last", np.float64), ("count", np.uint32)])
+TAGS = np.dtype([("tag_id", np.uint16), ("start", np.uint32), ("end", np.uint32)])
+
+
+class Chunk(object):
+    """The memory-mapped columns of a chunk written earlier"""
+
+    def __init__(self, path):
+        self.path = path
+        self.columns = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name, _ in COLUMNS}
+        tags = np.load(os.path.join(path, "tags.npy"))
+        self.tags = {int(tag["tag_id"]): (int(tag["start"]), int(tag["end"])) for tag in tags}
+
+    def rows(self, tag_id, start, end):
+        """The slice of the rows of tag_id with a timestamp from start up to and including end"""
+        first, last = self.tags.get(tag_id, (0, 0))
+        timestamps = self.columns["timestamp"][first:last]
+        return slice(first + int(np.searchsorted(timestamps, start, "left")),
+                     first + int(np.searchsorted(timestamps, end, "right")))
+
+    def select(self, rows):
+        fixes = np.empty(rows.stop - rows.start, dtype=FIX)
+        for name, _ in COLUMNS:
+            fixes[name] = self.columns[name][rows]
+        return fixes
+
+
+class PositionStore(object):
+    """Appends positions to chunked column files and queries them by tag and time"""
+
+    def __init__(self, directory, chunk_size=65536, cache_size=16, flush_interval=60.0):
+        """
+        Args:
+            directory: where the chunks go, positions are added to the ones already there.
+            chunk_size (optional): positions kept in memory before they are written as a chunk.
+            cache_size (optional): chunks kept open for queries.
+            flush_interval (optional): seconds a position waits in memory at most, None waits for a full chunk.
+        """
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, "index.npy")
+        if os.path.exists(self.index_path):
+            self.index = np.load(self.index_path)
+        else:
+            self.index = np.empty(0, dtype=INDEX)
+        self.buffer = np.empty(chunk_size, dtype=FIX)
+        self.buffered = 0
+        self.buffered_since = 0.0
+        self.chunks = {}
+
+    def __len__(self):
+        return int(self.index["count"].sum()) + self.buffered
+
+    def append(self, tag_id, timestamp, x, y, z, latency=0.0):
+        """Adds one position, timestamp in seconds since the epoch"""
+        if self.buffered == 0:
+            self.buffered_since = perf_counter()
+        self.buffer[self.buffered] = (tag_id or 0, timestamp, x, y, z, latency)
+        self.buffered += 1
+        if self.buffered == self.chunk_size or self.flushDue():
+            self.flush()
+
+    def extend(self, tag_ids, timestamps, xs, ys, zs, latencies=0.0):
+        """Adds many positions at once, given as arrays or sequences of the same length"""
+        tag_ids = np.asarray(tag_ids)
+        added = 0
+        while added < len(tag_ids):
+            if self.buffered == 0:
+                self.buffered_since = perf_counter()
+            count = min(len(tag_ids) - added, self.chunk_size - self.buffered)
+            rows = slice(self.buffered, self.buffered + count)
+            for name, values in zip(["tag_id", "timestamp", "x", "y", "z", "latency"],
+                                    [tag_ids, timestamps, xs, ys, zs, latencies]):
+                self.buffer[name][rows] = values[added:added + count] if np.ndim(values) else values
+            self.buffered += count
+            added += count
+            if self.buffered == self.chunk_size or self.flushDue():
+                self.flush()
+
+    def flushDue(self):
+        return self.flush_interval is not None and perf_counter() - self.buffered_since >= self.flush_interval
+
+    def flush(self):
+        """Writes the positions in memory as a new chunk"""
+        if self.buffered == 0:
+            return
+        fixes = self.buffer[:self.buffered]
+        fixes = fixes[np.lexsort((fixes["timestamp"], fixes["tag_id"]))]
+        number = int(self.index["chunk"].max()) + 1 if len(self.index) else 0
+        path = self.chunkPath(number)
+        os.makedirs(path, exist_ok=True)
+        for name, _ in COLUMNS:
+            np.save(os.path.join(path, name + ".npy"), np.ascontiguousarray(fixes[name]))
+        tag_ids, starts, counts = np.unique(fixes["tag_id"], return_index=True, return_counts=True)
+        tags = np.empty(len(tag_ids), dtype=TAGS)
+        tags["tag_id"], tags["start"], tags["end"] = tag_ids, starts, starts + counts
+        np.save(os.path.join(path, "tags.npy"), tags)
+
+        # the index is written last, a chunk that isn't in it doesn't exist
+        entry = np.array([(number, fixes["timestamp"].min(), fixes["timestamp"].max(), len(fixes))], dtype=INDEX)
+        self.index = np.concatenate([self.index, entry])
+        np.save(self.index_path + ".tmp.npy", self.index)
+        os.replace(self.index_path + ".tmp.npy", self.index_path)
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+        self.chunks = {}
+
+    def chunkPath(self, number):
+        return os.path.join(self.directory, "chunk_%06i" % number)
+
+    def chunk(self, number):
+        chunk = self.chunks.pop(number, None)
+        if chunk is None:
+            chunk = Chunk(self.chunkPath(number))
+            if len(self.chunks) >= self.cache_size:
+                del self.chunks[next(iter(self.chunks))]
+        # most recently used last
+        self.chunks[number] = chunk
+        return chunk
+
+    def overlapping(self, start, end):
+        """The numbers of the chunks with positions between start and end"""
+        return self.index["chunk"][(self.index["first"] <= end) & (self.index["last"] >= start)]
+
+    def range(self, tag_id, start, end):
+        """The positions of a tag from start up to and including end, ordered by time"""
+        parts = []
+        for number in self.overlapping(start, end):
+            chunk = self.chunk(int(number))
+            parts.append(chunk.select(chunk.rows(tag_id, start, end)))
+        fixes = self.buffer[:self.buffered]
+        fixes = fixes[(fixes["tag_id"] == tag_id) & (fixes["timestamp"] >= start) & (fixes["timestamp"] <= end)]
+        parts.append(fixes)
+        fixes = np.concatenate(parts)
+        return fixes[np.argsort(fixes["timestamp"], kind="stable")]
+
+    def between(self, start, end):
+        """The positions of all tags from start up to and including end, ordered by time"""
+        parts = []
+        for number in self.overlapping(start, end):
+            chunk = self.chunk(int(number))
+            for tag_id in chunk.tags:
+                parts.append(chunk.select(chunk.rows(tag_id, start, end)))
+        fixes = self.buffer[:self.buffered]
+        parts.append(fixes[(fixes["timestamp"] >= start) & (fixes["timestamp"] <= end)])
+        fixes = np.concatenate(parts)
+        return fixes[np.argsort(fixes["timestamp"], kind="stable")]
+
+    def at(self, timestamp, max_age=1.0):
+        """The last position of every tag at timestamp, of the tags with one at most max_age older"""
+        latest = {}
+        for number in self.overlapping(timestamp - max_age, timestamp):
+            chunk = self.chunk(int(number))
+            for tag_id in chunk.tags:
+                rows = chunk.rows(tag_id, timestamp - max_age, timestamp)
+                if rows.stop > rows.start:
+                    fix = chunk.select(slice(rows.stop - 1, rows.stop))[0]
+                    if tag_id not in latest or fix["timestamp"] >= latest[tag_id]["timestamp"]:
+                        latest[tag_id] = fix
+        fixes = self.buffer[:self.buffered]
+        for fix in fixes[(fixes["timestamp"] >= timestamp - max_age) & (fixes["timestamp"] <= timestamp)]:
+            tag_id = int(fix["tag_id"])
+            if tag_id not in latest or fix["timestamp"] >= latest[tag_id]["timestamp"]:
+                latest[tag_id] = fix
+        return np.array([latest[tag_id] for tag_id in sorted(latest)], dtype=FIX)
+
+
+if __name__ == "__main__":
+    # ingests a few million positions of 50 tags at 20Hz, one at a time and in blocks, then queries them
+    import shutil
+    import tempfile
+
+    directory = tempfile.mkdtemp()
+    tag_ids = np.arange(0x1000, 0x1000 + 50)
+    rate = 20.0
+    count = 2000000
+    rng = np.random.default_rng(1)
+    begin = time()
+    timestamps = begin + np.arange(count) / (rate * len(tag_ids))
+    tags = np.tile(tag_ids, count // len(tag_ids))
+    xs, ys, zs = rng.integers(0, 10000, (3, count), dtype=np.int32)
+    latencies = rng.uniform(20, 80, count).astype(np.float32)
+
+    store = PositionStore(os.path.join(directory, "one_by_one"))
+    single = 200000
+    values = list(zip(tags[:single].tolist(), timestamps[:single].tolist(), xs[:single].tolist(),
+                      ys[:single].tolist(), zs[:single].tolist(), latencies[:single].tolist()))
+    start = perf_counter()
+    for tag_id, timestamp, x, y, z, latency in values:
+        store.append(tag_id, timestamp, x, y, z, latency)
+    store.flush()
+    elapsed = perf_counter() - start
+    print("append: {} positions in {:.2f}s, {:.0f} positions/s".format(single, elapsed, single / elapsed))
+
+    store = PositionStore(os.path.join(directory, "blocks"))
+    block = 1000
+    start = perf_counter()
+    for offset in range(0, count, block):
+        rows = slice(offset, offset + block)
+        store.extend(tags[rows], timestamps[rows], xs[rows], ys[rows], zs[rows], latencies[rows])
+    store.flush()
+    elapsed = perf_counter() - start
+    print("extend: {} positions in {:.2f}s, {:.0f} positions/s, {} chunks".format(
+        count, elapsed, count / elapsed, len(store.index)))
+
+    # a fresh store, so the queries open the chunks from disk
+    store = PositionStore(os.path.join(directory, "blocks"))
+    middle = timestamps[count // 2]
+    start = perf_counter()
+    fixes = store.range(0x1000, middle, middle + 60)
+    print("tag 0x1000 over 60s: {} positions in {:.2f}ms".format(len(fixes), (perf_counter() - start) * 1000))
+    start = perf_counter()
+    fixes = store.at(middle)
+    print("all tags at one moment: {} positions in {:.2f}ms".format(len(fixes), (perf_counter() - start) * 1000))
+    start = perf_counter()
+    fixes = store.between(middle, middle + 1)
+    print("all tags over 1s: {} positions in {:.2f}ms".format(len(fixes), (perf_counter() - start) * 1000))
+    shutil.rmtree(directory)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Reads many fields of the positioning data of the local Pozyx in one call, into a NumPy array.
+
+getPositioningData takes a mask of fields and answers with all of them packed in a single serial
+exchange, but the scripts ask for the coordinates only: the heading or the acceleration would cost
+reads of their own. And pypozyx unpacks the answer byte by byte into a Python object per field.
+
+PositioningReader asks for the fields it was given in one exchange, and copies the packed answer as
+it is into the next row of a preallocated structured array whose dtype has the same packed layout,
+followed by the time of the read. The fields are only unpacked when a column is used, for a whole
+batch of reads at once, and convert() scales them to physical units the same way.
+
+The fields, in the order the Pozyx packs them:
+
+    position:                x, y, z in mm and the position status
+    acceleration:            in mg, including gravity
+    angular_velocity:        in 1/16 degrees per second
+    magnetic:                in 1/16 uT
+    euler_angles:            heading, roll and pitch in 1/16 degrees
+    quaternion:              w, x, y, z in 1/16384
+    linear_acceleration:     in mg, without gravity
+    gravity:                 in mg
+    pressure:                in mPa
+    max_linear_acceleration: in mg
+
+Ranges are left out, their number differs from one read to the next.
+"""
+from time import perf_counter, time
+
+import numpy as np
+from pypozyx import Data, PozyxConstants, PozyxRegisters, POZYX_FAILURE, POZYX_SUCCESS
+from serial import SerialException
+
+
+# name, dtype and divider to physical units of every field, the bit of a field is its index
+FIELDS = [
+    ("position", [("x", "<i4"), ("y", "<i4"), ("z", "<i4"), ("position_status", "u1")], PozyxConstants.POSITION_DIV_MM),
+    ("acceleration", [("acceleration", "<i2", (3,))], PozyxConstants.ACCELERATION_DIV_MG),
+    ("angular_velocity", [("angular_velocity", "<i2", (3,))], PozyxConstants.GYRO_DIV_DPS),
+    ("magnetic", [("magnetic", "<i2", (3,))], PozyxConstants.MAGNETOMETER_DIV_UT),
+    ("euler_angles", [("euler_angles", "<i2", (3,))], PozyxConstants.EULER_ANGLES_DIV_DEG),
+    ("quaternion", [("quaternion", "<i2", (4,))], PozyxConstants.QUATERNION_DIV),
+    ("linear_acceleration", [("linear_acceleration", "<i2", (3,))], PozyxConstants.ACCELERATION_DIV_MG),
+    ("gravity", [("gravity", "<i2", (3,))], PozyxConstants.ACCELERATION_DIV_MG),
+    ("pressure", [("pressure", "<u4")], PozyxConstants.PRESSURE_DIV_PA),
+    ("max_linear_acceleration", [("max_linear_acceleration", "<i2")], PozyxConstants.MAX_LINEAR_ACCELERATION_DIV_MG),
+]
+FIELD_BITS = {name: index for index, (name, _, _) in enumerate(FIELDS)}
+
+
+def field_mask(fields):
+    """The flags of getPositioningData for the names of the fields"""
+    mask = 0
+    for name in fields:
+        if name not in FIELD_BITS:
+            raise ValueError("Unknown positioning data field %s, choose from %s" % (name, ", ".join(FIELD_BITS)))
+        mask |= 1 << FIELD_BITS[name]
+    return mask
+
+
+def packed_dtype(mask):
+    """The dtype of the packed positioning data of a mask, without padding"""
+    columns = []
+    for index, (_, field_columns, _) in enumerate(FIELDS):
+        if mask & (1 << index):
+            columns.extend(field_columns)
+    return np.dtype(columns)
+
+
+class PositioningReader(object):
+    """Reads the positioning data fields of the local Pozyx into batches of a structured array"""
+
+    def __init__(self, pozyx, fields=("position",), batch_size=256):
+        """
+        Args:
+            pozyx: the local Pozyx, a PozyxSerial reads without decoding the answer into Python objects.
+            fields (optional): names of the fields to read, see FIELDS.
+            batch_size (optional): reads per batch, handleBatch gets every full batch.
+        """
+        self.pozyx = pozyx
+        self.fields = [name for name, _, _ in FIELDS if name in fields]
+        self.flags = field_mask(fields)
+        self.packed = packed_dtype(self.flags)
+        self.dtype = np.dtype(self.packed.descr + [("timestamp", "<f8")])
+        self.byte_size = self.packed.itemsize
+        self.hex_size = 2 * self.byte_size
+
+        self.flags_data = Data([self.flags], 'H')
+        self.flags_data.load_hex_string()
+        # the request is the same every time, what getPositioningData formats on every call
+        self.request = 'F,%0.2x,%s,%i\r' % (PozyxRegisters.DO_POSITIONING_WITH_DATA, self.flags_data.byte_data,
+                                             self.byte_size + 61)
+        # interfaces without serialExchange read through regFunction into this, a byte per element
+        self.serial = hasattr(pozyx, "serialExchange")
+        self.data = Data([0] * self.byte_size, 'B' * self.byte_size)
+
+        self.batch_size = batch_size
+        self.buffer = bytearray(batch_size * self.dtype.itemsize)
+        self.records = np.frombuffer(self.buffer, dtype=self.dtype)
+        self.timestamps = self.records["timestamp"]
+        self.count = 0
+        self.reads = 0
+        self.latest = None
+
+    def read(self):
+        """Reads the fields once into the next row, returns the status of the read"""
+        self.reads += 1
+        if self.serial:
+            try:
+                response = self.pozyx.serialExchange(self.request)
+            except SerialException:
+                return POZYX_FAILURE
+            status = int(response[0:2], 16)
+            if status != POZYX_SUCCESS or len(response) < 2 + self.hex_size:
+                return status
+            packed = bytes.fromhex(response[2:2 + self.hex_size])
+        else:
+            status = self.pozyx.regFunction(PozyxRegisters.DO_POSITIONING_WITH_DATA, self.flags_data, self.data)
+            if status != POZYX_SUCCESS:
+                return status
+            packed = bytes(self.data.data)
+        offset = self.count * self.dtype.itemsize
+        self.buffer[offset:offset + self.byte_size] = packed
+        self.timestamps[self.count] = time()
+        self.latest = self.count
+        self.count += 1
+        if self.count == self.batch_size:
+            self.flush()
+        return status
+
+    def last(self):
+        """The row of the latest read, None before the first"""
+        return None if self.latest is None else self.records[self.latest]
+
+    def batch(self):
+        """The rows read since the last full batch"""
+        return self.records[:self.count]
+
+    def flush(self):
+        """Hands the rows read so far to handleBatch and starts a new batch"""
+        if self.count > 0:
+            self.handleBatch(self.records[:self.count])
+            self.count = 0
+
+    def handleBatch(self, records):
+        """Called with a batch of rows, which are overwritten afterwards: copy what needs to stay"""
+        pass
+
+
+def convert(records):
+    """The columns of the rows in physical units, as float arrays in a dictionary"""
+    names = records.dtype.names
+    columns = {}
+    for name, field_columns, divider in FIELDS:
+        for column in field_columns:
+            if column[0] in names:
+                columns[column[0]] = records[column[0]] / divider if column[0] != "position_status" \
+                    else records[column[0]]
+    columns["timestamp"] = records["timestamp"]
+    return columns
+
+
+if __name__ == "__main__":
+    # reads the position with pypozyx, the position and all sensor fields with pypozyx, and the same
+    # fields with PositioningReader, on a simulated Pozyx walking in circles
+    from pypozyx import Coordinates, PositioningData
+
+    from benchmark import create_network
+    from simulated_pozyx import LatencyModel
+
+    reads = 2000
+    all_fields = [name for name, _, _ in FIELDS]
+    # a serial link without delay, to see the cost of decoding
+    pozyx = create_network([], LatencyModel(serial_round_trip=0, jitter=0), seed=1)
+    pozyx.doPositioning(Coordinates(), height=2500)
+
+    start = perf_counter()
+    for _ in range(reads):
+        position = Coordinates()
+        position_data = PositioningData(0b1)
+        if pozyx.getPositioningData(position_data) == POZYX_SUCCESS:
+            position.load_bytes(position_data.byte_data)
+    position_only = (perf_counter() - start) / reads
+
+    start = perf_counter()
+    for _ in range(reads):
+        position_data = PositioningData(field_mask(all_fields))
+        pozyx.getPositioningData(position_data)
+    objects = (perf_counter() - start) / reads
+
+    reader = PositioningReader(pozyx, all_fields, batch_size=reads)
+    start = perf_counter()
+    for _ in range(reads - 1):
+        reader.read()
+    array = (perf_counter() - start) / (reads - 1)
+    columns = convert(reader.batch())
+
+    # both decodings of the same answer
+    response = pozyx.serialExchange(reader.request)
+    position_data = PositioningData(reader.flags)
+    position_data.load_bytes(response[2:])
+    decoded = np.frombuffer(bytes.fromhex(response[2:2 + reader.hex_size]), dtype=reader.packed)[0]
+    containers = dict(zip([name for name, _, _ in FIELDS], position_data.containers))
+    same = containers["position"].data == [decoded["x"], decoded["y"], decoded["z"], decoded["position_status"]] and \
+        all(list(containers[name].data) == decoded[name].tolist()
+            for name in ["acceleration", "euler_angles", "linear_acceleration", "gravity"])
+
+    row = reader.last()
+    print("BENCH positioning data: position with pypozyx {:.0f}us per read, {} fields ({} bytes) with pypozyx "
+          "{:.0f}us, with PositioningReader {:.0f}us, same values: {}".format(
+              position_only * 1e6, len(all_fields), reader.byte_size, objects * 1e6, array * 1e6, same))
+    print("Last read: x {} mm, heading {:.1f} degrees, linear acceleration {} mg, pressure {:.0f} Pa".format(
+        row["x"], columns["euler_angles"][-1][0], row["linear_acceleration"].tolist(), columns["pressure"][-1]))
+
+    # decoding alone, the serial exchange of the simulation takes most of a read
+    start = perf_counter()
+    for _ in range(reads):
+        PositioningData(reader.flags).load_bytes(response[2:])
+    decode_objects = (perf_counter() - start) / reads
+    start = perf_counter()
+    for index in range(reads):
+        offset = index * reader.dtype.itemsize
+        reader.buffer[offset:offset + reader.byte_size] = bytes.fromhex(response[2:2 + reader.hex_size])
+    decode_array = (perf_counter() - start) / reads
+    print("BENCH positioning data decoding: pypozyx {:.1f}us, into the array {:.1f}us".format(
+        decode_objects * 1e6, decode_array * 1e6))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Positions a tag on the host from one range at a time, instead of waiting for doPositioning.
+
+doPositioning ranges with every anchor before it returns a position, so a position takes as long
+as all those ranging exchanges together. RangeFusion asks for a single range per call, to the next
+anchor in turn, and folds every range into an extended Kalman filter as soon as it arrives: the
+state is the position and velocity of the tag, and each range corrects it along the direction of
+its anchor. A position comes out after every range, at a fraction of the latency of doPositioning.
+
+One range only pins the tag down in one direction, the filter relies on the motion model between
+ranges to the other anchors. It is started from a regular doPositioning, and in 2D and 2.5D the
+height is held at the given height.
+"""
+from time import perf_counter, time
+
+import numpy as np
+from pypozyx import PozyxConstants
+
+
+class RangeFusion(object):
+    """An extended Kalman filter of the position and velocity of a tag, updated one range at a time"""
+
+    def __init__(self, anchors, dimension=PozyxConstants.DIMENSION_3D, height=1000, range_noise=100.0,
+                 process_noise=500000.0, gate=10.83, max_rejections=5, initial_velocity=1000.0):
+        """
+        Args:
+            anchors: DeviceCoordinates of the anchors to range with, in turn.
+            dimension (optional): in 2D and 2.5D the height stays at height.
+            height (optional): height of the tag in mm for 2D and 2.5D.
+            range_noise (optional): standard deviation of a range in mm.
+            process_noise (optional): spectral density of the acceleration in mm^2/s^3, higher follows
+                faster movements.
+            gate (optional): squared normalized innovation above which a range is an outlier, 10.83 is
+                the 99.9% point of the chi-square distribution with one degree of freedom.
+            max_rejections (optional): outliers in a row after which a range is accepted anyway.
+            initial_velocity (optional): standard deviation of the unknown velocity at the start in mm/s.
+        """
+        self.anchors = anchors
+        self.positions = np.array([(anchor.pos.x, anchor.pos.y, anchor.pos.z) for anchor in anchors], dtype=float)
+        self.fixed_height = dimension != PozyxConstants.DIMENSION_3D
+        self.height = height
+        self.range_variance = range_noise ** 2
+        self.process_noise = process_noise
+        self.gate = gate
+        self.max_rejections = max_rejections
+        self.initial_velocity = initial_velocity
+
+        # position and velocity in mm and mm/s
+        self.state = np.zeros(6)
+        self.covariance = np.eye(6)
+        self.time = None
+        self.next_index = 0
+        self.rejections = 0
+        self.updates = 0
+        self.outliers = 0
+
+    @property
+    def initialized(self):
+        return self.time is not None
+
+    def initialize(self, position, timestamp, position_noise=None):
+        """Starts the filter at a position, like one of doPositioning"""
+        position_noise = np.sqrt(self.range_variance) if position_noise is None else position_noise
+        self.state = np.array([position[0], position[1], self.height if self.fixed_height else position[2],
+                               0.0, 0.0, 0.0])
+        self.covariance = np.diag([position_noise ** 2] * 3 + [self.initial_velocity ** 2] * 3)
+        self.time = timestamp
+        self.rejections = 0
+
+    def reset(self):
+        self.time = None
+
+    def nextAnchor(self):
+        """The index of the anchor to range with now, round-robin"""
+        index = self.next_index
+        self.next_index = (self.next_index + 1) % len(self.anchors)
+        return index
+
+    def predict(self, timestamp):
+        dt = max(timestamp - self.time, 0.0)
+        if dt > 0:
+            transition = np.eye(6)
+            transition[0:3, 3:6] = dt * np.eye(3)
+            q = self.process_noise
+            noise = np.zeros((6, 6))
+            noise[0:3, 0:3] = q * dt ** 3 / 3 * np.eye(3)
+            noise[0:3, 3:6] = noise[3:6, 0:3] = q * dt ** 2 / 2 * np.eye(3)
+            noise[3:6, 3:6] = q * dt * np.eye(3)
+            self.state = transition @ self.state
+            self.covariance = transition @ self.covariance @ transition.T + noise
+            self.time = timestamp
+        if self.fixed_height:
+            self.state[2] = self.height
+            self.state[5] = 0.0
+            self.covariance[2, :] = self.covariance[:, 2] = 0.0
+            self.covariance[5, :] = self.covariance[:, 5] = 0.0
+
+    def update(self, anchor_index, distance, timestamp):
+        """
+        Folds in a range to an anchor.
+
+        Args:
+            anchor_index: the index of the anchor, as given by nextAnchor.
+            distance: the range in mm.
+            timestamp: when it was measured, in seconds.
+
+        Returns:
+            the estimated (x, y, z) at timestamp in mm, and whether the range was accepted.
+        """
+        self.predict(timestamp)
+        offset = self.state[0:3] - self.positions[anchor_index]
+        predicted = np.linalg.norm(offset)
+        jacobian = np.zeros(6)
+        jacobian[0:3] = offset / max(predicted, 1.0)
+        if self.fixed_height:
+            jacobian[2] = 0.0
+        innovation = distance - predicted
+        pc = self.covariance @ jacobian
+        variance = jacobian @ pc + self.range_variance
+        accepted = innovation ** 2 / variance <= self.gate or self.rejections >= self.max_rejections
+        if accepted:
+            gain = pc / variance
+            self.state = self.state + gain * innovation
+            # Joseph form, stays symmetric and positive
+            correction = np.eye(6) - np.outer(gain, jacobian)
+            self.covariance = correction @ self.covariance @ correction.T + self.range_variance * np.outer(gain, gain)
+            self.rejections = 0
+            self.updates += 1
+        else:
+            self.rejections += 1
+            self.outliers += 1
+        return (self.state[0], self.state[1], self.state[2]), accepted
+
+    def velocity(self):
+        return tuple(self.state[3:6])
+
+
+if __name__ == "__main__":
+    # positions a simulated tag walking in circles with Position.loop, doPositioning every call, and
+    # with its ranging mode, one range and an update of the filter every call
+    import io
+    from contextlib import redirect_stdout
+
+    from benchmark import ANCHORS, create_network
+    from position import Position
+    from simulated_pozyx import LatencyModel
+
+    duration = 5
+    latency = LatencyModel(serial_round_trip=0.001, ranging_time=0.006, hop_time=0.002, jitter=0.1, seed=1)
+
+    for name, fusion in [("Position.loop", None),
+                         ("Position.loop ranging", RangeFusion(ANCHORS, range_noise=50))]:
+        pozyx = create_network([], latency, seed=1, position_noise=50)
+        position = Position(pozyx, height=2500, range_fusion=fusion)
+        tag = pozyx.network.devices[position.network_id]
+        errors = []
+        latencies = []
+
+        def record(coordinates, call_latency):
+            truth = tag.true_position(perf_counter())
+            errors.append(((coordinates.x - truth[0]) ** 2 + (coordinates.y - truth[1]) ** 2 +
+                           (coordinates.z - truth[2]) ** 2) ** 0.5)
+            latencies.append(call_latency)
+        position.printPublishPosition = record
+
+        start = perf_counter()
+        with redirect_stdout(io.StringIO()):
+            while perf_counter() - start < duration:
+                position.loop()
+        errors.sort()
+        latencies.sort()
+        print("{}: {:.1f} positions/s, latency per position p50 {}ms, error p50 {:.0f}mm, p95 {:.0f}mm".format(
+            name, len(errors) / duration, latencies[len(latencies) // 2], errors[len(errors) // 2],
+            errors[int(0.95 * len(errors))]))
@@ -6,6 +6,8 @@ A script that will read the positioning data on the tag
 from pypozyx import (PozyxSerial, get_first_pozyx_serial_port, PositioningData, SingleRegister,
                      PozyxConstants, POZYX_SUCCESS, Coordinates)
 
+from positioning_reader import PositioningReader, convert
+
 
 def get_position(pozyx):
     position = Coordinates()
@@ -16,6 +18,15 @@ def get_position(pozyx):
         printPublishPosition(position)
 
 
+def get_positioning_data(pozyx, fields):
+    """Reads the position and the other fields in a single call"""
+    reader = PositioningReader(pozyx, ["position"] + list(fields), batch_size=1)
+    if reader.read() == POZYX_SUCCESS:
+        columns = convert(reader.records)
+        print(", ".join("{}: {}".format(name, column[0].tolist()) for name, column in columns.items()
+                        if name != "timestamp"))
+
+
 def doPositioning(pozyx):
     position = Coordinates()
     return pozyx.doPositioning(
@@ -40,8 +51,13 @@ if __name__ == '__main__':
     # do positioning if needed
     position = False
 
+    # positioning data fields to read along with the position, see positioning_reader.FIELDS
+    fields = []
+
     # see what we need to do
-    if position is True and doPositioning(pozyx) == POZYX_SUCCESS:
-        get_position(pozyx)
+    if position is True:
+        doPositioning(pozyx)
+    if fields:
+        get_positioning_data(pozyx, fields)
     else:
         get_position(pozyx)
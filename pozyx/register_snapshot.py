@@ -0,0 +1,128 @@
+"""
+A register cache in front of a Pozyx, for inspecting devices in a few round trips.
+
+RegisterSnapshot is a drop-in replacement for the PozyxSerial it wraps. Reads that fall inside a
+known block of registers fetch the whole block once and are served from memory afterwards. The
+results of read-only register functions such as the flash details and the anchor ids are kept as
+well. Any write or other register function on a device drops everything cached for that device.
+"""
+from pypozyx import Data, PozyxRegisters, POZYX_SUCCESS, POZYX_FAILURE
+from pypozyx.lib import PozyxLib
+
+
+# contiguous readable registers that are read in one go, the interrupt status is left out as reading clears it
+BLOCKS = [
+    (PozyxRegisters.WHO_AM_I, PozyxRegisters.ERROR_CODE - PozyxRegisters.WHO_AM_I + 1),
+    (PozyxRegisters.POSITIONING_FILTER, PozyxRegisters.CONFIG_BLINK_PAYLOAD - PozyxRegisters.POSITIONING_FILTER + 1),
+]
+
+# register functions that only read, their results are cached too
+READ_FUNCTIONS = [
+    PozyxRegisters.GET_FLASH_DETAILS,
+    PozyxRegisters.GET_POSITIONING_ANCHOR_IDS,
+    PozyxRegisters.GET_DEVICE_LIST_IDS,
+    PozyxRegisters.GET_DEVICE_COORDINATES,
+]
+
+
+class RegisterSnapshot(PozyxLib):
+    """Serves the register reads of a Pozyx and its remote devices from memory"""
+
+    def __init__(self, pozyx):
+        self.pozyx = pozyx
+        self.suppress_warnings = pozyx.suppress_warnings
+        # per remote id, the bytes of every block and the results of the read functions
+        self.blocks = {}
+        self.functions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        # everything that isn't a register access goes to the wrapped Pozyx
+        return getattr(self.pozyx, name)
+
+    def invalidate(self, remote_id=None):
+        self.blocks.pop(remote_id, None)
+        self.functions.pop(remote_id, None)
+
+    def refresh(self, remote_id=None):
+        """Reads all blocks of a device again"""
+        self.invalidate(remote_id)
+        status = POZYX_SUCCESS
+        for block in BLOCKS:
+            if self.readBlock(block, remote_id) is None:
+                status = POZYX_FAILURE
+        return status
+
+    # the interface PozyxCore builds on
+
+    def regRead(self, address, data):
+        return self.pozyx.regRead(address, data)
+
+    def regWrite(self, address, data):
+        self.invalidate(None)
+        return self.pozyx.regWrite(address, data)
+
+    def remoteRegWrite(self, destination, address, data):
+        self.invalidate(destination)
+        return PozyxLib.remoteRegWrite(self, destination, address, data)
+
+    def regFunction(self, address, params, data):
+        return self.pozyx.regFunction(address, params, data)
+
+    def waitForFlag(self, interrupt_flag, timeout_s, interrupt=None):
+        return self.pozyx.waitForFlag(interrupt_flag, timeout_s, interrupt)
+
+    # cached access
+
+    def getRead(self, address, data, remote_id=None):
+        block = self.findBlock(address, data.byte_size)
+        if block is None:
+            return self.pozyx.getRead(address, data, remote_id)
+        registers = self.readBlock(block, remote_id)
+        if registers is None:
+            return self.pozyx.getRead(address, data, remote_id)
+        offset = address - block[0]
+        data.load_packed(registers[offset:offset + data.byte_size])
+        return POZYX_SUCCESS
+
+    def setWrite(self, address, data, remote_id=None, *args, **kwargs):
+        self.invalidate(remote_id)
+        return self.pozyx.setWrite(address, data, remote_id, *args, **kwargs)
+
+    def useFunction(self, function, params=None, data=None, remote_id=None):
+        if function not in READ_FUNCTIONS or data is None:
+            # anything else might change the registers
+            self.invalidate(remote_id)
+            return self.pozyx.useFunction(function, params, data, remote_id)
+        key = (function, bytes(params.transform_to_bytes()) if params is not None else b'', data.byte_size)
+        cached = self.functions.setdefault(remote_id, {})
+        if key in cached:
+            self.hits += 1
+            status, result = cached[key]
+            data.load_packed(result)
+            return status
+        self.misses += 1
+        status = self.pozyx.useFunction(function, params, data, remote_id)
+        if status == POZYX_SUCCESS:
+            cached[key] = (status, bytes(data.transform_to_bytes()))
+        return status
+
+    def findBlock(self, address, size):
+        for block in BLOCKS:
+            if block[0] <= address and address + size <= block[0] + block[1]:
+                return block
+        return None
+
+    def readBlock(self, block, remote_id):
+        """The bytes of a block, read from the device the first time, None when that failed"""
+        blocks = self.blocks.setdefault(remote_id, {})
+        if block in blocks:
+            self.hits += 1
+            return blocks[block]
+        self.misses += 1
+        registers = Data([0] * block[1])
+        if self.pozyx.getRead(block[0], registers, remote_id) != POZYX_SUCCESS:
+            return None
+        blocks[block] = bytes(registers.transform_to_bytes())
+        return blocks[block]
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+"""
+Records everything a script asks of a Pozyx to a log file, and replays it without the Pozyx.
+
+SessionRecorder wraps a PozyxSerial like RegisterSnapshot does and writes every call that reaches
+the serial port (register reads, writes, functions, waiting for interrupts and raw exchanges) to
+the log: when it started, how long it took, its arguments and its result. SessionReplay takes the
+place of the PozyxSerial and answers the same calls from the log, at the recorded speed, faster,
+or as fast as possible. The scripts can't tell the difference, so the publish path and the filters
+can be benchmarked with real traffic.
+
+The log is append-only. Calls are collected in chunks, every chunk is compressed on its own and
+preceded by a header with the times of its first and last call. SessionLog memory-maps the file and
+reads only the headers, so it can jump to any moment without decompressing what comes before.
+
+    file header:  magic 'PZXLOG' (6 bytes), version (uint8), wall clock time of the start (float64)
+    chunk header: magic 'PZXC' (4 bytes), first and last call time (float64), number of calls (uint32),
+                  compressed size (uint32)
+    call:         start and duration in seconds since the start (float64), operation, address,
+                  status (uint8), argument and result size (uint16), argument bytes, result bytes
+
+Everything is little-endian. A chunk that was cut off, say by a crash, is ignored.
+"""
+import bisect
+import mmap
+import struct
+import zlib
+from time import perf_counter, sleep, time
+
+from pypozyx import SingleRegister, POZYX_FAILURE
+from pypozyx.lib import PozyxLib
+from serial import SerialException
+
+
+FILE_HEADER = struct.Struct('<6sBd')
+CHUNK_HEADER = struct.Struct('<4sddII')
+CALL = struct.Struct('<ddBBBHH')
+FILE_MAGIC = b'PZXLOG'
+CHUNK_MAGIC = b'PZXC'
+VERSION = 1
+
+# the calls PozyxSerial makes on the serial port
+REG_READ = 1
+REG_WRITE = 2
+REG_FUNCTION = 3
+WAIT_FOR_FLAG = 4
+SERIAL_EXCHANGE = 5
+
+OPERATION_NAMES = {REG_READ: "read", REG_WRITE: "write", REG_FUNCTION: "function", WAIT_FOR_FLAG: "wait",
+                   SERIAL_EXCHANGE: "exchange"}
+
+
+class Call(object):
+    __slots__ = ("start", "duration", "operation", "address", "status", "argument", "result")
+
+    def __init__(self, start, duration, operation, address, status, argument, result):
+        self.start = start
+        self.duration = duration
+        self.operation = operation
+        self.address = address
+        self.status = status
+        self.argument = argument
+        self.result = result
+
+    def __repr__(self):
+        return "<{} 0x{:02x} at {:.4f}s: {}>".format(OPERATION_NAMES.get(self.operation), self.address,
+                                                     self.start, self.status)
+
+
+def packed(data):
+    data.load_hex_string()
+    return bytes.fromhex(data.byte_data)
+
+
+class SessionRecorder(PozyxLib):
+    """A PozyxSerial that writes every call it passes on to a session log"""
+
+    def __init__(self, pozyx, path, chunk_size=256, chunk_interval=1.0, compression=6):
+        """
+        Args:
+            pozyx: the PozyxSerial to record.
+            path: the log file, calls are appended when it exists already.
+            chunk_size (optional): calls per compressed chunk.
+            chunk_interval (optional): seconds after which a chunk is written even when it isn't full.
+            compression (optional): zlib compression level.
+        """
+        PozyxLib.__init__(self)
+        self.pozyx = pozyx
+        self.suppress_warnings = pozyx.suppress_warnings
+        self.chunk_size = chunk_size
+        self.chunk_interval = chunk_interval
+        self.compression = compression
+        self.file = open(path, 'ab')
+        self.start = perf_counter()
+        if self.file.tell() == 0:
+            self.file.write(FILE_HEADER.pack(FILE_MAGIC, VERSION, time()))
+        else:
+            # times keep increasing after the calls already in the log
+            log = SessionLog(path)
+            self.start -= log.duration()
+            log.close()
+        self.calls = []
+        self.chunk_started = self.start
+        self.recorded = 0
+        self.written = 0
+
+    def __getattr__(self, name):
+        return getattr(self.pozyx, name)
+
+    def record(self, started, operation, address, status, argument=b'', result=b''):
+        now = perf_counter()
+        self.calls.append(CALL.pack(started - self.start, now - started, operation, address, status & 0xFF,
+                                    len(argument), len(result)) + argument + result)
+        self.recorded += 1
+        if len(self.calls) >= self.chunk_size or now - self.chunk_started >= self.chunk_interval:
+            self.flush()
+
+    def flush(self):
+        """Compresses and appends the calls collected so far"""
+        if not self.calls:
+            return
+        first = CALL.unpack_from(self.calls[0])[0]
+        last = CALL.unpack_from(self.calls[-1])[0]
+        body = zlib.compress(b''.join(self.calls), self.compression)
+        self.file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, first, last, len(self.calls), len(body)) + body)
+        self.file.flush()
+        self.written += CHUNK_HEADER.size + len(body)
+        self.calls = []
+        self.chunk_started = perf_counter()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    # the interface PozyxCore builds on
+
+    def regRead(self, address, data):
+        started = perf_counter()
+        status = self.pozyx.regRead(address, data)
+        self.record(started, REG_READ, address, status, struct.pack('<H', data.byte_size), packed(data))
+        return status
+
+    def regWrite(self, address, data):
+        started = perf_counter()
+        status = self.pozyx.regWrite(address, data)
+        self.record(started, REG_WRITE, address, status, packed(data))
+        return status
+
+    def regFunction(self, address, params, data):
+        started = perf_counter()
+        status = self.pozyx.regFunction(address, params, data)
+        self.record(started, REG_FUNCTION, address, status, packed(params), packed(data) if len(data) > 0 else b'')
+        return status
+
+    def waitForFlag(self, interrupt_flag, timeout_s, interrupt=None):
+        if interrupt is None:
+            interrupt = SingleRegister()
+        started = perf_counter()
+        status = self.pozyx.waitForFlag(interrupt_flag, timeout_s, interrupt)
+        self.record(started, WAIT_FOR_FLAG, interrupt_flag, int(status), struct.pack('<d', timeout_s),
+                    bytes([interrupt[0] & 0xFF]))
+        return status
+
+    def serialExchange(self, s):
+        started = perf_counter()
+        try:
+            response = self.pozyx.serialExchange(s)
+        except Exception:
+            self.record(started, SERIAL_EXCHANGE, 0, POZYX_FAILURE, s.encode())
+            raise
+        self.record(started, SERIAL_EXCHANGE, 0, 1, s.encode(), response.encode())
+        return response
+
+
+class SessionLog(object):
+    """Reads a session log through a memory map, by time"""
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.wall_clock = FILE_HEADER.unpack_from(self.map, 0)
+        if magic != FILE_MAGIC:
+            raise ValueError("%s is not a session log" % path)
+        if version != VERSION:
+            raise ValueError("Unsupported session log version %i" % version)
+        # (first call time, last call time, number of calls, offset of the body, size of the body) per chunk
+        self.chunks = []
+        offset = FILE_HEADER.size
+        while offset + CHUNK_HEADER.size <= len(self.map):
+            magic, first, last, count, size = CHUNK_HEADER.unpack_from(self.map, offset)
+            body = offset + CHUNK_HEADER.size
+            if magic != CHUNK_MAGIC or body + size > len(self.map):
+                break
+            self.chunks.append((first, last, count, body, size))
+            offset = body + size
+        self.ends = [chunk[1] for chunk in self.chunks]
+
+    def __len__(self):
+        return sum(chunk[2] for chunk in self.chunks)
+
+    def duration(self):
+        return self.chunks[-1][1] if self.chunks else 0.0
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def chunkCalls(self, index):
+        first, last, count, body, size = self.chunks[index]
+        raw = zlib.decompress(self.map[body:body + size])
+        offset = 0
+        for _ in range(count):
+            start, duration, operation, address, status, argument_size, result_size = CALL.unpack_from(raw, offset)
+            offset += CALL.size
+            argument = raw[offset:offset + argument_size]
+            offset += argument_size
+            result = raw[offset:offset + result_size]
+            offset += result_size
+            yield Call(start, duration, operation, address, status, argument, result)
+
+    def calls(self, start=0.0, end=None):
+        """Yields the calls that started between start and end seconds into the session"""
+        for index in range(bisect.bisect_left(self.ends, start), len(self.chunks)):
+            if end is not None and self.chunks[index][0] > end:
+                return
+            for call in self.chunkCalls(index):
+                if call.start < start:
+                    continue
+                if end is not None and call.start > end:
+                    return
+                yield call
+
+
+class SessionReplay(PozyxLib):
+    """Answers the calls of a script from a session log instead of a Pozyx"""
+
+    def __init__(self, path, speed=1.0, start=0.0, lookahead=64):
+        """
+        Args:
+            path: the session log.
+            speed (optional): 1 replays at the recorded pace, 4 four times faster, None as fast as possible.
+            start (optional): seconds into the session to start at.
+            lookahead (optional): calls skipped at most to find the one the script makes, for when the
+                script takes a slightly different path than during recording.
+        """
+        PozyxLib.__init__(self)
+        self.suppress_warnings = False
+        self.log = SessionLog(path)
+        self.speed = speed
+        self.lookahead = lookahead
+        self.calls = self.log.calls(start)
+        self.pending = []
+        self.offset = start
+        self.started = None
+        self.replayed = 0
+        self.skipped = 0
+        self.unmatched = 0
+
+    def nextCall(self, operation, address):
+        """The next recorded call of this kind, waiting until it is due"""
+        for index in range(self.lookahead):
+            if index >= len(self.pending):
+                call = next(self.calls, None)
+                if call is None:
+                    break
+                self.pending.append(call)
+            call = self.pending[index]
+            if call.operation == operation and call.address == address:
+                self.skipped += index
+                del self.pending[:index + 1]
+                self.wait(call)
+                self.replayed += 1
+                return call
+        # the script went its own way: drop the oldest call so the replay keeps moving forward
+        self.unmatched += 1
+        if self.pending:
+            del self.pending[0]
+        return None
+
+    def wait(self, call):
+        if self.speed is None:
+            return
+        if self.started is None:
+            self.started = perf_counter() - (call.start - self.offset) / self.speed
+        due = self.started + (call.start + call.duration - self.offset) / self.speed
+        delay = due - perf_counter()
+        if delay > 0:
+            sleep(delay)
+
+    def finished(self):
+        if self.pending:
+            return False
+        call = next(self.calls, None)
+        if call is None:
+            return True
+        self.pending.append(call)
+        return False
+
+    def close(self):
+        self.log.close()
+
+    # the interface PozyxCore builds on
+
+    def regRead(self, address, data):
+        call = self.nextCall(REG_READ, address)
+        if call is None:
+            return POZYX_FAILURE
+        if call.result:
+            data.load_bytes(call.result.hex())
+        return call.status
+
+    def regWrite(self, address, data):
+        call = self.nextCall(REG_WRITE, address)
+        return POZYX_FAILURE if call is None else call.status
+
+    def regFunction(self, address, params, data):
+        call = self.nextCall(REG_FUNCTION, address)
+        if call is None:
+            return POZYX_FAILURE
+        if call.result and len(data) > 0:
+            data.load_bytes(call.result.hex())
+        return call.status
+
+    def waitForFlag(self, interrupt_flag, timeout_s, interrupt=None):
+        call = self.nextCall(WAIT_FOR_FLAG, interrupt_flag)
+        if call is None:
+            return False
+        if interrupt is not None and call.result:
+            interrupt[0] = call.result[0]
+        return bool(call.status)
+
+    def serialExchange(self, s):
+        call = self.nextCall(SERIAL_EXCHANGE, 0)
+        if call is None or not call.result:
+            raise SerialException("No recorded response to %s" % s.strip())
+        return call.result.decode()
+
+
+if __name__ == "__main__":
+    # records five simulated tags positioning for a few seconds, then replays that session through
+    # MultitagPositioning with the tracking filter at 1x, 4x and as fast as possible
+    import io
+    import os
+    import tempfile
+    from contextlib import redirect_stdout
+
+    from benchmark import ANCHORS, create_network
+    from multitag_positioning import MultitagPositioning
+    from simulated_pozyx import LatencyModel
+    from tracking_filter import KalmanFilterBank
+
+    tag_ids = [0x1000, 0x1001, 0x1002, 0x1003, 0x1004]
+    duration = 3
+    path = os.path.join(tempfile.mkdtemp(), "session.pzxlog")
+
+    def positioning(pozyx):
+        multitag = MultitagPositioning(pozyx, tag_ids, ANCHORS, [], False, None, 0,
+                                       tracking_filter=KalmanFilterBank())
+        fixes = []
+        multitag.printPublishPosition = lambda position, network_id: fixes.append(network_id)
+        return multitag, fixes
+
+    recorder = SessionRecorder(create_network(tag_ids, LatencyModel(jitter=0.1, seed=1), seed=1, position_noise=50),
+                               path)
+    multitag, fixes = positioning(recorder)
+    start = perf_counter()
+    with redirect_stdout(io.StringIO()):
+        while perf_counter() - start < duration:
+            multitag.loop()
+    recorder.close()
+    print("Recorded {} calls, {} fixes in {:.1f}s, log of {} bytes ({:.1f} bytes per call)".format(
+        recorder.recorded, len(fixes), duration, os.path.getsize(path), os.path.getsize(path) / recorder.recorded))
+
+    for speed in [1.0, 4.0, None]:
+        replay = SessionReplay(path, speed)
+        multitag, fixes = positioning(replay)
+        start = perf_counter()
+        with redirect_stdout(io.StringIO()):
+            while not replay.finished():
+                multitag.loop()
+        elapsed = perf_counter() - start
+        print("Replay at {}: {} fixes in {:.2f}s ({:.0f} fixes/s), {} calls replayed, {} skipped, {} unmatched".format(
+            "%gx" % speed if speed else "full speed", len(fixes), elapsed, len(fixes) / elapsed, replay.replayed,
+            replay.skipped, replay.unmatched))
+        replay.close()
+
+    log = SessionLog(path)
+    start = perf_counter()
+    middle = list(log.calls(log.duration() / 2, log.duration() / 2 + 0.1))
+    print("{} chunks, the {} calls of 100ms in the middle read in {:.2f}ms".format(
+        len(log.chunks), len(middle), (perf_counter() - start) * 1000))
+    log.close()
@@ -0,0 +1,653 @@
+"""
+An in-process simulation of a Pozyx network, to run the scripts without hardware.
+
+The simulation sits below PozyxSerial: SimulatedSerialPort speaks the same
+'R,..', 'W,..' and 'F,..' line protocol as the real USB serial port, so every
+pypozyx function (local and remote) runs unchanged on top of it.
+"""
+import heapq
+import math
+import random
+import struct
+import threading
+from time import perf_counter, sleep
+
+from pypozyx import (PozyxSerial, PozyxConnectionError, PozyxConstants, PozyxRegisters,
+                     POZYX_SUCCESS, POZYX_FAILURE, POZYX_ERROR_NOT_ENOUGH_ANCHORS, POZYX_ERROR_FLASH,
+                     POZYX_ERROR_RANGING)
+from pypozyx.definitions.bitmasks import PozyxBitmasks
+from serial import SerialException
+
+
+REGISTER_SPACE = 0x100
+MAX_DEVICES = 20
+# registers that can be saved to flash, one bit each in the flash details
+FLASH_REGISTERS = 20 * 8
+# registers wider than a byte, flash saves them by their first address
+REGISTER_WIDTHS = {PozyxRegisters.POSITIONING_INTERVAL: 2, PozyxRegisters.NETWORK_ID: 2}
+
+
+class LatencyModel(object):
+    """Timings of the serial link and the UWB radio, in seconds"""
+
+    def __init__(self, serial_round_trip=0.001, ranging_time=0.006, hop_time=0.002,
+                 byte_time=0.0, jitter=0.0, seed=None):
+        # one request/response exchange over the USB serial port
+        self.serial_round_trip = serial_round_trip
+        # one two-way ranging exchange between a tag and an anchor
+        self.ranging_time = ranging_time
+        # one UWB message between two devices
+        self.hop_time = hop_time
+        # every character sent or received over the serial port
+        self.byte_time = byte_time
+        # relative spread of every delay, 0.1 makes them vary by up to 10%
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+    def jittered(self, delay):
+        if not self.jitter:
+            return delay
+        return delay * (1 + self.random.uniform(-self.jitter, self.jitter))
+
+    def serial(self, request, response):
+        characters = len(request) + (len(response) if response is not None else 0)
+        return self.jittered(self.serial_round_trip + self.byte_time * characters)
+
+    def ranging(self, number_of_anchors):
+        return self.jittered(self.ranging_time * number_of_anchors)
+
+    def hop(self, payload_size):
+        return self.jittered(self.hop_time)
+
+
+def clamp_short(value):
+    return max(-0x8000, min(0x7FFF, int(round(value))))
+
+
+def circle(center, radius, period):
+    """A trajectory going round a horizontal circle every period seconds"""
+    def position(t):
+        angle = 2 * math.pi * t / period
+        return (center[0] + radius * math.cos(angle), center[1] + radius * math.sin(angle), center[2])
+    return position
+
+
+class SimulatedDevice(object):
+    """A single Pozyx tag or anchor with its registers, device list and RX/TX buffers"""
+
+    def __init__(self, network_id, position=(0, 0, 0), is_anchor=False, firmware_version=0x11, trajectory=None):
+        self.network_id = network_id
+        self.default_network_id = network_id
+        self.position = position
+        self.is_anchor = is_anchor
+        self.firmware_version = firmware_version
+        # function of the time in seconds returning the position in mm, for moving tags
+        self.trajectory = trajectory
+        self.network = None
+
+        # what survives a reset, and how often the flash memory was written
+        self.flash = {}
+        self.flash_writes = 0
+        self.resets = 0
+        self.leds = 0
+
+        # every unplug breaks the serial ports opened before it, like a USB device that re-enumerates
+        self.plugged = True
+        self.usb_connection = 0
+
+        self.reset_state()
+
+    def reset_state(self):
+        """Puts the registers and buffers in their power-up state, then applies the flash memory"""
+        self.registers = bytearray(REGISTER_SPACE)
+        self.registers[PozyxRegisters.WHO_AM_I] = 0x43
+        self.registers[PozyxRegisters.FIRMWARE_VERSION] = self.firmware_version
+        self.registers[PozyxRegisters.HARDWARE_VERSION] = 0x23
+        self.registers[PozyxRegisters.SELFTEST_RESULT] = 0x3F
+        self.registers[PozyxRegisters.POSITIONING_ALGORITHM] = PozyxConstants.DIMENSION_3D << 4
+        self.registers[PozyxRegisters.POSITIONING_NUMBER_OF_ANCHORS] = 4
+        self.registers[PozyxRegisters.UWB_CHANNEL] = 5
+        self.registers[PozyxRegisters.UWB_RATES] = 2 << 6
+        self.registers[PozyxRegisters.UWB_PLEN] = 0x08
+        self.registers[PozyxRegisters.UWB_GAIN] = 23
+        self.registers[PozyxRegisters.OPERATION_MODE] = int(self.is_anchor)
+        self.set_register(PozyxRegisters.NETWORK_ID, 'H', self.default_network_id)
+
+        self.devices = []
+        self.anchor_ids = []
+        self.ranges = {}
+        self.interrupt_status = 0
+        self.tx_buffer = bytearray()
+        self.rx_buffer = bytes()
+        self.rx_network_id = 0
+        # bumped to cancel the continuous positioning of before a reset
+        self.positioning_generation = getattr(self, 'positioning_generation', 0) + 1
+        self.positioning_interval = 0
+
+        for address, value in self.flash.get('registers', {}).items():
+            self.registers[address] = value
+        self.devices = list(self.flash.get('devices', []))
+        self.anchor_ids = list(self.flash.get('anchor_ids', []))
+        if self.network is not None:
+            network_id = self.get_register(PozyxRegisters.NETWORK_ID, 'H')[0]
+            if network_id != self.network_id:
+                self.network.rename(self, network_id)
+            self.update_positioning_interval()
+
+    def set_register(self, address, data_format, *values):
+        packed = struct.pack('<' + data_format, *values)
+        self.registers[address:address + len(packed)] = packed
+
+    def get_register(self, address, data_format):
+        return struct.unpack_from('<' + data_format, self.registers, address)
+
+    def true_position(self, t):
+        """The physical position of the device in mm at time t"""
+        if self.trajectory is not None:
+            return self.trajectory(t)
+        return self.position
+
+    def uwb_configuration(self):
+        return bytes(self.registers[PozyxRegisters.UWB_CHANNEL:PozyxRegisters.UWB_GAIN])
+
+    # register access
+
+    def read(self, address, size):
+        self.registers[PozyxRegisters.INTERRUPT_STATUS] = self.interrupt_status
+        self.registers[PozyxRegisters.DEVICE_LIST_SIZE] = len(self.devices)
+        self.set_register(PozyxRegisters.RX_NETWORK_ID, 'HB', self.rx_network_id, len(self.rx_buffer))
+        if address <= PozyxRegisters.INTERRUPT_STATUS < address + size:
+            # reading the interrupt status clears it, just like the firmware does
+            self.interrupt_status = 0
+        return bytes(self.registers[address:address + size])
+
+    def write(self, address, data):
+        self.registers[address:address + len(data)] = data
+        if address <= PozyxRegisters.NETWORK_ID + 1 and PozyxRegisters.NETWORK_ID < address + len(data):
+            self.network.rename(self, self.get_register(PozyxRegisters.NETWORK_ID, 'H')[0])
+        if address <= PozyxRegisters.POSITIONING_INTERVAL + 1 and PozyxRegisters.POSITIONING_INTERVAL < address + len(data):
+            self.update_positioning_interval()
+
+    # register functions
+
+    def call(self, address, params, requester=None):
+        """Performs a register function, returns the status and the output bytes"""
+        function = self.functions().get(address)
+        if function is None:
+            return POZYX_FAILURE, b''
+        return function(bytes(params), requester)
+
+    def functions(self):
+        return {
+            PozyxRegisters.WRITE_TX_DATA: self.write_tx_data,
+            PozyxRegisters.SEND_TX_DATA: self.send_tx_data,
+            PozyxRegisters.READ_RX_DATA: self.read_rx_data,
+            PozyxRegisters.DO_POSITIONING: self.do_positioning,
+            PozyxRegisters.DO_POSITIONING_WITH_DATA: self.get_positioning_data,
+            PozyxRegisters.DO_RANGING: self.do_ranging,
+            PozyxRegisters.GET_DEVICE_RANGE_INFO: self.get_device_range_info,
+            PozyxRegisters.DO_DISCOVERY: self.do_discovery,
+            PozyxRegisters.SET_POSITIONING_ANCHOR_IDS: self.set_positioning_anchor_ids,
+            PozyxRegisters.GET_POSITIONING_ANCHOR_IDS: self.get_positioning_anchor_ids,
+            PozyxRegisters.GET_DEVICE_LIST_IDS: self.get_device_list_ids,
+            PozyxRegisters.GET_DEVICE_COORDINATES: self.get_device_coordinates,
+            PozyxRegisters.CLEAR_DEVICES: self.clear_devices,
+            PozyxRegisters.ADD_DEVICE: self.add_device,
+            PozyxRegisters.SAVE_FLASH_MEMORY: self.save_flash_memory,
+            PozyxRegisters.RESET_FLASH_MEMORY: self.reset_flash_memory,
+            PozyxRegisters.GET_FLASH_DETAILS: self.get_flash_details,
+            PozyxRegisters.RESET_SYSTEM: self.reset_system,
+            PozyxRegisters.LED_CONTROL: self.led_control,
+        }
+
+    def write_tx_data(self, params, requester):
+        offset = params[0]
+        self.tx_buffer[offset:] = params[1:]
+        return POZYX_SUCCESS, b''
+
+    def send_tx_data(self, params, requester):
+        destination, operation = struct.unpack('<HB', params[:3])
+        payload, self.tx_buffer = bytes(self.tx_buffer), bytearray()
+        self.network.transmit(self, destination, operation, payload)
+        return POZYX_SUCCESS, b''
+
+    def read_rx_data(self, params, requester):
+        offset, size = params[0], params[1]
+        return POZYX_SUCCESS, self.rx_buffer[offset:offset + size]
+
+    def clear_devices(self, params, requester):
+        self.devices = []
+        return POZYX_SUCCESS, b''
+
+    def add_device(self, params, requester):
+        network_id, flag, x, y, z = struct.unpack('<HBiii', params[:15])
+        self.devices = [device for device in self.devices if device[0] != network_id]
+        if len(self.devices) >= MAX_DEVICES:
+            return POZYX_FAILURE, b''
+        self.devices.append((network_id, flag, (x, y, z)))
+        return POZYX_SUCCESS, b''
+
+    def get_device_list_ids(self, params, requester):
+        offset, size = params[0], params[1]
+        ids = [device[0] for device in self.devices[offset:offset + size]]
+        return POZYX_SUCCESS, struct.pack('<%dH' % len(ids), *ids)
+
+    def get_device_coordinates(self, params, requester):
+        network_id, = struct.unpack('<H', params[:2])
+        for device in self.devices:
+            if device[0] == network_id:
+                return POZYX_SUCCESS, struct.pack('<iii', *device[2])
+        return POZYX_FAILURE, b''
+
+    def set_positioning_anchor_ids(self, params, requester):
+        self.anchor_ids = list(struct.unpack('<%dH' % (len(params) // 2), params))
+        self.registers[PozyxRegisters.POSITIONING_NUMBER_OF_ANCHORS] = len(self.anchor_ids)
+        return POZYX_SUCCESS, b''
+
+    def get_positioning_anchor_ids(self, params, requester):
+        count = self.registers[PozyxRegisters.POSITIONING_NUMBER_OF_ANCHORS] & 0xF
+        ids = [anchor[0] for anchor in self.positioning_anchors()][:count]
+        ids += [0] * (count - len(ids))
+        return POZYX_SUCCESS, struct.pack('<%dH' % count, *ids)
+
+    def led_control(self, params, requester):
+        mask, states = params[0] >> 4, params[0] & 0xF
+        self.leds = (self.leds & ~mask) | (states & mask)
+        return POZYX_SUCCESS, b''
+
+    # flash memory
+
+    def save_flash_memory(self, params, requester):
+        save_type = params[0]
+        self.flash_writes += 1
+        if save_type == PozyxConstants.FLASH_SAVE_REGISTERS:
+            if len(params) < 2:
+                self.raise_error(POZYX_ERROR_FLASH)
+                return POZYX_FAILURE, b''
+            saved = self.flash.setdefault('registers', {})
+            for address in params[1:]:
+                for offset in range(REGISTER_WIDTHS.get(address, 1)):
+                    saved[address + offset] = self.registers[address + offset]
+        elif save_type == PozyxConstants.FLASH_SAVE_NETWORK:
+            self.flash['devices'] = list(self.devices)
+        elif save_type == PozyxConstants.FLASH_SAVE_ANCHOR_IDS:
+            self.flash['anchor_ids'] = list(self.anchor_ids)
+        elif save_type == PozyxConstants.FLASH_SAVE_ALL:
+            self.flash['registers'] = dict((address, self.registers[address]) for address in range(FLASH_REGISTERS))
+            self.flash['devices'] = list(self.devices)
+            self.flash['anchor_ids'] = list(self.anchor_ids)
+        else:
+            self.raise_error(POZYX_ERROR_FLASH)
+            return POZYX_FAILURE, b''
+        return POZYX_SUCCESS, b''
+
+    def reset_flash_memory(self, params, requester):
+        self.flash = {}
+        self.flash_writes += 1
+        return POZYX_SUCCESS, b''
+
+    def get_flash_details(self, params, requester):
+        details = bytearray(FLASH_REGISTERS // 8)
+        for address in self.flash.get('registers', {}):
+            if address < FLASH_REGISTERS:
+                details[address // 8] |= 1 << (address % 8)
+        return POZYX_SUCCESS, bytes(details)
+
+    def reset_system(self, params, requester):
+        # reset right after answering, like the firmware
+        self.network.schedule(self.network.time, self.reset)
+        return POZYX_SUCCESS, b''
+
+    def reset(self):
+        self.resets += 1
+        self.reset_state()
+
+    def unplug(self):
+        """Pulls the USB cable, serial ports opened before stay broken"""
+        self.plugged = False
+        self.usb_connection += 1
+
+    def plug(self):
+        """Plugs the USB cable back in, which powers the device up again"""
+        self.plugged = True
+        self.reset()
+
+    # ranging and discovery
+
+    def distance_to(self, other, t):
+        return math.sqrt(sum((a - b) ** 2 for a, b in zip(self.true_position(t), other.true_position(t))))
+
+    def do_ranging(self, params, requester):
+        destination_id, = struct.unpack('<H', params[:2])
+        destination = self.network.devices.get(destination_id)
+        if destination is None or destination.uwb_configuration() != self.uwb_configuration():
+            self.raise_error(POZYX_ERROR_RANGING)
+            return POZYX_SUCCESS, b''
+        # like positioning, a remote acknowledgement goes out before the ranging starts
+        self.network.schedule(self.network.time, lambda: self.start_ranging(destination, requester))
+        return POZYX_SUCCESS, b''
+
+    def start_ranging(self, destination, requester):
+        done = self.network.occupy_air(self.network.latency.ranging(1))
+        self.network.schedule(done, lambda: self.finish_ranging(destination, requester))
+
+    def finish_ranging(self, destination, requester):
+        t = self.network.time
+        distance = max(0, int(round(self.distance_to(destination, t) + self.network.noise())))
+        rss = int(-40 - 20 * math.log10(max(distance, 1) / 1000.0))
+        self.ranges[destination.network_id] = (int(t * 1000) & 0xFFFFFFFF, distance, rss)
+        range_info = struct.pack('<IIh', *self.ranges[destination.network_id])
+        if requester is None:
+            self.interrupt_status |= PozyxBitmasks.INT_STATUS_FUNC
+        else:
+            self.network.transmit(self, requester.network_id, PozyxConstants.REMOTE_DATA, range_info)
+
+    def get_device_range_info(self, params, requester):
+        network_id, = struct.unpack('<H', params[:2])
+        if network_id not in self.ranges:
+            return POZYX_FAILURE, b''
+        return POZYX_SUCCESS, struct.pack('<IIh', *self.ranges[network_id])
+
+    def do_discovery(self, params, requester):
+        discovery_type, slots, slot_duration = params[0], params[1], params[2] / 1000.0
+        done = self.network.time + slots * slot_duration
+        self.network.schedule(done, lambda: self.finish_discovery(discovery_type, requester))
+        return POZYX_SUCCESS, b''
+
+    def finish_discovery(self, discovery_type, requester):
+        for device in self.network.devices.values():
+            if device is self or device.uwb_configuration() != self.uwb_configuration():
+                continue
+            if discovery_type == PozyxConstants.DISCOVERY_ANCHORS_ONLY and not device.is_anchor:
+                continue
+            if discovery_type == PozyxConstants.DISCOVERY_TAGS_ONLY and device.is_anchor:
+                continue
+            if device.network_id not in [known[0] for known in self.devices] and len(self.devices) < MAX_DEVICES:
+                self.devices.append((device.network_id, 1 if device.is_anchor else 2, (0, 0, 0)))
+        self.interrupt_status |= PozyxBitmasks.INT_STATUS_FUNC
+
+    # positioning
+
+    def positioning_anchors(self):
+        """The anchors from the device list this device ranges with"""
+        anchors = [device for device in self.devices if device[1] == 0x1]
+        selection = self.registers[PozyxRegisters.POSITIONING_NUMBER_OF_ANCHORS]
+        if not selection & 0x80 and self.anchor_ids:
+            anchors = [anchor for anchor in anchors if anchor[0] in self.anchor_ids]
+        return anchors[:selection & 0xF]
+
+    def do_positioning(self, params, requester):
+        flags = struct.unpack('<H', params[:2])[0] if len(params) >= 2 else 0b1
+        anchors = [anchor for anchor in self.positioning_anchors() if anchor[0] in self.network.devices]
+        if len(anchors) < 3:
+            self.raise_error(POZYX_ERROR_NOT_ENOUGH_ANCHORS)
+            return POZYX_SUCCESS, b''
+        # start ranging right after this call returns, so a remote acknowledgement goes out first
+        self.network.schedule(self.network.time, lambda: self.start_positioning(len(anchors), flags, requester))
+        return POZYX_SUCCESS, b''
+
+    def update_positioning_interval(self):
+        """Starts or stops continuous positioning after POSITIONING_INTERVAL was written"""
+        interval = self.get_register(PozyxRegisters.POSITIONING_INTERVAL, 'H')[0] / 1000.0
+        was_running = self.positioning_interval > 0
+        self.positioning_interval = interval
+        if interval > 0 and not was_running:
+            generation = self.positioning_generation
+            self.network.schedule(self.network.time + interval, lambda: self.continuous_positioning(generation))
+
+    def continuous_positioning(self, generation):
+        if generation != self.positioning_generation or self.positioning_interval <= 0:
+            return
+        anchors = [anchor for anchor in self.positioning_anchors() if anchor[0] in self.network.devices]
+        busy = 0
+        if len(anchors) >= 3:
+            busy = self.network.latency.ranging(len(anchors))
+            done = self.network.occupy_air(busy)
+            self.network.schedule(done, lambda: self.finish_positioning(0b1, None))
+        next_time = self.network.time + max(self.positioning_interval, busy)
+        self.network.schedule(next_time, lambda: self.continuous_positioning(generation))
+
+    def get_positioning_data(self, params, requester):
+        """The data of the last positioning, over serial only"""
+        flags = struct.unpack('<H', params[:2])[0] if len(params) >= 2 else 0b1
+        return POZYX_SUCCESS, self.positioning_data(flags)
+
+    def start_positioning(self, number_of_anchors, flags, requester):
+        done = self.network.occupy_air(self.network.latency.ranging(number_of_anchors))
+        self.network.schedule(done, lambda: self.finish_positioning(flags, requester))
+
+    def finish_positioning(self, flags, requester):
+        x, y, z = self.measure_position(self.network.time)
+        self.set_register(PozyxRegisters.POSITION_X, 'iii', x, y, z)
+        self.interrupt_status |= PozyxBitmasks.INT_STATUS_POS
+        if requester is not None:
+            self.network.transmit(self, requester.network_id, PozyxConstants.REMOTE_DATA,
+                                  self.positioning_result(flags))
+
+    def measure_position(self, t):
+        return tuple(int(round(value + self.network.noise())) for value in self.true_position(t))
+
+    def positioning_result(self, flags):
+        """The bytes a remote device sends back after positioning"""
+        coordinates = bytes(self.registers[PozyxRegisters.POSITION_X:PozyxRegisters.POSITION_X + 12])
+        if self.registers[PozyxRegisters.FIRMWARE_VERSION] <= 0x11:
+            return coordinates
+        return self.positioning_data(flags)
+
+    def positioning_data(self, flags):
+        """Packs the positioning data for the given flags, see PositioningData"""
+        x, y, z = self.get_register(PozyxRegisters.POSITION_X, 'iii')
+        velocity, acceleration = self.motion(self.network.time)
+        # the IMU of a tag that lies flat, facing the way it moves
+        heading = math.atan2(velocity[1], velocity[0]) % (2 * math.pi)
+        linear = [int(round(value / 9.80665)) for value in acceleration]
+        gravity = [0, 0, 1000]
+        fields = [('iiiB', (x, y, z, 0)),
+                  ('hhh', [clamp_short(l + g) for l, g in zip(linear, gravity)]),
+                  ('hhh', (0, 0, 0)),
+                  ('hhh', (0, 0, 0)),
+                  ('hhh', (clamp_short(math.degrees(heading) * 16), 0, 0)),
+                  ('hhhh', (clamp_short(math.cos(heading / 2) * 16384), 0, 0,
+                            clamp_short(math.sin(heading / 2) * 16384))),
+                  ('hhh', [clamp_short(value) for value in linear]),
+                  ('hhh', gravity),
+                  ('I', (101325000,)),
+                  ('h', (clamp_short(math.sqrt(sum(value ** 2 for value in linear))),))]
+        packed = b''.join(struct.pack('<' + data_format, *values)
+                          for index, (data_format, values) in enumerate(fields) if flags & (1 << index))
+        return packed
+
+    def motion(self, t, dt=0.05):
+        """The velocity in mm/s and acceleration in mm/s^2 of the device at t"""
+        before, now, after = self.true_position(t - dt), self.true_position(t), self.true_position(t + dt)
+        velocity = [(a - b) / (2 * dt) for a, b in zip(after, before)]
+        acceleration = [(a - 2 * n + b) / dt ** 2 for a, n, b in zip(after, now, before)]
+        return velocity, acceleration
+
+    def raise_error(self, error_code):
+        self.registers[PozyxRegisters.ERROR_CODE] = error_code
+        self.interrupt_status |= PozyxBitmasks.INT_STATUS_ERR
+
+    # UWB messages from other devices
+
+    def receive(self, sender, operation, payload):
+        if operation == PozyxConstants.REMOTE_READ:
+            self.network.reply(self, sender, self.read(payload[0], payload[1]))
+        elif operation == PozyxConstants.REMOTE_WRITE:
+            self.write(payload[0], payload[1:])
+            self.network.reply(self, sender, b'')
+        elif operation == PozyxConstants.REMOTE_FUNCTION:
+            status, data = self.call(payload[0], payload[1:], requester=sender)
+            self.network.reply(self, sender, bytes([status]) + data)
+
+    def store_rx(self, sender_id, payload, interrupt_flag):
+        self.rx_buffer = bytes(payload)
+        self.rx_network_id = sender_id
+        self.interrupt_status |= interrupt_flag
+
+
+class SimulatedNetwork(object):
+    """The UWB air shared by the simulated devices, with a clock and an event queue"""
+
+    def __init__(self, latency=None, air_contention=True, position_noise=0.0, seed=None):
+        self.latency = LatencyModel() if latency is None else latency
+        self.air_contention = air_contention
+        # standard deviation of the measured positions and ranges in mm
+        self.position_noise = position_noise
+        self.random = random.Random(seed)
+        self.devices = {}
+        self.time = perf_counter()
+        self.air_free_at = self.time
+        self.lock = threading.RLock()
+        self._events = []
+        self._event_counter = 0
+
+    def add(self, device):
+        device.network = self
+        self.devices[device.network_id] = device
+        return device
+
+    def addAnchor(self, network_id, position, **kwargs):
+        return self.add(SimulatedDevice(network_id, position, is_anchor=True, **kwargs))
+
+    def addTag(self, network_id, position=(0, 0, 0), **kwargs):
+        return self.add(SimulatedDevice(network_id, position, **kwargs))
+
+    def remove(self, device):
+        """Takes a device off the air, like a tag out of range or without power, add() brings it back"""
+        if self.devices.get(device.network_id) is device:
+            del self.devices[device.network_id]
+
+    def rename(self, device, network_id):
+        if self.devices.get(device.network_id) is device:
+            del self.devices[device.network_id]
+        device.network_id = network_id
+        self.devices[network_id] = device
+
+    def anchors(self):
+        return [device for device in self.devices.values() if device.is_anchor]
+
+    def noise(self):
+        if not self.position_noise:
+            return 0.0
+        return self.random.gauss(0, self.position_noise)
+
+    # time keeping
+
+    def schedule(self, at, callback):
+        self._event_counter += 1
+        heapq.heappush(self._events, (at, self._event_counter, callback))
+
+    def advance(self, until=None):
+        """Runs all events that are due, in order"""
+        until = perf_counter() if until is None else until
+        while self._events and self._events[0][0] <= until:
+            at, _, callback = heapq.heappop(self._events)
+            self.time = max(self.time, at)
+            callback()
+        self.time = max(self.time, until)
+
+    def occupy_air(self, duration):
+        """Reserves the UWB channel for duration seconds and returns when that ends"""
+        if not self.air_contention:
+            return self.time + duration
+        start = max(self.time, self.air_free_at)
+        self.air_free_at = start + duration
+        return self.air_free_at
+
+    # UWB messaging
+
+    def transmit(self, sender, destination, operation, payload):
+        receiver = self.devices.get(destination)
+        if receiver is None or receiver.uwb_configuration() != sender.uwb_configuration():
+            return
+        arrival = self.occupy_air(self.latency.hop(len(payload)))
+        if operation == PozyxConstants.REMOTE_DATA:
+            # the sender id is fixed when sending, the sender might be reset before the data arrives
+            sender_id = sender.network_id
+            self.schedule(arrival, lambda: receiver.store_rx(sender_id, payload, PozyxBitmasks.INT_STATUS_RX_DATA))
+        else:
+            self.schedule(arrival, lambda: receiver.receive(sender, operation, payload))
+
+    def reply(self, sender, receiver, payload):
+        """Sends the answer of a remote read, write or function back to the requester"""
+        if receiver.uwb_configuration() != sender.uwb_configuration():
+            return
+        sender_id = sender.network_id
+        arrival = self.occupy_air(self.latency.hop(len(payload)))
+        self.schedule(arrival, lambda: receiver.store_rx(sender_id, payload, PozyxBitmasks.INT_STATUS_FUNC))
+
+
+class SimulatedSerialPort(object):
+    """Stands in for serial.Serial, executing the Pozyx serial protocol on a simulated device"""
+
+    def __init__(self, device):
+        self.device = device
+        self.network = device.network
+        self.is_open = True
+        self.usb_connection = device.usb_connection
+        self._responses = []
+        # number of requests handled, to count the serial traffic of a script
+        self.requests = 0
+
+    def write(self, data):
+        if not self.is_open or self.usb_connection != self.device.usb_connection:
+            raise SerialException("write failed: device disconnected")
+        for request in data.decode().split('\r'):
+            if request:
+                self.execute(request)
+        return len(data)
+
+    def readline(self):
+        if not self._responses:
+            return b''
+        return self._responses.pop(0)
+
+    def close(self):
+        self.is_open = False
+
+    def execute(self, request):
+        self.requests += 1
+        with self.network.lock:
+            self.network.advance()
+            response = self.respond(request.split(','))
+        sleep(self.network.latency.serial(request, response))
+        if response is not None:
+            self._responses.append(response.encode())
+
+    def respond(self, fields):
+        """Handles one request line and returns the response line, if any"""
+        device = self.device
+        address = int(fields[1], 16)
+        if fields[0] == 'R':
+            return 'D,%s\r\n' % device.read(address, int(fields[2])).hex()
+        if fields[0] == 'W':
+            device.write(address, bytes.fromhex(fields[2]))
+            return None
+        if fields[0] == 'F':
+            status, data = device.call(address, bytes.fromhex(fields[2]))
+            if address == PozyxRegisters.DO_POSITIONING_WITH_DATA:
+                # answered with just the data asked for, not the requested size
+                return 'D,%0.2x%s\r\n' % (status, data.hex())
+            size = int(fields[3]) - 1
+            data = bytes(data[:size]) + bytes(max(0, size - len(data)))
+            return 'D,%0.2x%s\r\n' % (status, data.hex())
+        return None
+
+
+class SimulatedPozyxSerial(PozyxSerial):
+    """A PozyxSerial connected to a device of a SimulatedNetwork instead of a USB port"""
+
+    def __init__(self, network, network_id, **kwargs):
+        self.network = network
+        self.device = network.devices[network_id]
+        super(SimulatedPozyxSerial, self).__init__("sim:0x%0.4x" % network_id, **kwargs)
+
+    def connectToPozyx(self, port, baudrate, timeout, write_timeout):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.write_timeout = write_timeout
+        if not self.device.plugged:
+            raise PozyxConnectionError("Wrong or busy serial port, SerialException: %s is unplugged" % port)
+        self.ser = SimulatedSerialPort(self.device)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+A Kalman filter for the positions of all tags, run on the host instead of the filter of the Pozyx.
+
+The on-device filters (FILTER_TYPE_MOVING_AVERAGE and friends) lag behind a moving tag and are set
+per tag with a flash write. KalmanFilterBank keeps a constant velocity (or constant acceleration)
+model of every tag in one NumPy array and updates all tags of a frame at once. Positions that are
+too far from where a tag is expected to be are rejected as outliers, a tag whose positions keep
+getting rejected is started over from its latest position.
+
+The x, y and z axes are filtered independently with the same model and noise, so they share one
+covariance matrix per tag.
+"""
+from time import perf_counter
+
+import numpy as np
+
+
+# chi-square with 3 degrees of freedom, 99.9% of the genuine positions pass
+DEFAULT_GATE = 16.27
+
+
+class KalmanFilterBank(object):
+    """Filters the positions of many tags with a Kalman filter each, in batch"""
+
+    def __init__(self, process_noise=500000.0, measurement_noise=100.0, model="velocity", gate=DEFAULT_GATE,
+                 max_rejections=5, initial_velocity=1000.0, capacity=16):
+        """
+        Args:
+            process_noise (optional): how fast the motion of a tag can change, as the spectral density of
+                its acceleration (velocity model) or jerk (acceleration model) in mm/s² or mm/s³.
+            measurement_noise (optional): standard deviation of a position in mm.
+            model (optional): "velocity" or "acceleration".
+            gate (optional): squared Mahalanobis distance above which a position is an outlier, None
+                accepts every position.
+            max_rejections (optional): outliers in a row after which a tag is started over.
+            initial_velocity (optional): standard deviation of the velocity of a new tag in mm/s.
+            capacity (optional): number of tags to make room for, it grows when needed.
+        """
+        if model not in ("velocity", "acceleration"):
+            raise ValueError("Unknown motion model %s" % model)
+        self.order = 2 if model == "velocity" else 3
+        self.process_noise = process_noise
+        self.measurement_variance = measurement_noise ** 2
+        self.gate = gate
+        self.max_rejections = max_rejections
+        self.initial_covariance = np.diag(
+            [self.measurement_variance, initial_velocity ** 2, (10 * initial_velocity) ** 2][:self.order])
+
+        self.indices = {}
+        # per tag: state per axis (position, velocity[, acceleration]), shared covariance, time, outliers in a row
+        self.states = np.zeros((capacity, 3, self.order))
+        self.covariances = np.zeros((capacity, self.order, self.order))
+        self.times = np.zeros(capacity)
+        self.rejections = np.zeros(capacity, dtype=int)
+
+        self.updates = 0
+        self.outliers = 0
+
+    def __len__(self):
+        return len(self.indices)
+
+    def rows(self, tag_ids):
+        """The rows of the tags, making room for the ones that are new"""
+        rows = np.empty(len(tag_ids), dtype=int)
+        new = np.zeros(len(tag_ids), dtype=bool)
+        for i, tag_id in enumerate(tag_ids):
+            row = self.indices.get(tag_id)
+            if row is None:
+                row = self.indices[tag_id] = len(self.indices)
+                new[i] = True
+            rows[i] = row
+        if len(self.indices) > len(self.times):
+            self.grow(len(self.indices))
+        return rows, new
+
+    def grow(self, size):
+        capacity = max(size, 2 * len(self.times))
+        extra = capacity - len(self.times)
+        self.states = np.concatenate([self.states, np.zeros((extra, 3, self.order))])
+        self.covariances = np.concatenate([self.covariances, np.zeros((extra, self.order, self.order))])
+        self.times = np.concatenate([self.times, np.zeros(extra)])
+        self.rejections = np.concatenate([self.rejections, np.zeros(extra, dtype=int)])
+
+    def transitions(self, dt):
+        """State transition and process noise matrices for a step of dt seconds per tag"""
+        ones = np.ones_like(dt)
+        zeros = np.zeros_like(dt)
+        q = self.process_noise
+        if self.order == 2:
+            transition = np.stack([np.stack([ones, dt], -1), np.stack([zeros, ones], -1)], -2)
+            noise = q * np.stack([np.stack([dt ** 3 / 3, dt ** 2 / 2], -1),
+                                  np.stack([dt ** 2 / 2, dt], -1)], -2)
+        else:
+            transition = np.stack([np.stack([ones, dt, dt ** 2 / 2], -1),
+                                   np.stack([zeros, ones, dt], -1),
+                                   np.stack([zeros, zeros, ones], -1)], -2)
+            noise = q * np.stack([np.stack([dt ** 5 / 20, dt ** 4 / 8, dt ** 3 / 6], -1),
+                                  np.stack([dt ** 4 / 8, dt ** 3 / 3, dt ** 2 / 2], -1),
+                                  np.stack([dt ** 3 / 6, dt ** 2 / 2, dt], -1)], -2)
+        return transition, noise
+
+    def propagate(self, rows, timestamps):
+        """The states and covariances of the rows moved forward to the timestamps, without storing them"""
+        dt = np.maximum(timestamps - self.times[rows], 0.0)
+        transition, noise = self.transitions(dt)
+        states = np.einsum('tij,taj->tai', transition, self.states[rows])
+        covariances = np.einsum('tij,tjk,tlk->til', transition, self.covariances[rows], transition) + noise
+        return states, covariances
+
+    def update(self, tag_ids, positions, timestamps):
+        """
+        Filters one position for each of the tags.
+
+        Args:
+            tag_ids: the tags the positions belong to, each tag at most once.
+            positions: array of shape (tags, 3) in mm.
+            timestamps: the time of each position in seconds, or a single time for all of them.
+
+        Returns:
+            the filtered positions of shape (tags, 3), and which positions were accepted. A rejected
+            position is replaced by the predicted one.
+        """
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        timestamps = np.broadcast_to(np.asarray(timestamps, dtype=float), (len(positions),))
+        rows, new = self.rows(tag_ids)
+        states, covariances = self.propagate(rows, timestamps)
+
+        # only the position is measured, so the innovation covariance is a scalar per tag
+        innovations = positions - states[:, :, 0]
+        variances = covariances[:, 0, 0] + self.measurement_variance
+        accepted = np.ones(len(rows), dtype=bool)
+        if self.gate is not None:
+            accepted = (innovations ** 2).sum(axis=1) / variances <= self.gate
+        accepted |= new
+
+        gains = covariances[:, :, 0] / variances[:, None]
+        gains[~accepted] = 0.0
+        states += gains[:, None, :] * innovations[:, :, None]
+        covariances -= gains[:, :, None] * covariances[:, None, 0, :]
+
+        rejections = np.where(accepted, 0, self.rejections[rows] + 1)
+        restart = new | (rejections > self.max_rejections)
+        if restart.any():
+            states[restart] = 0.0
+            states[restart, :, 0] = positions[restart]
+            covariances[restart] = self.initial_covariance
+            rejections[restart] = 0
+            accepted |= restart
+
+        self.states[rows] = states
+        self.covariances[rows] = covariances
+        self.times[rows] = timestamps
+        self.rejections[rows] = rejections
+        self.updates += len(rows)
+        self.outliers += int((~accepted).sum())
+        return states[:, :, 0].copy(), accepted
+
+    def predict(self, tag_ids, timestamp):
+        """Where the tags are expected to be at timestamp, without changing their state"""
+        rows = np.array([self.indices[tag_id] for tag_id in tag_ids], dtype=int)
+        states, _ = self.propagate(rows, np.full(len(rows), float(timestamp)))
+        return states[:, :, 0]
+
+    def velocities(self, tag_ids):
+        rows = np.array([self.indices[tag_id] for tag_id in tag_ids], dtype=int)
+        return self.states[rows, :, 1].copy()
+
+    def remove(self, tag_id):
+        """Forgets a tag, its row is taken over by the last tag"""
+        row = self.indices.pop(tag_id)
+        last = len(self.indices)
+        if row != last:
+            moved = next(other for other, index in self.indices.items() if index == last)
+            self.indices[moved] = row
+            for array in (self.states, self.covariances, self.times, self.rejections):
+                array[row] = array[last]
+
+
+if __name__ == "__main__":
+    # filters noisy circles with a few outliers, and times a frame for growing numbers of tags
+    rate = 20.0
+    frames = 200
+    noise = 80.0
+    outlier_rate = 0.02
+
+    random = np.random.default_rng(1)
+    for number_of_tags in [10, 100, 1000]:
+        bank = KalmanFilterBank(measurement_noise=noise)
+        tag_ids = list(range(0x1000, 0x1000 + number_of_tags))
+        phases = random.uniform(0, 2 * np.pi, number_of_tags)
+        raw_errors = []
+        filtered_errors = []
+        frame_times = []
+        for frame in range(frames):
+            t = frame / rate
+            truth = np.column_stack([1000 + 800 * np.cos(t + phases), 1500 + 800 * np.sin(t + phases),
+                                     np.full(number_of_tags, 1000.0)])
+            measured = truth + random.normal(0, noise, truth.shape)
+            outliers = random.random(number_of_tags) < outlier_rate
+            measured[outliers] += random.normal(0, 2000, (outliers.sum(), 3))
+            start = perf_counter()
+            filtered, accepted = bank.update(tag_ids, measured, t)
+            frame_times.append(perf_counter() - start)
+            if frame > 20:
+                raw_errors.append(np.linalg.norm(measured - truth, axis=1))
+                filtered_errors.append(np.linalg.norm(filtered - truth, axis=1))
+        frame_times = np.array(frame_times[1:]) * 1000
+        print("{} tags: {:.3f}ms per frame (p99 {:.3f}ms), {:.2f}us per tag, median error raw {:.0f}mm, "
+              "filtered {:.0f}mm, outliers rejected: {:.1f}%".format(
+                  number_of_tags, np.median(frame_times), np.percentile(frame_times, 99),
+                  np.median(frame_times) / number_of_tags * 1000, np.median(np.concatenate(raw_errors)),
+                  np.median(np.concatenate(filtered_errors)), 100.0 * bank.outliers / bank.updates))